@@ -1,9 +1,102 @@
 import pygame
 import time
 import os
+import io
 import asyncio
-import soundfile as sf
-from mutagen.mp3 import MP3
+import queue
+import threading
+from concurrent.futures import Future
+from audio_stream import StreamDecoder, AudioStream, StreamPlayback
+
+
+class PlaybackWatcher:
+    """
+    Watches the mixer from one background thread and resolves a Future the moment a sound/channel/music stops being busy.
+    This replaces sleeping for the length the file metadata claims, which cuts playback short or leaves us idle when it's off.
+    The thread only polls while something is actually playing.
+    Futures are resolved in order on one resolver thread rather than the watcher's own, so a slow done callback never holds up
+    the polling. A callback that waits for more playback (e.g. play_audio_queued()) has to wait with wait(), which keeps
+    resolving from the callback until its future is done.
+    """
+
+    def __init__(self, poll_interval=0.005):
+        self.poll_interval = poll_interval
+        self.watches = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (future, result, error) to resolve, in the order playback finished
+        self.finished = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.resolver_thread = threading.Thread(target=self._resolve, daemon=True)
+        self.resolver_thread.start()
+
+    def watch(self, is_finished, result=None, on_finished=None):
+        """
+        Returns a Future that resolves with result once is_finished() returns True.
+        on_finished (callable): optional callback, called with the Future when playback ends
+        """
+        playback_future = Future()
+        if on_finished:
+            playback_future.add_done_callback(on_finished)
+        with self.lock:
+            self.watches.append((is_finished, result, playback_future))
+        self.wakeup.set()
+        return playback_future
+
+    def wait(self, playback_future, timeout=None):
+        """playback_future.result(), but safe to call from a done callback (i.e. on the resolver thread)"""
+        if threading.current_thread() is not self.resolver_thread:
+            return playback_future.result(timeout)
+        # Nobody else is going to resolve it, so carry on resolving from here, still in order
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not playback_future.done():
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            try:
+                self._resolve_one(self.finished.get(timeout=self.poll_interval))
+            except queue.Empty:
+                pass
+        return playback_future.result(0)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                watches = self.watches
+                self.watches = []
+            still_playing = []
+            for is_finished, result, playback_future in watches:
+                if playback_future.cancelled():
+                    continue
+                try:
+                    finished = not pygame.mixer.get_init() or is_finished()
+                except Exception as e:
+                    self.finished.put((playback_future, None, e))
+                    continue
+                if finished:
+                    self.finished.put((playback_future, result, None))
+                else:
+                    still_playing.append((is_finished, result, playback_future))
+            with self.lock:
+                self.watches = still_playing + self.watches
+                if not self.watches:
+                    self.wakeup.clear()
+            time.sleep(self.poll_interval)
+
+    def _resolve(self):
+        # Off the watcher thread, so the callbacks can take as long as they like
+        while True:
+            self._resolve_one(self.finished.get())
+
+    @staticmethod
+    def _resolve_one(finished):
+        playback_future, result, error = finished
+        if error is not None:
+            playback_future.set_exception(error)
+        else:
+            playback_future.set_result(result)
+
 
 class AudioManager:
 
@@ -11,55 +104,202 @@ class AudioManager:
         # Use higher frequency to prevent audio glitching noises
         # Use higher buffer because why not (default is 512)
         pygame.mixer.init(frequency=48000, buffer=1024) 
+        # Keep channel 0 for queued speech, so Sound.play() never grabs it for something else
+        pygame.mixer.set_reserved(1)
+        self.playback_watcher = PlaybackWatcher()
+        # A few silent samples, used to push real clips out of the speech channel's queue when stopping
+        self.silence = pygame.mixer.Sound(buffer=bytes(256))
+        # StreamPlaybacks that are still going, stop_audio() stops them too
+        self.stream_playbacks = set()
+        self.stream_lock = threading.Lock()
 
-    def play_audio(self, file_path, sleep_during_playback=True, delete_file=False, play_using_music=True):
+    def play_audio(self, file_path, sleep_during_playback=True, delete_file=False, play_using_music=True, on_finished=None):
         """
         Parameters:
         file_path (str): path to the audio file
-        sleep_during_playback (bool): means program will wait for length of audio file before returning
-        delete_file (bool): means file is deleted after playback (note that this shouldn't be used for multithreaded function calls)
+        sleep_during_playback (bool): means program will wait until the mixer reports the audio has finished before returning
+        delete_file (bool): means file is deleted once it has been loaded into memory, and is then played from memory
         play_using_music (bool): means it will use Pygame Music, if false then uses pygame Sound instead
+        on_finished (callable): optional callback, called with the playback Future the moment playback ends
+        Returns a Future that resolves when playback has really ended
         """
         print(f"Playing file with pygame: {file_path}")
-        if not pygame.mixer.get_init(): # Reinitialize mixer if needed
-            pygame.mixer.init(frequency=48000, buffer=1024) 
+        if delete_file:
+            # Read the file into memory and delete it right away, instead of stopping the mixer later just to release the file
+            with open(file_path, "rb") as audio_file:
+                audio_bytes = audio_file.read()
+            try:
+                os.remove(file_path)
+                print(f"Deleted the audio file.")
+            except PermissionError:
+                print(f"Couldn't remove {file_path} because it is being used by another process.")
+            return self.play_audio_bytes(audio_bytes, sleep_during_playback, on_finished)
+
+        self._ensure_mixer()
         if play_using_music:
             # Pygame Music can only play one file at a time
             pygame.mixer.music.load(file_path)
             pygame.mixer.music.play()
+            playback_future = self.playback_watcher.watch(lambda: not pygame.mixer.music.get_busy(), on_finished=on_finished)
         else:
             # Pygame Sound lets you play multiple sounds simultaneously
             pygame_sound = pygame.mixer.Sound(file_path) 
-            pygame_sound.play()
+            playback_future = self._play_sound(pygame_sound, on_finished)
+
+        if sleep_during_playback:
+            self.playback_watcher.wait(playback_future)
+        return playback_future
+
+    def play_audio_bytes(self, audio_bytes, sleep_during_playback=True, on_finished=None):
+        """
+        Plays audio straight from memory (e.g. what ElevenLabs just returned), without ever writing it to disk.
+        The audio is decoded once, and the length comes from the decoded sound instead of re-reading file metadata.
 
+        Parameters:
+        audio_bytes (bytes or file-like object): encoded audio (mp3, wav, ogg)
+        sleep_during_playback (bool): means program will wait until the audio has finished before returning
+        on_finished (callable): optional callback, called with the playback Future the moment playback ends
+        Returns a Future that resolves with the length of the audio in seconds when playback has really ended
+        """
+        print("Playing audio from memory with pygame")
+        pygame_sound = self._load_sound(audio_bytes)
+        playback_future = self._play_sound(pygame_sound, on_finished)
         if sleep_during_playback:
-            # Calculate length of the file, based on the file format
-            _, ext = os.path.splitext(file_path) # Get the extension of this file
-            if ext.lower() == '.wav':
-                wav_file = sf.SoundFile(file_path)
-                file_length = wav_file.frames / wav_file.samplerate
-                wav_file.close()
-            elif ext.lower() == '.mp3':
-                mp3_file = MP3(file_path)
-                file_length = mp3_file.info.length
-            else:
-                print("Cannot play audio, unknown file type")
-                return
-
-            # Sleep until file is done playing
-            time.sleep(file_length)
-
-            # Delete the file
-            if delete_file:
-                # Stop Pygame so file can be deleted
-                # Note: this will stop the audio on other threads as well, so it's not good if you're playing multiple sounds at once
-                pygame.mixer.music.stop()
-                pygame.mixer.quit()
-                try:  
-                    os.remove(file_path)
-                    print(f"Deleted the audio file.")
-                except PermissionError:
-                    print(f"Couldn't remove {file_path} because it is being used by another process.")
+            self.playback_watcher.wait(playback_future)
+        return playback_future
+
+    def play_audio_queued(self, audio, on_finished=None):
+        """
+        Plays the audio on the reserved speech channel right after whatever that channel is playing now,
+        so back-to-back clips (e.g. one per sentence) play without a gap.
+        A channel only holds one queued sound, so this blocks until there is room for the clip.
+
+        Parameters:
+        audio (str, bytes or file-like object): path to the audio file, or the encoded audio itself
+        on_finished (callable): optional callback, called with the playback Future once this clip has finished
+        Returns a Future that resolves when this clip has finished playing
+        """
+        # Decode the audio before we wait, so it's ready the moment the channel frees up
+        pygame_sound = self._load_sound(audio)
+        speech_channel = pygame.mixer.Channel(0)
+        self.playback_watcher.wait(self.playback_watcher.watch(lambda: speech_channel.get_queue() is None))
+        # If nothing is playing on the channel, queue() starts the sound immediately
+        speech_channel.queue(pygame_sound)
+        # The clip is done once it's neither playing nor waiting in the queue
+        return self.playback_watcher.watch(
+            lambda: speech_channel.get_sound() is not pygame_sound and speech_channel.get_queue() is not pygame_sound,
+            pygame_sound.get_length(),
+            on_finished
+        )
+
+    def open_stream(self, chunks, audio_format="mp3", sample_rate=24000, channels=1, on_done=None):
+        """
+        Starts reading and decoding audio that's still coming in (e.g. a TTS response as it downloads) into a buffer,
+        on a background thread. Nothing plays until it's passed to play_stream(), so the next sentence can be
+        downloading while this one plays.
+
+        Parameters:
+        chunks (iterable): the encoded (mp3) or raw (pcm) audio, in pieces of any size
+        audio_format (str): "mp3" or "pcm" (16 bit little endian)
+        sample_rate (int), channels (int): what the pcm audio is, mp3 says it itself
+        on_done (callable): optional callback, called once all the chunks are read
+        Returns an AudioStream
+        """
+        self._ensure_mixer()
+        mixer_rate, _, mixer_channels = pygame.mixer.get_init()
+        decoder = StreamDecoder(audio_format, sample_rate, channels, mixer_rate, mixer_channels)
+        return AudioStream(chunks, decoder, on_done=on_done)
+
+    def play_stream(self, audio, preroll_ms=150, block_ms=50, audio_format="mp3", sample_rate=24000, channels=1, on_finished=None):
+        """
+        Plays audio while it's still coming in, on the reserved speech channel: right after whatever is queued there now,
+        once preroll_ms of it is buffered. No subprocess and no temp files, it's decoded straight into memory.
+        Underruns fade out and back in instead of clicking, see StreamPlayback.
+
+        Parameters:
+        audio (iterable or AudioStream): chunks of audio (see open_stream()), or a stream open_stream() already started
+        preroll_ms (float): how much has to be buffered before playback starts
+        block_ms (float): how much is handed to the mixer at a time
+        audio_format, sample_rate, channels: what the chunks are, see open_stream()
+        on_finished (callable): optional callback, called with the finished Future once playback ends
+        Returns the StreamPlayback: playback.fed resolves once everything is queued on the channel,
+        playback.finished once it has been played, and playback.stats() says how full the buffer stayed
+        """
+        audio_stream = audio if isinstance(audio, AudioStream) else self.open_stream(audio, audio_format, sample_rate, channels)
+        playback = StreamPlayback(audio_stream, pygame.mixer.Channel(0), self.playback_watcher, preroll_ms, block_ms, on_finished=on_finished)
+        with self.stream_lock:
+            self.stream_playbacks.add(playback)
+        playback.finished.add_done_callback(lambda _: self._forget_stream(playback))
+        return playback.start()
+
+    def _forget_stream(self, playback):
+        with self.stream_lock:
+            self.stream_playbacks.discard(playback)
+
+    def wait_for_queued_audio(self):
+        """Blocks until the speech channel has played everything queued on it"""
+        self.playback_watcher.wait(self.queued_audio_finished())
+
+    def queued_audio_finished(self, on_finished=None):
+        """Returns a Future that resolves once the speech channel has played everything queued on it"""
+        if not pygame.mixer.get_init():
+            playback_future = Future()
+            playback_future.set_result(None)
+            return playback_future
+        speech_channel = pygame.mixer.Channel(0)
+        return self.playback_watcher.watch(lambda: not speech_channel.get_busy(), on_finished=on_finished)
+
+    def stop_audio(self, fade_ms=150):
+        """
+        Fades out everything that's playing and drops anything queued on the speech channel, streams stop downloading
+        (e.g. because the user started talking over the assistant).
+        Any playback futures resolve as soon as the fade is over.
+
+        Parameters:
+        fade_ms (int): length of the fade out, 0 stops immediately
+        """
+        with self.stream_lock:
+            stream_playbacks = list(self.stream_playbacks)
+        # Streams stop queueing blocks first, so nothing new starts once the fade is going
+        for playback in stream_playbacks:
+            playback.stop()
+        if not pygame.mixer.get_init():
+            return
+        if fade_ms <= 0:
+            pygame.mixer.stop()
+            pygame.mixer.music.stop()
+            return
+        speech_channel = pygame.mixer.Channel(0)
+        # fadeout() still lets the queued clip start afterwards, so swap it for a blank one first
+        if speech_channel.get_busy():
+            speech_channel.queue(self.silence)
+        pygame.mixer.fadeout(fade_ms)
+        pygame.mixer.music.fadeout(fade_ms)
+
+    def _ensure_mixer(self):
+        if not pygame.mixer.get_init(): # Reinitialize mixer if needed
+            pygame.mixer.init(frequency=48000, buffer=1024) 
+            pygame.mixer.set_reserved(1)
+
+    def _load_sound(self, audio):
+        """Decodes a file path, raw bytes or a file-like buffer into a pygame Sound"""
+        self._ensure_mixer()
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = io.BytesIO(audio)
+        return pygame.mixer.Sound(file=audio)
+
+    def _play_sound(self, pygame_sound, on_finished=None):
+        channel = pygame_sound.play()
+        if channel is None:
+            # Every channel is busy, so pygame dropped the sound
+            playback_future = Future()
+            playback_future.set_result(0)
+            return playback_future
+        return self.playback_watcher.watch(
+            lambda: channel.get_sound() is not pygame_sound or not channel.get_busy(),
+            pygame_sound.get_length(),
+            on_finished
+        )
 
     async def play_audio_async(self, file_path):
         """
@@ -67,37 +307,117 @@ class AudioManager:
         file_path (str): path to the audio file
         """
         print(f"Playing file with asynchronously with pygame: {file_path}")
-        if not pygame.mixer.get_init(): # Reinitialize mixer if needed
-            pygame.mixer.init(frequency=48000, buffer=1024) 
+        self._ensure_mixer()
         pygame_sound = pygame.mixer.Sound(file_path) 
-        pygame_sound.play()
-
-        # Calculate length of the file, based on the file format
-        _, ext = os.path.splitext(file_path) # Get the extension of this file
-        if ext.lower() == '.wav':
-            wav_file = sf.SoundFile(file_path)
-            file_length = wav_file.frames / wav_file.samplerate
-            wav_file.close()
-        elif ext.lower() == '.mp3':
-            mp3_file = MP3(file_path)
-            file_length = mp3_file.info.length
-        else:
-            print("Cannot play audio, unknown file type")
-            return
-
-        # We must use asyncio.sleep() here because the normal time.sleep() will block the thread, even if it's in an async function
-        await asyncio.sleep(file_length)
+        # Awaiting the wrapped future doesn't block the event loop, and returns the moment the mixer says playback ended
+        await asyncio.wrap_future(self._play_sound(pygame_sound))
 
 
 # TESTS
 if __name__ == '__main__':
+    import sys
+    import numpy as np
+    # Run with --dummy to use SDL's dummy audio driver (no sound card needed, playback still takes real time)
+    if "--dummy" in sys.argv:
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+
     audio_manager = AudioManager()
     MP3_FILEPATH = "TestAudio_MP3.mp3"
     WAV_FILEPATH = "TestAudio_WAV.wav"
 
     if not os.path.exists(MP3_FILEPATH) or not os.path.exists(WAV_FILEPATH):
         exit("Missing test audio")
-    
+
+    # Completion test: the future should resolve when the mixer stops, not before and not long after
+    with open(MP3_FILEPATH, "rb") as mp3_file:
+        mp3_bytes = mp3_file.read()
+    finished_callbacks = []
+    start = time.perf_counter()
+    playback_future = audio_manager.play_audio_bytes(mp3_bytes, False, finished_callbacks.append)
+    audio_length = playback_future.result(timeout=10)
+    waited = time.perf_counter() - start
+    assert audio_length - 0.05 < waited < audio_length + 0.25, (audio_length, waited)
+    print(f"Playback of a {audio_length:.2f}s clip was reported finished after {waited:.2f}s")
+
+    # Queued clips should each finish in order, back to back
+    queued_futures = [audio_manager.play_audio_queued(mp3_bytes) for _ in range(2)]
+    start = time.perf_counter()
+    queued_futures[0].result(timeout=10)
+    first_done = time.perf_counter() - start
+    audio_manager.queued_audio_finished().result(timeout=10)
+    assert queued_futures[1].done() and first_done < audio_length + 0.25
+    assert finished_callbacks == [playback_future]
+    print("Queued clips finished in order")
+
+    # Stop test: a fade should end the current clip and drop the queued one
+    queued_futures = [audio_manager.play_audio_queued(mp3_bytes) for _ in range(2)]
+    time.sleep(0.3)
+    start = time.perf_counter()
+    audio_manager.stop_audio(fade_ms=100)
+    audio_manager.queued_audio_finished().result(timeout=10)
+    assert queued_futures[0].done() and queued_futures[1].done() and time.perf_counter() - start < 0.5
+    print("Stopping faded out the current clip and dropped the queued one")
+
+    # Chaining test: a callback that plays the next clip and waits for it must not stall the watcher
+    chained_futures = []
+    def play_next(_):
+        chained_futures.append(audio_manager.play_audio_queued(mp3_bytes))
+        audio_manager.play_audio_bytes(mp3_bytes, sleep_during_playback=True)
+    audio_manager.play_audio_queued(mp3_bytes, on_finished=play_next).result(timeout=10)
+    unrelated_future = audio_manager.play_audio_bytes(mp3_bytes, False)
+    unrelated_future.result(timeout=10)
+    audio_manager.queued_audio_finished().result(timeout=10)
+    assert len(chained_futures) == 1 and chained_futures[0].result(timeout=10)
+    print("A callback could start the next clip and wait on it")
+
+    # Callbacks run in the order playback finished, even when an earlier one is slow
+    import wave
+    short_wav = io.BytesIO()
+    with wave.open(short_wav, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(24000)
+        wav_file.writeframes(bytes(2 * 2400))
+    callback_order = []
+    def finished_in_order(index, delay):
+        def on_finished(_):
+            time.sleep(delay)
+            callback_order.append(index)
+        return on_finished
+    for index in range(3):
+        audio_manager.play_audio_queued(short_wav.getvalue(), on_finished=finished_in_order(index, 0.3 if index == 0 else 0))
+    audio_manager.wait_for_queued_audio()
+    time.sleep(0.5)
+    assert callback_order == [0, 1, 2], callback_order
+    print("Callbacks ran in order")
+
+    # Streaming test: the clip arrives in pieces like a download, playback starts long before the last piece is in
+    def download(audio, chunk_size, seconds_per_chunk, stall_after=None, stall_seconds=0):
+        for i in range(0, len(audio), chunk_size):
+            time.sleep(stall_seconds if i == stall_after else seconds_per_chunk)
+            yield audio[i:i + chunk_size]
+    start = time.perf_counter()
+    playback = audio_manager.play_stream(download(mp3_bytes, 2048, 0.05))
+    played_seconds = playback.finished.result(timeout=10)
+    stats = playback.stats()
+    print(f"Streamed {played_seconds:.2f}s of mp3 in {time.perf_counter() - start:.2f}s: {stats}")
+    assert stats["first_audio_ms"] < 500 and stats["underruns"] == 0, stats
+
+    # An underrun fades out, waits for the preroll to build up again and carries on
+    pcm_tone = (np.sin(np.arange(24000) * 2 * np.pi * 220 / 24000) * 8000).astype("<i2").tobytes()
+    playback = audio_manager.play_stream(download(pcm_tone, 8000, 0.01, stall_after=24000, stall_seconds=0.6), audio_format="pcm")
+    played_seconds = playback.finished.result(timeout=10)
+    assert playback.stats()["underruns"] == 1 and abs(played_seconds - 1.0) < 0.01, playback.stats()
+    print(f"Recovered from an underrun: {playback.stats()}")
+
+    # Stopping a stream stops the download too
+    playback = audio_manager.play_stream(download(mp3_bytes, 2048, 0.05))
+    time.sleep(0.4)
+    audio_manager.stop_audio(fade_ms=100)
+    playback.finished.result(timeout=2)
+    assert playback.stream.done.wait(2)
+    print("Stopping ended the stream and its download")
+
     # MP3 Test
     audio_manager.play_audio(MP3_FILEPATH)
     print("Sleeping until next file")
@@ -126,6 +446,18 @@ if __name__ == '__main__':
     print("Sleeping until next file")
     time.sleep(3)
 
+    # In-memory test
+    audio_manager.play_audio_bytes(mp3_bytes)
+    print("Sleeping until next file")
+    time.sleep(3)
+
+    # Queued playback test, the clips should play back to back without a gap
+    for _ in range(3):
+        audio_manager.play_audio_queued(mp3_bytes)
+    audio_manager.wait_for_queued_audio()
+    print("Sleeping until next file")
+    time.sleep(3)
+
     # Async tests
     async def async_audio_test():
         await audio_manager.play_audio_async(MP3_FILEPATH)
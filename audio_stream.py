@@ -0,0 +1,492 @@
+import io
+import time
+import threading
+import numpy as np
+import pygame
+from concurrent.futures import Future
+
+# Layer III frame headers, by MPEG version bits: 3 is MPEG-1, 2 is MPEG-2, 0 is MPEG-2.5
+MP3_BITRATES_KBPS = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    0: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+# A Layer III frame can borrow bits from the frames before it, so every batch is decoded along with this many frames
+# from before it (their samples are thrown away). With 3, the batches come out the same as decoding the whole file in one go.
+MP3_PRIMER_FRAMES = 3
+
+
+def parse_mp3_frame_header(header):
+    """(frame length in bytes, samples per frame, sample rate) of a Layer III frame header, or None if it isn't one"""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x3
+    layer = (header[1] >> 1) & 0x3
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES_KBPS[version][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x1
+    if version == 3:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+
+
+class StreamDecoder:
+    """
+    Turns audio chunks, cut anywhere (straight off the network), into int16 frames in the mixer's format, as they arrive.
+    "mp3": the bytes are cut into whole frames, and once there's batch_ms of them they're decoded with pygame,
+    along with the MP3_PRIMER_FRAMES frames before them. The ID3 tag and the Xing/Info frame are skipped.
+    "pcm": 16 bit little endian samples at sample_rate with channels channels (e.g. ElevenLabs' pcm_24000),
+    which only have to be resampled to the mixer's rate.
+
+    Parameters:
+    audio_format (str): "mp3" or "pcm"
+    sample_rate (int), channels (int): what the pcm samples are, mp3 frames say it themselves
+    mixer_rate (int), mixer_channels (int): what the mixer plays (pygame.mixer.get_init())
+    batch_ms (float): how much mp3 is decoded at a time
+    """
+
+    def __init__(self, audio_format="mp3", sample_rate=24000, channels=1, mixer_rate=48000, mixer_channels=2, batch_ms=60):
+        if audio_format not in ("mp3", "pcm"):
+            raise ValueError(f"Can't stream {audio_format} audio, only mp3 or pcm")
+        self.audio_format = audio_format
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.mixer_rate = mixer_rate
+        self.mixer_channels = mixer_channels
+        self.batch_ms = batch_ms
+        self.pending = bytearray()
+        # mp3: frames waiting to be decoded, and the last few decoded ones (the next batch's primer)
+        self.frames = []
+        self.frames_ms = 0.0
+        self.primer_frames = []
+        self.skipped_tag = False
+        # pcm: where resampling is at, relative to the last sample of the chunk before
+        self.resample_position = 0.0
+        self.last_sample = None
+
+    def decode(self, chunk):
+        """Returns whatever can be decoded so far, as an int16 array of shape (frames, mixer_channels)"""
+        self.pending += chunk
+        if self.audio_format == "pcm":
+            return self._decode_pcm()
+        self._split_frames()
+        if self.frames_ms < self.batch_ms:
+            return self._empty()
+        return self._decode_frames()
+
+    def flush(self):
+        """Decodes whatever is left once the stream is over"""
+        if self.audio_format == "pcm":
+            # Half a sample can't be played
+            self.pending.clear()
+            return self._empty()
+        self._split_frames()
+        return self._decode_frames()
+
+    def _empty(self):
+        return np.zeros((0, self.mixer_channels), dtype=np.int16)
+
+    def _split_frames(self):
+        position = 0
+        pending = self.pending
+        if not self.skipped_tag:
+            if len(pending) < 10:
+                return
+            if pending[:3] == b"ID3":
+                tag_length = 10 + ((pending[6] << 21) | (pending[7] << 14) | (pending[8] << 7) | pending[9])
+                if len(pending) < tag_length:
+                    return
+                position = tag_length
+            self.skipped_tag = True
+        while position + 4 <= len(pending):
+            header = parse_mp3_frame_header(pending[position:position + 4])
+            if header is None:
+                # Not a frame, look for the next one
+                position += 1
+                continue
+            frame_length, frame_samples, sample_rate = header
+            if position + frame_length > len(pending):
+                break
+            frame = bytes(pending[position:position + frame_length])
+            if b"Xing" not in frame[:64] and b"Info" not in frame[:64]:
+                self.frames.append((frame, frame_samples, sample_rate))
+                self.frames_ms += frame_samples * 1000 / sample_rate
+            position += frame_length
+        del pending[:position]
+
+    def _decode_frames(self):
+        if not self.frames:
+            return self._empty()
+        frames = self.primer_frames + self.frames
+        sound = pygame.mixer.Sound(file=io.BytesIO(b"".join(frame for frame, _, _ in frames)))
+        samples = np.frombuffer(sound.get_raw(), dtype=np.int16).reshape(-1, self.mixer_channels)
+        primer_samples = round(sum(frame_samples * self.mixer_rate / sample_rate for _, frame_samples, sample_rate in self.primer_frames))
+        self.primer_frames = frames[-MP3_PRIMER_FRAMES:]
+        self.frames = []
+        self.frames_ms = 0.0
+        return samples[primer_samples:]
+
+    def _decode_pcm(self):
+        whole_bytes = len(self.pending) - len(self.pending) % (2 * self.channels)
+        if not whole_bytes:
+            return self._empty()
+        samples = np.frombuffer(bytes(self.pending[:whole_bytes]), dtype="<i2").reshape(-1, self.channels).astype(np.float32)
+        del self.pending[:whole_bytes]
+        if self.sample_rate != self.mixer_rate:
+            samples = self._resample(samples)
+        if self.channels == 1 and self.mixer_channels > 1:
+            samples = np.repeat(samples, self.mixer_channels, axis=1)
+        elif self.mixer_channels == 1 and self.channels > 1:
+            samples = samples.mean(axis=1, keepdims=True)
+        elif self.channels != self.mixer_channels:
+            samples = samples[:, :self.mixer_channels]
+        return np.clip(np.round(samples), -32768, 32767).astype(np.int16)
+
+    def _resample(self, samples):
+        # Linear interpolation, carried on across chunks so their edges don't show
+        if self.last_sample is not None:
+            samples = np.concatenate([self.last_sample, samples])
+        step = self.sample_rate / self.mixer_rate
+        positions = np.arange(self.resample_position, len(samples) - 1, step)
+        self.last_sample = samples[-1:]
+        if not len(positions):
+            self.resample_position -= len(samples) - 1
+            return np.zeros((0, samples.shape[1]), dtype=np.float32)
+        self.resample_position = positions[-1] + step - (len(samples) - 1)
+        indexes = positions.astype(np.int64)
+        weights = (positions - indexes)[:, None].astype(np.float32)
+        return samples[indexes] * (1 - weights) + samples[indexes + 1] * weights
+
+
+class PcmRingBuffer:
+    """
+    Fixed size ring buffer of int16 frames, for one writer (the download) and one reader (playback).
+    write() waits for room when it's full, so a fast download can't run away with the memory.
+
+    Parameters:
+    capacity_frames (int): how many frames fit
+    channels (int): samples per frame
+    """
+
+    def __init__(self, capacity_frames, channels):
+        self.buffer = np.zeros((capacity_frames, channels), dtype=np.int16)
+        self.capacity = capacity_frames
+        self.condition = threading.Condition()
+        # Frames written and read so far, positions in the buffer are these modulo the capacity
+        self.written = 0
+        self.read_count = 0
+        self.closed = False
+        self.cancelled = False
+
+    def buffered(self):
+        with self.condition:
+            return self.written - self.read_count
+
+    def write(self, frames):
+        offset = 0
+        while offset < len(frames):
+            with self.condition:
+                while self.written - self.read_count >= self.capacity and not self.cancelled:
+                    self.condition.wait()
+                if self.cancelled:
+                    return
+                count = min(len(frames) - offset, self.capacity - (self.written - self.read_count))
+                start = self.written % self.capacity
+                first_part = min(count, self.capacity - start)
+                self.buffer[start:start + first_part] = frames[offset:offset + first_part]
+                self.buffer[:count - first_part] = frames[offset + first_part:offset + count]
+                self.written += count
+                offset += count
+                self.condition.notify_all()
+
+    def read(self, max_frames):
+        """Up to max_frames frames (a copy), whatever is there right now"""
+        with self.condition:
+            count = min(max_frames, self.written - self.read_count)
+            start = self.read_count % self.capacity
+            first_part = min(count, self.capacity - start)
+            frames = np.concatenate([self.buffer[start:start + first_part], self.buffer[:count - first_part]])
+            self.read_count += count
+            self.condition.notify_all()
+            return frames
+
+    def wait_for(self, frames, timeout=None):
+        """Waits until at least frames frames are buffered, or nothing more is coming. Returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.written - self.read_count >= frames or self.closed or self.cancelled, timeout)
+
+    def close(self):
+        """The writer is done"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.closed = True
+            self.condition.notify_all()
+
+
+class AudioStream:
+    """
+    Reads an iterator of audio chunks (e.g. a TTS response as it downloads) on its own thread, decodes them as they come in
+    and keeps the frames in a ring buffer until they're played. Made by AudioManager.open_stream().
+
+    Parameters:
+    chunks (iterable): the audio, in any size pieces
+    decoder (StreamDecoder): turns the pieces into frames the mixer can play
+    buffer_seconds (float): how far ahead of playback the download can get
+    on_done (callable): called without arguments once the chunks run out (or the stream fails or is cancelled)
+    """
+
+    def __init__(self, chunks, decoder, buffer_seconds=30.0, on_done=None):
+        self.chunks = chunks
+        self.decoder = decoder
+        self.frames_per_ms = decoder.mixer_rate / 1000
+        self.ring = PcmRingBuffer(int(decoder.mixer_rate * buffer_seconds), decoder.mixer_channels)
+        self.on_done = on_done
+        self.opened_at = time.perf_counter()
+        self.first_chunk_at = None
+        self.bytes_read = 0
+        self.decode_seconds = 0.0
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def buffered_ms(self):
+        return self.ring.buffered() / self.frames_per_ms
+
+    def wait_for_preroll(self, preroll_ms, timeout=None):
+        """Waits until preroll_ms is buffered, or the whole stream is (if it's shorter). Returns False on timeout."""
+        return self.ring.wait_for(int(preroll_ms * self.frames_per_ms), timeout)
+
+    def cancel(self):
+        """Stops reading, whatever is buffered is dropped"""
+        self.ring.cancel()
+
+    def _read(self):
+        try:
+            for chunk in self.chunks:
+                if self.ring.cancelled:
+                    break
+                if not chunk:
+                    continue
+                if self.first_chunk_at is None:
+                    self.first_chunk_at = time.perf_counter()
+                self.bytes_read += len(chunk)
+                start_time = time.perf_counter()
+                frames = self.decoder.decode(chunk)
+                self.decode_seconds += time.perf_counter() - start_time
+                self.ring.write(frames)
+            else:
+                self.ring.write(self.decoder.flush())
+        except Exception as e:
+            self.error = e
+            print(f"Audio stream failed after {self.bytes_read} bytes: {e}")
+        finally:
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                # Lets a generator close its connection if we stopped early
+                close()
+            self.ring.close()
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+
+class StreamPlayback:
+    """
+    Plays an AudioStream on a channel while it's still coming in. Once preroll_ms is buffered, it's cut into block_ms blocks
+    that are queued on the channel one after another, and the channel starts each one the moment the one before it ends.
+    If the buffer runs dry before the stream is over (an underrun), the last block fades out over fade_ms instead of
+    stopping with a click, playback waits for preroll_ms to build up again, and the next block fades in.
+    How much is buffered ahead of playback is sampled on every block, see stats(). Made by AudioManager.play_stream().
+
+    Parameters:
+    stream (AudioStream): what to play
+    channel (pygame.mixer.Channel): where to play it
+    playback_watcher (PlaybackWatcher): for waiting on the channel
+    preroll_ms (float): how much has to be buffered before playback starts (and starts again after an underrun)
+    block_ms (float): how much is handed to the channel at a time
+    fade_ms (float): fade length around an underrun
+    on_finished (callable): optional callback, called with the finished Future once playback ends
+    """
+
+    def __init__(self, stream, channel, playback_watcher, preroll_ms=150, block_ms=50, fade_ms=5, on_finished=None):
+        self.stream = stream
+        self.channel = channel
+        self.playback_watcher = playback_watcher
+        self.preroll_ms = preroll_ms
+        self.block_frames = max(1, int(block_ms * stream.frames_per_ms))
+        self.fade_frames = max(1, int(fade_ms * stream.frames_per_ms))
+        # Resolves once everything is handed to the channel (or playback was stopped), the next clip can be queued after that
+        self.fed = Future()
+        # Resolves with the seconds played once the channel has really finished playing them
+        self.finished = Future()
+        if on_finished:
+            self.finished.add_done_callback(on_finished)
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.first_audio_at = None
+        self.frames_played = 0
+        self.blocks = 0
+        self.underruns = 0
+        self.rebuffer_seconds = 0.0
+        self.occupancy_samples = 0
+        self.occupancy_total_ms = 0.0
+        self.min_buffered_ms = None
+        self.max_buffered_ms = 0.0
+
+    def start(self):
+        threading.Thread(target=self._feed, daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stops queueing blocks (the channel still has to be faded or stopped, see AudioManager.stop_audio) and the download"""
+        with self.lock:
+            self.stopped = True
+        self.stream.cancel()
+
+    def stats(self):
+        stream = self.stream
+        return {
+            "first_chunk_ms": None if stream.first_chunk_at is None else round((stream.first_chunk_at - stream.opened_at) * 1000),
+            "first_audio_ms": None if self.first_audio_at is None else round((self.first_audio_at - stream.opened_at) * 1000),
+            "played_ms": round(self.frames_played / stream.frames_per_ms),
+            "blocks": self.blocks,
+            "underruns": self.underruns,
+            "rebuffer_ms": round(self.rebuffer_seconds * 1000),
+            "buffered_ms": round(stream.buffered_ms()),
+            "min_buffered_ms": None if self.min_buffered_ms is None else round(self.min_buffered_ms),
+            "avg_buffered_ms": round(self.occupancy_total_ms / self.occupancy_samples) if self.occupancy_samples else None,
+            "max_buffered_ms": round(self.max_buffered_ms),
+            "decode_ms": round(stream.decode_seconds * 1000, 1),
+        }
+
+    def _feed(self):
+        ring = self.stream.ring
+        last_sound = None
+        fade_in = False
+        try:
+            self.stream.wait_for_preroll(self.preroll_ms)
+            while not self.stopped:
+                block = ring.read(self.block_frames)
+                if not len(block):
+                    if ring.closed:
+                        break
+                    # Ran dry right after a block that didn't know it was the last one, wait for more
+                    fade_in = self._rebuffer()
+                    continue
+                buffered_ms = ring.buffered() / self.stream.frames_per_ms
+                self.occupancy_samples += 1
+                self.occupancy_total_ms += buffered_ms
+                self.min_buffered_ms = buffered_ms if self.min_buffered_ms is None else min(self.min_buffered_ms, buffered_ms)
+                self.max_buffered_ms = max(self.max_buffered_ms, buffered_ms)
+
+                underrun = not ring.buffered() and not ring.closed
+                if fade_in or underrun or (ring.closed and not ring.buffered()):
+                    block = self._apply_fades(block, fade_in, fade_out=underrun or ring.closed)
+                fade_in = False
+
+                sound = pygame.mixer.Sound(buffer=block.tobytes())
+                # Waits until the block before is playing, so this one starts right as it ends
+                self.playback_watcher.watch(lambda: self.channel.get_queue() is None).result()
+                with self.lock:
+                    if self.stopped:
+                        break
+                    # If nothing is playing on the channel, queue() starts the block immediately
+                    self.channel.queue(sound)
+                last_sound = sound
+                if self.first_audio_at is None:
+                    self.first_audio_at = time.perf_counter()
+                self.frames_played += len(block)
+                self.blocks += 1
+                if underrun:
+                    fade_in = self._rebuffer()
+        finally:
+            seconds = self.frames_played / self.stream.frames_per_ms / 1000
+            self.fed.set_result(seconds)
+            if last_sound is None:
+                self.finished.set_result(seconds)
+            elif self.stopped:
+                # Done once the fade is over
+                self.playback_watcher.watch(lambda: not self.channel.get_busy(), seconds).add_done_callback(self._set_finished)
+            else:
+                # The last block is done once it's neither playing nor waiting in the queue
+                self.playback_watcher.watch(
+                    lambda: self.channel.get_sound() is not last_sound and self.channel.get_queue() is not last_sound, seconds
+                ).add_done_callback(self._set_finished)
+
+    def _rebuffer(self):
+        """Waits for preroll_ms to build up again after an underrun. Returns True if there's more to play (it fades in)."""
+        self.underruns += 1
+        start_time = time.perf_counter()
+        self.stream.wait_for_preroll(self.preroll_ms)
+        self.rebuffer_seconds += time.perf_counter() - start_time
+        return self.stream.ring.buffered() > 0
+
+    def _apply_fades(self, block, fade_in, fade_out):
+        block = block.astype(np.float32)
+        fade_frames = min(self.fade_frames, len(block))
+        ramp = np.linspace(0.0, 1.0, fade_frames, dtype=np.float32)[:, None]
+        if fade_in:
+            block[:fade_frames] *= ramp
+        if fade_out:
+            block[len(block) - fade_frames:] *= ramp[::-1]
+        return block.astype(np.int16)
+
+    def _set_finished(self, playback_future):
+        try:
+            self.finished.set_result(playback_future.result())
+        except Exception as e:
+            self.finished.set_exception(e)
+
+
+# Tests
+if __name__ == '__main__':
+    import os
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    pygame.mixer.init(frequency=48000, buffer=1024)
+    mixer_rate, _, mixer_channels = pygame.mixer.get_init()
+
+    # Decoding an mp3 as it trickles in gives the same samples as decoding its frames in one go
+    with open("TestAudio_MP3.mp3", "rb") as mp3_file:
+        mp3_bytes = mp3_file.read()
+    whole = StreamDecoder("mp3", mixer_rate=mixer_rate, mixer_channels=mixer_channels)
+    whole.pending += mp3_bytes
+    whole._split_frames()
+    expected = np.frombuffer(pygame.mixer.Sound(file=io.BytesIO(b"".join(frame for frame, _, _ in whole.frames))).get_raw(),
+                             dtype=np.int16).reshape(-1, mixer_channels)
+    for chunk_size in (97, 777, 4096):
+        decoder = StreamDecoder("mp3", mixer_rate=mixer_rate, mixer_channels=mixer_channels)
+        decoded = np.concatenate([decoder.decode(mp3_bytes[i:i + chunk_size]) for i in range(0, len(mp3_bytes), chunk_size)] + [decoder.flush()])
+        assert decoded.shape == expected.shape and np.array_equal(decoded, expected), (chunk_size, decoded.shape, expected.shape)
+    print(f"Decoded {len(mp3_bytes)} bytes of mp3 in pieces, same {len(expected)} frames as in one go")
+
+    # pcm is resampled to the mixer's rate, the same however it's cut up
+    tone = (np.sin(np.arange(24000) * 2 * np.pi * 440 / 24000) * 10000).astype("<i2").tobytes()
+    decoder = StreamDecoder("pcm", 24000, 1, mixer_rate, mixer_channels)
+    decoded = np.concatenate([decoder.decode(tone[i:i + 1001]) for i in range(0, len(tone), 1001)] + [decoder.flush()])
+    expected = np.sin(np.arange(len(decoded)) * 2 * np.pi * 440 / mixer_rate) * 10000
+    assert abs(len(decoded) - mixer_rate) <= 2 and np.abs(decoded[:, 0] - expected).max() < 50, len(decoded)
+    print(f"Resampled 1s of 24 kHz pcm to {len(decoded)} frames")
+
+    # The ring buffer wraps around, and makes the writer wait while it's full
+    ring = PcmRingBuffer(100, 1)
+    samples = np.arange(250, dtype=np.int16).reshape(-1, 1)
+    writer = threading.Thread(target=ring.write, args=(samples,))
+    writer.start()
+    read_back = []
+    while len(read_back) < 250:
+        ring.wait_for(1)
+        read_back.extend(ring.read(30)[:, 0])
+    writer.join()
+    assert read_back == list(range(250))
+    print("Ring buffer kept everything in order")
@@ -1,20 +1,139 @@
 import time
+import wave
+import threading
 import azure.cognitiveservices.speech as speechsdk
 import keyboard
 import os
 
+
+class AzureRecognizer:
+    """
+    Long-lived Azure continuous recognizer. It's built (and its service connection opened) once, then started and
+    stopped for each utterance, so no turn pays for setting up a new recognizer.
+    This is the interface SpeechToTextManager talks to, so it can be swapped for FakeRecognizer in tests.
+    """
+
+    def __init__(self, speech_config, audio_config=None):
+        if audio_config is None:
+            audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
+        self.speech_recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        self.on_recognizing = None
+        self.on_recognized = None
+        self.speech_recognizer.recognizing.connect(lambda evt: self.on_recognizing and self.on_recognizing(evt.result.text))
+        self.speech_recognizer.recognized.connect(lambda evt: self.on_recognized and self.on_recognized(evt.result.text))
+        # Open the connection to the service now, instead of on the first utterance
+        self.connection = speechsdk.Connection.from_recognizer(self.speech_recognizer)
+        self.connection.open(True)
+
+    def set_handlers(self, on_recognizing, on_recognized):
+        """on_recognizing(text) gets partial hypotheses while the user talks, on_recognized(text) gets each final phrase"""
+        self.on_recognizing = on_recognizing
+        self.on_recognized = on_recognized
+
+    def start(self):
+        # Don't wait for the session to actually start, the caller can go on right away
+        self.speech_recognizer.start_continuous_recognition_async()
+
+    def stop(self):
+        # Stopping flushes the final result for whatever the user was in the middle of saying
+        self.speech_recognizer.stop_continuous_recognition()
+
+    def close(self):
+        self.connection.close()
+
+
+class FakeRecognizer:
+    """
+    Offline stand-in for AzureRecognizer. Replays a WAV file in real time (TestAudio_WAV.wav by default),
+    revealing a scripted transcript word by word as partial hypotheses, then as one final phrase.
+
+    Parameters:
+    wav_path (str): the "microphone" audio, only its length is used
+    transcript (str): what the fake recognizer "hears"
+    speed (float): playback speed, 2.0 replays the file twice as fast
+    """
+
+    def __init__(self, wav_path="TestAudio_WAV.wav", transcript="This is a test recording", speed=1.0):
+        with wave.open(wav_path, "rb") as wav_file:
+            self.audio_length = wav_file.getnframes() / wav_file.getframerate()
+        self.transcript_words = transcript.split()
+        self.speed = speed
+        self.on_recognizing = None
+        self.on_recognized = None
+        self.stop_event = threading.Event()
+        self.replay_thread = None
+        self.heard_words = []
+        self.finalized = False
+
+    def set_handlers(self, on_recognizing, on_recognized):
+        self.on_recognizing = on_recognizing
+        self.on_recognized = on_recognized
+
+    def start(self):
+        self.stop_event.clear()
+        self.heard_words = []
+        self.finalized = False
+        self.replay_thread = threading.Thread(target=self._replay, daemon=True)
+        self.replay_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.replay_thread.join()
+        self._finalize()
+
+    def close(self):
+        pass
+
+    def _replay(self):
+        step = 0.1
+        elapsed = 0
+        while elapsed < self.audio_length:
+            if self.stop_event.wait(step / self.speed):
+                return
+            elapsed += step
+            # Words come in evenly over the file
+            word_count = min(len(self.transcript_words), int(len(self.transcript_words) * elapsed / self.audio_length) + 1)
+            if word_count > len(self.heard_words):
+                self.heard_words = self.transcript_words[:word_count]
+                if self.on_recognizing:
+                    self.on_recognizing(" ".join(self.heard_words))
+        # The file is over, which is a pause long enough for the phrase to be final
+        self._finalize()
+
+    def _finalize(self):
+        if self.finalized or not self.heard_words:
+            return
+        self.finalized = True
+        if self.on_recognized:
+            self.on_recognized(" ".join(self.heard_words))
+
+
 class SpeechToTextManager:
     azure_speechconfig = None
     azure_audioconfig = None
     azure_speechrecognizer = None
-    should_stop = False
+    mic_recognizer = None
+
+    def __init__(self, recognizer=None):
+        """
+        recognizer: optional pre-built recognizer (e.g. FakeRecognizer for tests).
+        By default an AzureRecognizer on the default mic is created on first use and then kept warm.
+        """
+        self.mic_recognizer = recognizer
+        self.stop_event = threading.Event()
+        self.session_lock = threading.Lock()
+        self.utterance_results = []
+        self.barge_in_callback = None
+        self.partial_callback = None
 
-    def __init__(self):
         # Creates an instance of a speech config with specified subscription key and service region.
         # Replace with your own subscription key and service region (e.g., "westus").
         try:
             self.azure_speechconfig = speechsdk.SpeechConfig(subscription=os.getenv('AZURE_TTS_KEY'), region=os.getenv('AZURE_TTS_REGION'))
-        except TypeError:
+        except (TypeError, ValueError):
+            if recognizer is not None:
+                # Fine when testing with a fake recognizer, only the Azure-backed functions need the key
+                return
             exit("Ooops! You forgot to set AZURE_TTS_KEY or AZURE_TTS_REGION in your environment!")
         
         self.azure_speechconfig.speech_recognition_language="en-US"
@@ -67,11 +186,10 @@ class SpeechToTextManager:
         self.azure_audioconfig = speechsdk.audio.AudioConfig(filename=filename)
         self.azure_speechrecognizer = speechsdk.SpeechRecognizer(speech_config=self.azure_speechconfig, audio_config=self.azure_audioconfig)
 
-        done = False
+        done = threading.Event()
         def stop_cb(evt):
             print('CLOSING on {}'.format(evt))
-            nonlocal done
-            done = True
+            done.set()
 
         # These are optional event callbacks that just print out when an event happens.
         # Recognized is useful as an update when a full chunk of speech has finished processing
@@ -81,7 +199,7 @@ class SpeechToTextManager:
         self.azure_speechrecognizer.session_stopped.connect(lambda evt: print('SESSION STOPPED {}'.format(evt)))
         self.azure_speechrecognizer.canceled.connect(lambda evt: print('CANCELED {}'.format(evt)))
 
-        # These functions will stop the program by flipping the "done" boolean when the session is either stopped or canceled
+        # These functions will stop the program by setting the "done" event when the session is either stopped or canceled
         self.azure_speechrecognizer.session_stopped.connect(stop_cb)
         self.azure_speechrecognizer.canceled.connect(stop_cb)
 
@@ -96,8 +214,7 @@ class SpeechToTextManager:
         self.azure_speechrecognizer.start_continuous_recognition()
         
         # We wait until stop_cb() has been called above, because session either stopped or canceled
-        while not done:
-            time.sleep(.5)
+        done.wait()
 
         # Now that we're done, tell the recognizer to end session
         # NOTE: THIS NEEDS TO BE OUTSIDE OF THE stop_cb FUNCTION. If it's inside that function the program just freezes. Not sure why.
@@ -107,32 +224,100 @@ class SpeechToTextManager:
         print(f"\n\nHeres the result we got from contiuous file read!\n\n{final_result}\n\n")
         return final_result
 
-    def speechtotext_from_mic_continuous(self):
-        self.should_stop = False
-        self.azure_speechrecognizer = speechsdk.SpeechRecognizer(speech_config=self.azure_speechconfig)
-        result_text = ""
-
-        def handle_result(evt):
-            nonlocal result_text
-            result_text += evt.result.text + " "
+    def start_session(self):
+        """Builds the mic recognizer (and opens its connection) if that hasn't happened yet. Call it early to warm up."""
+        if self.mic_recognizer is None:
+            self.mic_recognizer = AzureRecognizer(self.azure_speechconfig)
+        self.mic_recognizer.set_handlers(self._handle_partial, self._handle_result)
 
-        self.azure_speechrecognizer.recognized.connect(handle_result)
+    def speechtotext_from_mic_continuous(self, on_partial=None):
+        """
+        Listens until stop_recording() is called, then returns everything that was said.
+        on_partial(text): optional callback that gets the whole transcript so far every time the recognizer updates it
+        """
+        self.start_session()
+        self.stop_event.clear()
+        self.partial_callback = on_partial
+        with self.session_lock:
+            if self.barge_in_callback is not None:
+                # The user is already talking over the assistant, so this utterance keeps that session (and what it heard)
+                self.barge_in_callback = None
+            else:
+                self.utterance_results = []
+                self.mic_recognizer.start()
 
-        self.azure_speechrecognizer.start_continuous_recognition()
-        
-        # Wait until stop is requested
-        while not self.should_stop:
-            time.sleep(0.1)
+        # Wait until stop is requested, stop_recording() wakes us up immediately
+        self.stop_event.wait()
 
-        self.azure_speechrecognizer.stop_continuous_recognition()
-        return result_text.strip()
+        self.mic_recognizer.stop()
+        self.partial_callback = None
+        return " ".join(self.utterance_results).strip()
 
     def stop_recording(self):
-        self.should_stop = True
+        self.stop_event.set()
+
+    def start_barge_in_listener(self, on_speech_detected):
+        """
+        Listens to the mic in the background while the assistant is talking, using the same warm recognizer.
+        on_speech_detected(text) is called as soon as the recognizer hears the user start speaking (first partial hypothesis),
+        so playback can be cut off right away instead of waiting for the user to finish their sentence.
+        """
+        self.start_session()
+        with self.session_lock:
+            self.utterance_results = []
+            self.barge_in_callback = on_speech_detected
+            self.mic_recognizer.start()
+
+    def stop_barge_in_listener(self):
+        """Stops the background listener. Returns whatever the user said over the assistant, so it can start the next question."""
+        with self.session_lock:
+            if self.barge_in_callback is None:
+                return ""
+            self.mic_recognizer.stop()
+            self.barge_in_callback = None
+        return " ".join(self.utterance_results).strip()
+
+    def close(self):
+        if self.mic_recognizer is not None:
+            self.mic_recognizer.close()
+
+    def _handle_partial(self, text):
+        if not text:
+            return
+        if self.barge_in_callback is not None:
+            self.barge_in_callback(text)
+        elif self.partial_callback is not None:
+            self.partial_callback(" ".join(self.utterance_results + [text]))
+
+    def _handle_result(self, text):
+        if text:
+            self.utterance_results.append(text)
+            if self.partial_callback is not None:
+                self.partial_callback(" ".join(self.utterance_results))
 
 
 # Tests
 if __name__ == '__main__':
+    import sys
+
+    # Run with --fake to test offline, replaying TestAudio_WAV.wav instead of using the mic and Azure
+    if "--fake" in sys.argv:
+        speechtotext_manager = SpeechToTextManager(FakeRecognizer())
+
+        for utterance in range(2):
+            threading.Timer(2, speechtotext_manager.stop_recording).start()
+            result = speechtotext_manager.speechtotext_from_mic_continuous()
+            print(f"Utterance {utterance + 1}: {result}")
+            assert result and result in "This is a test recording"
+
+        # Stopping should return straight away, not after a poll interval
+        threading.Timer(0.5, speechtotext_manager.stop_recording).start()
+        start = time.perf_counter()
+        speechtotext_manager.speechtotext_from_mic_continuous()
+        stop_latency = time.perf_counter() - start - 0.5
+        print(f"Returned {stop_latency * 1000:.1f} ms after stop was requested")
+        assert stop_latency < 0.05
+        exit()
 
     TEST_FILE = "D:\Video Editing\Misc - Ai teaches me to pass History Exam\Audio\Misc - Ai teaches me to pass History Exam - VO 1.wav"
     
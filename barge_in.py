@@ -0,0 +1,69 @@
+import threading
+from rich import print
+
+
+class BargeInController:
+    """
+    Lets the user interrupt the assistant by simply talking over it.
+    While a turn is running, the mic is listened to in the background. The moment speech is detected, the playback
+    fades out, any sentences still waiting for TTS are dropped, and the GPT stream for the turn is cancelled.
+
+    Usage for one turn:
+        cancel_event = barge_in.start_turn(tts_pipeline)
+        ... stream GPT with cancel_event, feed tts_pipeline ...
+        heard_text = barge_in.end_turn()
+
+    This works best with headphones, otherwise the recognizer can hear the assistant's own voice and cut it off.
+
+    Parameters:
+    speech_to_text: SpeechToTextManager (or anything with start_barge_in_listener / stop_barge_in_listener)
+    fade_ms (int): how long the assistant's voice takes to fade out once interrupted
+    """
+
+    def __init__(self, speech_to_text, fade_ms=150):
+        self.speech_to_text = speech_to_text
+        self.fade_ms = fade_ms
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.tts_pipeline = None
+        self.turn_active = False
+        self.listening = False
+        self.interrupted = False
+
+    def start_turn(self, tts_pipeline=None, listen=True):
+        """Starts watching for barge-in. Returns the turn's cancel event, to be passed to OpenAiManager.chat_with_history_streamed"""
+        with self.lock:
+            self.cancel_event = threading.Event()
+            self.tts_pipeline = tts_pipeline
+            self.turn_active = True
+            self.interrupted = False
+        if listen:
+            self.speech_to_text.start_barge_in_listener(self._on_speech_detected)
+            self.listening = True
+        return self.cancel_event
+
+    def interrupt(self):
+        """Cuts the current turn off right now. Safe to call from any thread, and more than once."""
+        with self.lock:
+            if not self.turn_active or self.cancel_event.is_set():
+                return
+            self.interrupted = True
+            self.cancel_event.set()
+            tts_pipeline = self.tts_pipeline
+        print("[yellow]✋ Barge-in! Stopping the current answer")
+        if tts_pipeline is not None:
+            tts_pipeline.cancel(self.fade_ms)
+
+    def end_turn(self):
+        """Stops listening. Returns what the user said while interrupting (empty if they didn't), so it can start the next turn."""
+        heard_text = ""
+        if self.listening:
+            heard_text = self.speech_to_text.stop_barge_in_listener()
+            self.listening = False
+        with self.lock:
+            self.tts_pipeline = None
+            self.turn_active = False
+        return heard_text if self.interrupted else ""
+
+    def _on_speech_detected(self, partial_text):
+        self.interrupt()
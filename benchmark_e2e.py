@@ -0,0 +1,306 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Nothing here talks to a real service, but the app modules still want their settings to exist when they're imported
+os.environ.setdefault("ELEVENLABS_API_KEY", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.pop("ASSISTANT_WORKSPACE", None)
+
+from rich import print
+from openai_chat import OpenAiManager
+from eleven_labs import ElevenLabsManager
+from audio_player import AudioManager
+from audio_stream import parse_mp3_frame_header
+from azure_speech_to_text import SpeechToTextManager, FakeRecognizer
+from vscode_api_handler import VSCodeAPIHandler
+from local_ws_server import LocalWebSocketServer
+from tts_cache import TTSAudioCache
+from latency_tracer import LatencyTracer, format_summary
+from turn_orchestrator import TurnOrchestrator
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def mp3_clip(mp3_bytes, max_seconds):
+    """
+    The first max_seconds of an MP3, cut on a frame boundary. The Xing/Info frame is left out, its frame count would be wrong
+    for the shorter clip. Returns the bytes unchanged if they aren't Layer III frames.
+    """
+    position = 0
+    if mp3_bytes[:3] == b"ID3":
+        position = 10 + ((mp3_bytes[6] << 21) | (mp3_bytes[7] << 14) | (mp3_bytes[8] << 7) | mp3_bytes[9])
+    frames = []
+    seconds = 0.0
+    while position + 4 <= len(mp3_bytes) and seconds < max_seconds:
+        frame_header = parse_mp3_frame_header(mp3_bytes[position:position + 4])
+        if frame_header is None:
+            return mp3_bytes
+        frame_length, samples_per_frame, sample_rate = frame_header
+        frame = mp3_bytes[position:position + frame_length]
+        if b"Xing" not in frame[:64] and b"Info" not in frame[:64]:
+            frames.append(frame)
+            seconds += samples_per_frame / sample_rate
+        position += frame_length
+    return b"".join(frames)
+
+
+class FakeChatCompletionServer:
+    """
+    Local stand-in for OpenAI's chat completions endpoint, streamed or not. The OpenAI client is pointed at it with OPENAI_BASE_URL.
+    script(messages) gives the answer, which is streamed a word at a time: the first word after first_token_ms, then one every ms_per_chunk.
+
+    Parameters:
+    script (callable): script(messages) -> answer text
+    first_token_ms (float): how long the "model" thinks before the first token
+    ms_per_chunk (float): time between streamed chunks
+    """
+
+    def __init__(self, script, first_token_ms=300, ms_per_chunk=15):
+        self.script = script
+        self.first_token_ms = first_token_ms
+        self.ms_per_chunk = ms_per_chunk
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.http_server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.http_server.server_address[1]}/v1"
+
+    def start(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fake_server.lock:
+                    fake_server.requests += 1
+                fake_server._answer(self, request)
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def _answer(self, handler, request):
+        answer = self.script(request["messages"])
+        created = int(time.time())
+        time.sleep(self.first_token_ms / 1000)
+        if not request.get("stream"):
+            body = json.dumps({
+                "id": "benchmark", "object": "chat.completion", "created": created, "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.end_headers()
+        for index, piece in enumerate(re.findall(r"\s*\S+|\s+$", answer)):
+            if index:
+                time.sleep(self.ms_per_chunk / 1000)
+            chunk = {"id": "benchmark", "object": "chat.completion.chunk", "created": created, "model": request["model"],
+                     "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]}
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+
+class FakeSpeechSynthesizer:
+    """
+    Stand-in for the ElevenLabs API, for ElevenLabsManager(synthesizer=...). Takes as long as a TTS request
+    (base_ms plus ms_per_char for the text), then returns the first clip_seconds of TestAudio_MP3.mp3.
+    """
+
+    def __init__(self, mp3_path="TestAudio_MP3.mp3", base_ms=150, ms_per_char=1.0, clip_seconds=0.3):
+        with open(mp3_path, "rb") as file:
+            self.audio = mp3_clip(file.read(), clip_seconds)
+        self.base_ms = base_ms
+        self.ms_per_char = ms_per_char
+        self.calls = 0
+
+    def __call__(self, input_text, voice, model):
+        self.calls += 1
+        time.sleep((self.base_ms + self.ms_per_char * len(input_text)) / 1000)
+        return self.audio
+
+
+class FakeEditorPeer:
+    """
+    In-process WebSocket peer that plays server.js and the VS Code extension: sends an open file when Python says hello
+    (or asks for a resync), and acks every command after ack_ms.
+    """
+
+    def __init__(self, ack_ms=5, document_lines=300):
+        self.ack_ms = ack_ms
+        self.document = "\n".join(f"def function_{i}(value):\n    return value * {i}\n" for i in range(document_lines // 3))
+        self.commands = 0
+        self.server = LocalWebSocketServer(on_message=self._on_message)
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def _on_message(self, server, client, text):
+        message = json.loads(text)
+        if message.get("type") in ("hello", "resync"):
+            server.send(client, json.dumps({"type": "document", "uri": "file:///project/app.py", "languageId": "python",
+                                            "version": 1, "text": self.document, "cursorLine": 40}))
+        if "command" not in message:
+            return
+        self.commands += 1
+        ack = json.dumps({"type": "ack", "id": message["id"], "ok": True, "applyMs": 2, "error": None})
+        threading.Timer(self.ack_ms / 1000, server.send, (client, ack)).start()
+
+
+def scripted_answer(messages):
+    """What the fake model says: an explanation for spoken questions, an edit for typed ones. Every answer is new, so the TTS cache never hits."""
+    prompt = messages[-1]["content"]
+    turn_number = sum(1 for message in messages if message["role"] == "user")
+    if messages[0]["role"] == "system" and messages[0]["content"].startswith("You keep a running summary"):
+        return f"The developer asked {turn_number} questions about app.py."
+    if prompt.startswith("Rename"):
+        return (f"EDIT ROW: {40 + turn_number}\nHere's the rename for turn {turn_number}.\n```python\ntotal_{turn_number} = 0\n```\n"
+                f"That's the only line that changes in turn {turn_number}.")
+    return (f"Sure, this is answer number {turn_number}. The function at the cursor multiplies the value it gets. "
+            f"It returns the result straight away, so it's cheap to call. Nothing else in turn {turn_number} depends on it.")
+
+
+def run_benchmark(voice_turns=5, edit_turns=5, first_token_ms=300, ms_per_chunk=15, tts_base_ms=150, ack_ms=5):
+    """Runs warm-up, voice and typed edit turns through the real managers and the fake backends. Returns (metrics, tracer)."""
+    chat_server = FakeChatCompletionServer(scripted_answer, first_token_ms, ms_per_chunk).start()
+    os.environ["OPENAI_BASE_URL"] = chat_server.url
+    editor_peer = FakeEditorPeer(ack_ms).start()
+    cache_dir = tempfile.mkdtemp()
+    vscode_api = VSCodeAPIHandler(editor_peer.server.url)
+    openai_manager = OpenAiManager(vscode_api=vscode_api)
+    openai_manager.chat_history.append({"role": "system", "content": "You are a coding assistant in VS Code."})
+    recognizer = FakeRecognizer(speed=4.0)
+    speech_to_text = SpeechToTextManager(recognizer)
+    elevenlabs_manager = ElevenLabsManager(TTSAudioCache(cache_dir), FakeSpeechSynthesizer(base_ms=tts_base_ms))
+    orchestrator = TurnOrchestrator(openai_manager, speech_to_text, elevenlabs_manager, AudioManager(),
+                                    barge_in=False, auto_stop=False)
+
+    def stop_when_done_talking(event):
+        # The user "presses P" right when the recording is over
+        if event["type"] == "listening":
+            threading.Timer(recognizer.audio_length / recognizer.speed + 0.05, orchestrator.stop_listening).start()
+
+    orchestrator.subscribe(stop_when_done_talking)
+    try:
+        assert vscode_api.connection.wait_until_connected(5), "the fake editor peer didn't connect"
+        # Warm-up: first connection to the chat server, tokenizer, mixer
+        orchestrator.submit_text_turn("Warm up").result(timeout=60)
+        orchestrator.tracer = LatencyTracer()
+        statuses = []
+        start = time.perf_counter()
+        for _ in range(voice_turns):
+            statuses.append(orchestrator.submit_voice_turn().result(timeout=60)["status"])
+        for i in range(edit_turns):
+            statuses.append(orchestrator.submit_text_turn(f"Rename the total variable, take {i}").result(timeout=60)["status"])
+        orchestrator.wait_until_idle(10)
+        wall_seconds = time.perf_counter() - start
+        # Acks for the last edit may land after its turn is done
+        deadline = time.perf_counter() + 5
+        while orchestrator.tracer.summary().get("command_to_editor_ack", {}).get("count", 0) < edit_turns and time.perf_counter() < deadline:
+            time.sleep(0.01)
+    finally:
+        orchestrator.shutdown()
+        vscode_api.close()
+        editor_peer.stop()
+        chat_server.stop()
+
+    assert statuses.count("done") == len(statuses), statuses
+    spans = orchestrator.tracer.summary()
+    metrics = {"turns_per_minute": len(statuses) / wall_seconds * 60}
+    for span in ("turn", "prompt_to_first_audio", "transcript_to_first_token", "first_token_to_first_audio",
+                 "stop_to_transcript", "tts_sentence", "command_to_editor_ack"):
+        metrics[f"{span}_p50_ms"] = spans[span]["p50_ms"]
+        metrics[f"{span}_p95_ms"] = spans[span]["p95_ms"]
+    return metrics, orchestrator.tracer
+
+
+def compare_to_baseline(metrics, baseline, tolerance=0.25, slack_ms=25):
+    """
+    Returns (rows, regressions). A latency regresses if it's more than tolerance (and slack_ms) above the baseline,
+    turns_per_minute if it's more than tolerance below it.
+    """
+    rows, regressions = [], []
+    for name, value in metrics.items():
+        expected = baseline.get(name)
+        if expected is None:
+            rows.append((name, None, value, "new"))
+            continue
+        if name.endswith("_ms"):
+            regressed = value > expected * (1 + tolerance) + slack_ms
+        else:
+            regressed = value < expected * (1 - tolerance)
+        rows.append((name, expected, value, "REGRESSED" if regressed else "ok"))
+        if regressed:
+            regressions.append(name)
+    return rows, regressions
+
+
+# Offline end-to-end benchmark: python benchmark_e2e.py  (fails with exit code 1 on a regression)
+# After a change that's meant to make things faster (or slower, on purpose): python benchmark_e2e.py --update-baseline
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Full turns through the app with local stand-ins for OpenAI, ElevenLabs, Azure and VS Code")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown before it counts as a regression")
+    parser.add_argument("--turns", type=int, default=5, help="voice turns and typed edit turns to run (each)")
+    parser.add_argument("--export", help="also write the latency trace to this JSON file")
+    parser.add_argument("--first-token-ms", type=float, default=300, help="fake model's time to first token")
+    parser.add_argument("--tts-ms", type=float, default=150, help="fake TTS request time, before the per character part")
+    args = parser.parse_args()
+
+    metrics, tracer = run_benchmark(voice_turns=args.turns, edit_turns=args.turns, first_token_ms=args.first_token_ms, tts_base_ms=args.tts_ms)
+    print(format_summary(tracer.summary()))
+    if args.export:
+        tracer.export(args.export)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as file:
+            json.dump({name: round(value, 1) for name, value in metrics.items()}, file, indent=2)
+        print(f"[green]Baseline written to {args.baseline}")
+        sys.exit(0)
+
+    try:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            baseline = json.load(file)
+    except OSError:
+        sys.exit(f"No baseline at {args.baseline} yet, make one with --update-baseline")
+    rows, regressions = compare_to_baseline(metrics, baseline, args.tolerance)
+    for name, expected, value, status in rows:
+        color = "red" if status == "REGRESSED" else "green"
+        expected_text = "-" if expected is None else f"{expected:.1f}"
+        print(f"[{color}]{name:<36} baseline {expected_text:>8}   now {value:>8.1f}   {status}")
+    if regressions:
+        print(f"[red]{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+    print("[green]No regressions")
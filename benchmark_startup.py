@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+# How long the window may wait, in ms. Every number is the median of a few fresh processes. An import includes
+# everything the module pulls in, but not the interpreter starting up.
+IMPORT_BUDGET_MS = {
+    "chat_interface": 150,  # all the window needs before it can show up
+    "eleven_labs": 50,
+    "token_budget": 20,
+}
+WINDOW_BUDGET_MS = 600  # importing chat_interface to the window being drawn (only measured with a display)
+READY_BUDGET_MS = 2000  # importing chat_interface to every service built and the orchestrator running
+
+# The rest are reported, they're loaded in the background
+REPORTED_MODULES = ("openai_chat", "azure_speech_to_text", "audio_player", "turn_orchestrator")
+
+
+def offline_service_tasks(voice_list_path):
+    """chat_interface.SERVICE_TASKS, with the fake recognizer from the tests and a saved voice list, so nothing needs a real service"""
+    import chat_interface
+
+    def build_speech_to_text():
+        from azure_speech_to_text import SpeechToTextManager, FakeRecognizer
+        speech_to_text = SpeechToTextManager(FakeRecognizer())
+        speech_to_text.start_session()
+        return speech_to_text
+
+    def build_elevenlabs_manager():
+        from eleven_labs import ElevenLabsManager
+        return ElevenLabsManager(voice_list_path=voice_list_path)
+
+    return dict(chat_interface.SERVICE_TASKS, speech_to_text=build_speech_to_text, elevenlabs_manager=build_elevenlabs_manager)
+
+
+def save_voice_list(voice_list_path):
+    with open(voice_list_path, "w", encoding="utf-8") as file:
+        json.dump({"fetched_at": time.time(), "voices": [
+            {"voice_id": "TX3LPaxmHKxFdv7VOQHJ", "name": "Liam", "category": "premade", "settings": {"stability": 0.5, "similarity_boost": 0.75}},
+        ]}, file)
+
+
+def measure_import(module):
+    start = time.perf_counter()
+    __import__(module)
+    return {"import_ms": (time.perf_counter() - start) * 1000}
+
+
+def measure_startup(sequential, voice_list_path):
+    """From importing chat_interface to the window (if there's a display) and to every service being ready"""
+    process_start = time.perf_counter()
+    import chat_interface
+    from service_startup import ServiceStartup
+    result = {"import_ms": (time.perf_counter() - process_start) * 1000}
+    tasks = offline_service_tasks(voice_list_path)
+
+    if sequential:
+        # What chat_interface did before: every manager built one after another, before the window
+        task_ms = {}
+        services = {}
+        for name, task in tasks.items():
+            start = time.perf_counter()
+            services[name] = task()
+            task_ms[name] = round((time.perf_counter() - start) * 1000)
+        orchestrator = chat_interface.build_orchestrator(services)
+        result.update(ready_ms=(time.perf_counter() - process_start) * 1000, task_ms=task_ms)
+    elif os.environ.get("DISPLAY") or sys.platform in ("win32", "darwin"):
+        app = chat_interface.ModernChatInterface(service_tasks=tasks)
+        app.root.update()
+        result["window_ms"] = (time.perf_counter() - process_start) * 1000
+        deadline = time.perf_counter() + 30
+        while app.orchestrator is None and app.startup.error is None and time.perf_counter() < deadline:
+            app.root.update()
+            time.sleep(0.005)
+        if app.startup.error is not None:
+            raise app.startup.error
+        result.update(ready_ms=(time.perf_counter() - process_start) * 1000, task_ms=app.startup.stats()["task_ms"])
+        orchestrator = app.orchestrator
+    else:
+        # No display, so no window: the same startup without it
+        startup = ServiceStartup(tasks).start()
+        orchestrator = chat_interface.build_orchestrator(startup.wait(timeout=30))
+        result.update(ready_ms=(time.perf_counter() - process_start) * 1000, task_ms=startup.stats()["task_ms"])
+    orchestrator.shutdown()
+    return result
+
+
+def run_child(*args):
+    """Runs one measurement in a fresh interpreter, so nothing is imported yet"""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", *args],
+                            capture_output=True, text=True, timeout=120, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def median_of(runs, key):
+    values = [run[key] for run in runs if key in run]
+    return statistics.median(values) if values else None
+
+
+# Import-time and startup-time benchmark: python benchmark_startup.py  (fails with exit code 1 if anything is over budget)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="How long the app takes to import its modules, show the window and build its services")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement, the median counts")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Nothing here talks to a real service, but the managers still want their settings to exist
+    os.environ.setdefault("ELEVENLABS_API_KEY", "benchmark")
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    os.environ.pop("ASSISTANT_WORKSPACE", None)
+
+    if args.child:
+        if args.child[0] == "import":
+            result = measure_import(args.child[1])
+        else:
+            result = measure_startup(args.child[0] == "sequential", args.child[1])
+        # Managers print while they start, the result is the last line
+        print(json.dumps(result))
+        sys.exit(0)
+
+    from rich import print
+    over_budget = []
+    print(f"[bold]Import times, median of {args.runs} fresh processes:")
+    for module in list(IMPORT_BUDGET_MS) + list(REPORTED_MODULES):
+        import_ms = median_of([run_child("import", module) for _ in range(args.runs)], "import_ms")
+        budget = IMPORT_BUDGET_MS.get(module)
+        if budget is None:
+            print(f"  {module:<22} {import_ms:>7.0f} ms   (loaded in the background)")
+        else:
+            within = import_ms <= budget
+            print(f"  [{'green' if within else 'red'}]{module:<22} {import_ms:>7.0f} ms   budget {budget} ms")
+            if not within:
+                over_budget.append(f"import {module}")
+
+    voice_list_path = os.path.join(tempfile.mkdtemp(), "elevenlabs_voices.json")
+    save_voice_list(voice_list_path)
+    startup_runs = [run_child("concurrent", voice_list_path) for _ in range(args.runs)]
+    sequential_runs = [run_child("sequential", voice_list_path) for _ in range(args.runs)]
+
+    print(f"[bold]Startup, median of {args.runs} fresh processes:")
+    window_ms = median_of(startup_runs, "window_ms")
+    if window_ms is None:
+        print("  window                    -      (no display, not measured)")
+    else:
+        within = window_ms <= WINDOW_BUDGET_MS
+        print(f"  [{'green' if within else 'red'}]window              {window_ms:>7.0f} ms   budget {WINDOW_BUDGET_MS} ms")
+        if not within:
+            over_budget.append("window")
+    ready_ms = median_of(startup_runs, "ready_ms")
+    within = ready_ms <= READY_BUDGET_MS
+    print(f"  [{'green' if within else 'red'}]services ready      {ready_ms:>7.0f} ms   budget {READY_BUDGET_MS} ms")
+    if not within:
+        over_budget.append("services ready")
+    print(f"  one after another   {median_of(sequential_runs, 'ready_ms'):>7.0f} ms   (how it used to start, before the window)")
+    print(f"  per service (concurrent): {startup_runs[len(startup_runs) // 2]['task_ms']}")
+    print(f"  per service (one after another): {sequential_runs[len(sequential_runs) // 2]['task_ms']}")
+
+    if over_budget:
+        print(f"[red]Over budget: {', '.join(over_budget)}")
+        sys.exit(1)
+    print("[green]Everything within budget")
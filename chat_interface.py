@@ -1,11 +1,16 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
-import threading
-from openai_chat import OpenAiManager
-from azure_speech_to_text import SpeechToTextManager
-from eleven_labs import ElevenLabsManager
-from audio_player import AudioManager
-import time
+from ui_update_queue import UiUpdateQueue
+from service_startup import ServiceStartup
+# The service managers (and openai, the speech SDK, pygame and elevenlabs with them) are imported by the startup tasks
+# below, in the background, so the window doesn't wait for them
+
+BARGE_IN = True # Start talking while the assistant is speaking to interrupt it (use headphones, or it may hear itself)
+SPECULATIVE_PREFETCH = False # Start asking GPT while you're still talking, once your words stop changing (costs some wasted tokens)
+AUTO_STOP = True # Stop recording by itself once you stop talking, instead of waiting for the Stop Recording button
+STREAMED_SPEECH = True # Start playing each sentence as soon as its first audio arrives, instead of once it's all synthesized
+RESPONSE_CACHE = False # Answer a repeated question about the same code from a local cache instead of asking GPT again (answers that edit code are never cached)
+LATENCY_TRACE_FILE = "latency_trace.json" # Per-stage latencies, written on close. Print a summary with: python latency_tracer.py latency_trace.json
 
 SYSTEM_PROMPT = {"role": "system", "content": '''
 You are an advanced AI-powered coding assistant, designed to **help developers write, edit, and manage code** within a VS Code environment using voice commands. Your primary goal is to assist in coding, debugging, optimizing, and explaining programming concepts while ensuring clarity, accuracy, and efficiency.
@@ -56,16 +61,26 @@ EDIT ROW:
 I'll modify the current line to fix the syntax error.
 [code follows]
 
+For changes to several lines (they are applied together, as one undo step):
+EDIT ROW: 12
+I'll rename the variable on line 12.
+[code follows]
+DELETE ROW: 15
+And remove the unused import on line 15.
+
 ❌ INCORRECT FORMAT EXAMPLES:
 - "Let me delete that line for you..."
 - "### Command: Delete row"
 - "I will remove the selected line"
 - "DELETE LINE: Let me help"
-- Any command with extra text on the same line
+- Any command with extra text on the same line (other than a line number)
 
 Remember:
 - For DELETE ROW: No code should follow, only explanation
 - Commands must be EXACT and on their own line
+- A command may end with a line number (e.g. DELETE ROW: 15), without one it applies at the cursor
+- Line numbers always refer to the file as it was before any of your changes
+- The part of the open file around the cursor is sent to you with every message, as 'line number: code' lines. Use those line numbers
 - Always explain what you're doing after the command
                         
 ---
@@ -86,8 +101,53 @@ Remember:
 
 Alright, let's get started! 🎯💻'''}
 
+
+# The startup tasks, each builds one service on its own thread (see ServiceStartup)
+def build_openai_manager():
+    from openai_chat import OpenAiManager
+    from response_cache import ResponseCache
+    openai_manager = OpenAiManager(response_cache=ResponseCache() if RESPONSE_CACHE else None)
+    # Initialize chat with system prompt
+    openai_manager.chat_history.append(SYSTEM_PROMPT)
+    return openai_manager
+
+def build_speech_to_text():
+    from azure_speech_to_text import SpeechToTextManager
+    speech_to_text = SpeechToTextManager()
+    try:
+        # Opens the connection to Azure now, instead of on the first recording
+        speech_to_text.start_session()
+    except Exception as e:
+        print(f"Couldn't warm up the speech recognizer, it'll try again on the first recording: {e}")
+    return speech_to_text
+
+def build_elevenlabs_manager():
+    from eleven_labs import ElevenLabsManager
+    return ElevenLabsManager()
+
+def build_audio_manager():
+    from audio_player import AudioManager
+    return AudioManager()
+
+SERVICE_TASKS = {
+    "openai_manager": build_openai_manager,
+    "speech_to_text": build_speech_to_text,
+    "elevenlabs_manager": build_elevenlabs_manager,
+    "audio_manager": build_audio_manager,
+}
+
+def build_orchestrator(services):
+    """Runs every message (typed or spoken) through STT, GPT, TTS, playback and the editor, one turn at a time"""
+    from turn_orchestrator import TurnOrchestrator
+    return TurnOrchestrator(
+        services["openai_manager"], services["speech_to_text"], services["elevenlabs_manager"], services["audio_manager"], "Liam",
+        barge_in=BARGE_IN, speculative_prefetch=SPECULATIVE_PREFETCH, auto_stop=AUTO_STOP, streamed_speech=STREAMED_SPEECH
+    )
+
+
 class ModernChatInterface:
-    def __init__(self):
+    def __init__(self, service_tasks=None):
+        """service_tasks: name -> function that builds that service, SERVICE_TASKS unless something else is passed in (for benchmark_startup.py)"""
         self.root = tk.Tk()
         self.root.title("AI Coding Assistant")
         self.root.geometry("900x700")
@@ -101,19 +161,26 @@ class ModernChatInterface:
         self.style.configure('TButton', background="#007acc", foreground="#ffffff", font=('Segoe UI', 10, 'bold'), padding=10)
         self.style.map("TButton", background=[("active", "#005f99")])
 
-        # Chat manager instances
-        self.openai_manager = OpenAiManager()
-        self.speech_to_text = SpeechToTextManager()
-        self.elevenlabs_manager = ElevenLabsManager()
-        self.audio_manager = AudioManager()
-        
-        # Initialize chat with system prompt
-        self.openai_manager.chat_history.append(SYSTEM_PROMPT)
+        # Chat manager instances, built in the background once the window is up. They're None until on_services_ready
+        self.openai_manager = None
+        self.speech_to_text = None
+        self.elevenlabs_manager = None
+        self.audio_manager = None
+        self.orchestrator = None
+        # Messages typed before everything was ready, they're sent as soon as it is
+        self.waiting_messages = []
         
         self.is_recording = False
-        self.record_thread = None
+        # Edits reach VS Code while the answer is still streaming, their results wait here until the answer text is done
+        self.answer_streaming = False
+        self.pending_command_notes = []
         
         self.setup_gui()
+        # Worker threads never touch widgets, they queue updates that the main loop applies once per frame
+        self.ui_updates = UiUpdateQueue(self.root)
+        self.ui_updates.start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.startup = ServiceStartup(service_tasks if service_tasks is not None else SERVICE_TASKS, on_ready=self.on_services_built).start()
         
     def setup_gui(self):
         # Main frame
@@ -143,7 +210,7 @@ class ModernChatInterface:
         💡 Tips:
         • For code creation: Position cursor in VS Code before speaking
         • Say "read current file" to analyze current file
-        • Wait for "⏹️ Stop Recording" to appear before stopping
+        • Recording stops by itself when you stop talking (or press "⏹️ Stop Recording")
         """
         helper_label = ttk.Label(
             main_frame,
@@ -196,10 +263,12 @@ class ModernChatInterface:
             style='Record.TButton'
         )
         self.voice_button.pack(side=tk.LEFT)
+        # Nothing to record with until the speech recognizer is ready
+        self.voice_button.state(["disabled"])
         
         # Status Bar
         self.status_var = tk.StringVar()
-        self.status_var.set("Ready")
+        self.status_var.set("Starting up...")
         status_label = ttk.Label(
             main_frame, 
             textvariable=self.status_var, 
@@ -212,95 +281,170 @@ class ModernChatInterface:
         message = self.input_field.get()
         if message.strip():
             self.status_var.set("Processing message...")
-            self.chat_display.insert(tk.END, "You: ", "user")
-            self.chat_display.insert(tk.END, f"{message}\n\n")
+            # Through the update queue like everything else, so it lands in order with what's already queued
+            self.ui_updates.append_text(self.chat_display, "You: ", "user")
+            self.ui_updates.append_text(self.chat_display, f"{message}\n\n")
             self.input_field.delete(0, tk.END)
-            self.chat_display.see(tk.END)
-            threading.Thread(target=self.process_message, args=(message,)).start()
+            if self.orchestrator is None:
+                self.status_var.set("Starting up, your message goes out once everything is ready...")
+                self.waiting_messages.append(message)
+            else:
+                self.orchestrator.submit_text_turn(message)
+    
+    def on_services_built(self, services, error):
+        # Called on the startup thread. The orchestrator is built here too, then handed over to the Tk thread
+        if error is None:
+            try:
+                orchestrator = build_orchestrator(services)
+                orchestrator.subscribe(self.on_turn_event)
+            except Exception as e:
+                error = e
+        if error is not None:
+            self.ui_updates.call(self.show_startup_error, error)
+            return
+        self.ui_updates.call(self.on_services_ready, services, orchestrator)
+    
+    def on_services_ready(self, services, orchestrator):
+        self.openai_manager = services["openai_manager"]
+        self.speech_to_text = services["speech_to_text"]
+        self.elevenlabs_manager = services["elevenlabs_manager"]
+        self.audio_manager = services["audio_manager"]
+        self.orchestrator = orchestrator
+        self.voice_button.state(["!disabled"])
+        self.status_var.set("Ready")
+        print(f"Services ready: {self.startup.stats()}")
+        for message in self.waiting_messages:
+            self.orchestrator.submit_text_turn(message)
+        self.waiting_messages = []
+    
+    def show_startup_error(self, error):
+        self.chat_display.insert(tk.END, f"❌ Startup failed: {error}\n\n", "error")
+        self.chat_display.see(tk.END)
+        self.status_var.set(f"Startup failed: {error}")
     
     def toggle_recording(self):
         if not self.is_recording:
+            # Pressing record while the assistant is still answering cuts that answer off
+            self.orchestrator.interrupt()
             # Start recording
-            self.is_recording = True
-            self.voice_button.configure(text="⏹️ Stop Recording")
-            self.status_var.set("Recording... Speak now")
-            self.chat_display.insert(tk.END, "🎤 Recording started...\n", "voice")
-            self.chat_display.see(tk.END)
-            
-            # Start recording in a separate thread
-            self.record_thread = threading.Thread(target=self.record_voice)
-            self.record_thread.start()
+            self.set_recording(True)
+            self.ui_updates.append_text(self.chat_display, "🎤 Recording started...\n", "voice")
+            self.orchestrator.submit_voice_turn()
         else:
             # Stop recording
             self.stop_recording()
     
     def stop_recording(self):
         if self.is_recording:
-            self.is_recording = False
-            self.speech_to_text.stop_recording()  # Stop the speech recognition
-            self.voice_button.configure(text="🎤 Start Recording")
+            self.orchestrator.stop_listening()  # Stop the speech recognition
+            self.set_recording(False)
             self.status_var.set("Processing recording...")
-            self.chat_display.insert(tk.END, "⏹️ Recording stopped...\n", "voice")
-            self.chat_display.see(tk.END)
+            self.ui_updates.append_text(self.chat_display, "⏹️ Recording stopped...\n", "voice")
     
-    def record_voice(self):
-        try:
-            voice_input = self.speech_to_text.speechtotext_from_mic_continuous()
-            if voice_input and voice_input.strip():
-                self.chat_display.insert(tk.END, "You (voice): ", "voice")
-                self.chat_display.insert(tk.END, f"{voice_input}\n\n")
-                self.chat_display.see(tk.END)
-                self.process_message(voice_input)
-            else:
-                self.chat_display.insert(tk.END, "❌ No speech detected\n\n", "error")
-                self.status_var.set("No speech detected")
-        except Exception as e:
-            error_msg = str(e)
-            self.chat_display.insert(tk.END, f"❌ Recording error: {error_msg}\n\n", "error")
-            self.status_var.set(f"Recording error: {error_msg}")
-        finally:
-            self.is_recording = False
+    def set_recording(self, is_recording):
+        self.is_recording = is_recording
+        if is_recording:
+            self.voice_button.configure(text="⏹️ Stop Recording")
+            self.status_var.set("Recording... Speak now")
+        else:
             self.voice_button.configure(text="🎤 Start Recording")
-            self.root.update()
     
-    def process_message(self, message):
-        try:
+    def on_turn_event(self, event):
+        # Called on the orchestrator's thread, Tk widgets may only be touched from the main loop
+        if event["type"] == "delta":
+            # Streamed text is merged into one insert per frame, so long answers don't flood Tk
+            self.ui_updates.append_text(self.chat_display, event["text"])
+        else:
+            self.ui_updates.call(self.show_turn_event, event)
+    
+    def show_turn_event(self, event):
+        event_type = event["type"]
+        if event_type == "turn_done":
+            # A timed out or failed answer never gets its answer_done
+            self.show_command_notes()
+        if event_type == "listening" and event["carried_over_text"]:
+            # The user talked over the answer, so keep listening for the rest of what they're saying
+            self.chat_display.insert(tk.END, "✋ Interrupted, listening...\n", "voice")
+            self.set_recording(True)
+        elif event_type == "heard":
+            self.set_recording(False)
+            self.chat_display.insert(tk.END, "You (voice): ", "voice")
+            self.chat_display.insert(tk.END, f"{event['text']}\n\n")
+        elif event_type == "no_speech":
+            self.set_recording(False)
+            self.chat_display.insert(tk.END, "❌ No speech detected\n\n", "error")
+            self.status_var.set("No speech detected")
+        elif event_type == "thinking":
             self.status_var.set("AI is thinking...")
-            
-            # Check if this is a file reading command
-            if "read" in message.lower() and "file" in message.lower():
+            # The open file (around the cursor) goes along with every message, this just says so when the user asks for it
+            message = event["text"].lower()
+            if "read" in message and "file" in message:
                 self.status_var.set("Reading current file...")
-                self.chat_display.insert(tk.END, "💻 Requesting file content...\n", "system")
-                self.chat_display.see(tk.END)
-                
-            response = self.openai_manager.chat_with_history(message)
-            
-            # Display AI response with proper formatting
+                if self.openai_manager.vscode_api.editor_context.has_document():
+                    self.chat_display.insert(tk.END, "💻 Sending the code around your cursor...\n", "system")
+                else:
+                    self.chat_display.insert(tk.END, "💻 No file open in VS Code yet...\n", "system")
+            # The answer shows up as it streams in, while every finished sentence is already being spoken
             self.chat_display.insert(tk.END, "AI: ", "ai")
-            
-            # Check for code commands in the response
-            if any(cmd in response for cmd in ["CREATE FUNCTION:", "EDIT ROW:", "DELETE ROW:"]):
-                self.chat_display.insert(tk.END, "⚡ Executing code command...\n", "system")
-                # Give user a moment to position cursor if needed
-                self.status_var.set("Position your cursor in VS Code (3s)...")
-                self.root.update()
-                time.sleep(3)  # Brief pause to allow cursor positioning
-                
-            self.chat_display.insert(tk.END, f"{response}\n\n")
-            self.chat_display.see(tk.END)
-            
-            self.status_var.set("Converting to speech...")
-            audio_file = self.elevenlabs_manager.text_to_audio(response, "Liam", False)
-            
+            self.answer_streaming = True
+        elif event_type == "answer_done":
+            self.chat_display.insert(tk.END, "\n\n")
+            self.show_command_notes()
+        elif event_type == "command_queued":
+            self.status_var.set("⚡ Sending code to VS Code...")
+        elif event_type == "command_done":
+            if event["ok"]:
+                note = (f"✅ Applied in VS Code ({event['round_trip_ms']:.0f} ms)\n\n", "system")
+            else:
+                note = (f"❌ VS Code couldn't apply the command: {event['error']}\n\n", "error")
+            if self.answer_streaming:
+                self.pending_command_notes.append(note)
+            else:
+                self.chat_display.insert(tk.END, *note)
+        elif event_type == "speaking":
             self.status_var.set("Playing response...")
-            self.audio_manager.play_audio(audio_file, True, True, True)
-            
+        elif event_type == "turn_rejected":
+            if not event["text"]:
+                self.set_recording(False)
+            self.chat_display.insert(tk.END, "❌ Still busy with earlier messages, please wait a moment\n\n", "error")
+        elif event_type == "timeout":
+            self.chat_display.insert(tk.END, f"❌ Error: the answer took longer than {event['seconds']:.0f}s\n\n", "error")
+        elif event_type == "error":
+            if event["stage"] == "listening":
+                self.set_recording(False)
+                self.chat_display.insert(tk.END, f"❌ Recording error: {event['error']}\n\n", "error")
+                self.status_var.set(f"Recording error: {event['error']}")
+            else:
+                self.chat_display.insert(tk.END, f"❌ Error: {event['error']}\n\n", "error")
+                self.status_var.set(f"Error: {event['error']}")
+        elif event_type == "turn_done" and event["status"] in ("done", "interrupted"):
             self.status_var.set("Ready")
-        except Exception as e:
-            error_msg = str(e)
-            self.status_var.set(f"Error: {error_msg}")
-            self.chat_display.insert(tk.END, f"❌ Error: {error_msg}\n\n", "error")
-            self.chat_display.see(tk.END)
+        else:
+            return
+        self.chat_display.see(tk.END)
+    
+    def show_command_notes(self):
+        self.answer_streaming = False
+        for note, tag in self.pending_command_notes:
+            self.chat_display.insert(tk.END, note, tag)
+        self.pending_command_notes = []
+
+    def on_close(self):
+        print(f"UI update stats: {self.ui_updates.stats()}")
+        self.ui_updates.stop()
+        if self.orchestrator is None:
+            # Closed before everything was ready, the startup threads go away with the process
+            self.root.destroy()
+            return
+        if self.openai_manager.response_cache is not None:
+            print(f"Response cache stats: {self.openai_manager.response_cache.stats()}")
+        print(f"Latency:\n{self.orchestrator.tracer.format_summary()}")
+        self.orchestrator.tracer.export(LATENCY_TRACE_FILE)
+        self.orchestrator.shutdown()
+        if self.openai_manager.workspace_index is not None:
+            # Saves whatever was re-indexed since the last save
+            self.openai_manager.workspace_index.stop()
+        self.root.destroy()
     
     def run(self):
         self.root.mainloop()
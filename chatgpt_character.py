@@ -3,17 +3,37 @@ import keyboard
 from rich import print
 from azure_speech_to_text import SpeechToTextManager
 from openai_chat import OpenAiManager
+from response_cache import ResponseCache
+from conversation_journal import ConversationJournal
 from eleven_labs import ElevenLabsManager
 from audio_player import AudioManager
+from turn_orchestrator import TurnOrchestrator
 
 ELEVENLABS_VOICE = "Liam" # Replace this with the name of whatever voice you have created on Elevenlabs
 
-BACKUP_FILE = "ChatHistoryBackup.txt"
+BARGE_IN = True # Start talking while the assistant is speaking to interrupt it (use headphones, or it may hear itself)
+SPECULATIVE_PREFETCH = False # Start asking GPT while you're still talking, once your words stop changing (costs some wasted tokens)
+AUTO_STOP = True # Stop listening by itself once you stop talking, instead of waiting for you to press P
+STREAMED_SPEECH = True # Start playing each sentence as soon as its first audio arrives, instead of once it's all synthesized
+RESPONSE_CACHE = False # Answer a repeated question about the same code from a local cache instead of asking GPT again (answers that edit code are never cached)
+
+RESUME_CONVERSATION = True # Pick up the conversation from the last run, from the journal
+
+JOURNAL_FILE = "ChatHistory.jsonl"
+LATENCY_TRACE_FILE = "latency_trace.json" # Per-stage latencies, print a summary with: python latency_tracer.py latency_trace.json
 
 elevenlabs_manager = ElevenLabsManager()
 speechtotext_manager = SpeechToTextManager()
-openai_manager = OpenAiManager()
+openai_manager = OpenAiManager(response_cache=ResponseCache() if RESPONSE_CACHE else None)
 audio_manager = AudioManager()
+# Listens, asks OpenAi, speaks the answer and runs the editor command, one turn at a time
+orchestrator = TurnOrchestrator(
+    openai_manager, speechtotext_manager, elevenlabs_manager, audio_manager, ELEVENLABS_VOICE,
+    barge_in=BARGE_IN, speculative_prefetch=SPECULATIVE_PREFETCH, auto_stop=AUTO_STOP, streamed_speech=STREAMED_SPEECH
+)
+
+# Pressing P always stops listening, even with AUTO_STOP on
+keyboard.add_hotkey("p", orchestrator.stop_listening)
 
 FIRST_SYSTEM_MESSAGE = {"role": "system", "content": '''
 You are an advanced AI-powered coding assistant, designed to **help developers write, edit, and manage code** within a VS Code environment using voice commands. Your primary goal is to assist in coding, debugging, optimizing, and explaining programming concepts while ensuring clarity, accuracy, and efficiency.
@@ -64,16 +84,26 @@ EDIT ROW:
 I'll modify the current line to fix the syntax error.
 [code follows]
 
+For changes to several lines (they are applied together, as one undo step):
+EDIT ROW: 12
+I'll rename the variable on line 12.
+[code follows]
+DELETE ROW: 15
+And remove the unused import on line 15.
+
 ❌ INCORRECT FORMAT EXAMPLES:
 - "Let me delete that line for you..."
 - "### Command: Delete row"
 - "I will remove the selected line"
 - "DELETE LINE: Let me help"
-- Any command with extra text on the same line
+- Any command with extra text on the same line (other than a line number)
 
 Remember:
 - For DELETE ROW: No code should follow, only explanation
 - Commands must be EXACT and on their own line
+- A command may end with a line number (e.g. DELETE ROW: 15), without one it applies at the cursor
+- Line numbers always refer to the file as it was before any of your changes
+- The part of the open file around the cursor is sent to you with every message, as 'line number: code' lines. Use those line numbers
 - Always explain what you're doing after the command
                         
 ---
@@ -96,6 +126,34 @@ Alright, let's get started! 🎯💻'''
 }
 
 openai_manager.chat_history.append(FIRST_SYSTEM_MESSAGE)
+# Every message is appended to the journal as it's added, instead of rewriting a backup of the whole history after each answer
+restored_messages = openai_manager.attach_journal(ConversationJournal(JOURNAL_FILE), resume=RESUME_CONVERSATION)
+if restored_messages:
+    print(f"[green]Picked up the last conversation ({restored_messages} messages, {openai_manager.chat_history.total_tokens} tokens)")
+
+def show_turn_event(event):
+    # Called by the orchestrator as the turn goes along
+    if event["type"] == "listening" and event["carried_over_text"]:
+        # The user talked over the last answer, so we went straight to listening for the rest of their question
+        print("[green]You interrupted the assistant, keep talking:")
+    elif event["type"] == "no_speech":
+        print("[red]Did not receive any input from your microphone!")
+    elif event["type"] == "delta":
+        # Print the answer as it streams in. Each finished sentence is already on its way to 11Labs and played in order.
+        print(event["text"], end="", flush=True)
+    elif event["type"] == "answer_done":
+        print()
+    elif event["type"] == "turn_done":
+        # Both of this turn's messages are on disk once this returns
+        openai_manager.journal.flush()
+    elif event["type"] == "command_done":
+        # Edits are sent as soon as their code block is complete, so this can land in the middle of the answer
+        if event["ok"]:
+            print(f"\n[green]Code applied in VS Code, {event['round_trip_ms']:.0f} ms round trip ({event['apply_ms']} ms in the editor)")
+        else:
+            print(f"\n[red]VS Code couldn't apply the command: {event['error']}")
+
+orchestrator.subscribe(show_turn_event)
 
 print("[green]Starting the loop, press F4 to begin")
 while True:
@@ -106,25 +164,15 @@ while True:
 
     print("[green]User pressed F4 key! Now listening to your microphone:")
 
-    # Get question from mic
-    mic_result = speechtotext_manager.speechtotext_from_mic_continuous()
-    
-    if mic_result == '':
-        print("[red]Did not receive any input from your microphone!")
-        continue
-
-    # Send question to OpenAi
-    openai_result = openai_manager.chat_with_history(mic_result)
-    
-    # Write the results to txt file as a backup
-    with open(BACKUP_FILE, "w", encoding="utf-8") as file:
-        file.write(str(openai_manager.chat_history))
-
-    # Send it to 11Labs to turn into cool audio
-    elevenlabs_output = elevenlabs_manager.text_to_audio(openai_result, ELEVENLABS_VOICE, False)
-
-    # Play the mp3 file
-    audio_manager.play_audio(elevenlabs_output, True, True, True)
+    # Get question from mic, answer it, and keep going if the user talks over the answer
+    orchestrator.submit_voice_turn()
+    orchestrator.wait_until_idle()
+    if SPECULATIVE_PREFETCH:
+        print(f"[coral]Speculative prefetch stats: {orchestrator.prefetcher.stats()}")
+    if RESPONSE_CACHE:
+        print(f"[coral]Response cache stats: {openai_manager.response_cache.stats()}")
+    print(f"[coral]Latency so far:\n{orchestrator.tracer.format_summary()}")
+    orchestrator.tracer.export(LATENCY_TRACE_FILE)
 
     print("[green]\n!!!!!!!\nFINISHED PROCESSING DIALOGUE.\nREADY FOR NEXT INPUT\n!!!!!!!\n")
     
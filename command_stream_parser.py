@@ -0,0 +1,191 @@
+import re
+from rich import print
+
+# A command on its own line, optionally followed by the (1-based) line it applies to, e.g. "DELETE ROW: 15"
+AI_COMMAND_LINE = re.compile(r"^[ \t]*(CREATE FUNCTION|EDIT ROW|DELETE ROW):[ \t]*(\d+)?[ \t]*\r?$", re.MULTILINE)
+AI_COMMAND_OPERATIONS = {"CREATE FUNCTION": "insert", "EDIT ROW": "replaceLine", "DELETE ROW": "deleteLine"}
+# Opening or closing code fence: ``` or ~~~ (or longer), optionally followed by a language on the opening one
+FENCE_LINE = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})[ \t]*([^`]*?)[ \t]*\r?$")
+
+
+def contains_ai_command(text):
+    return AI_COMMAND_LINE.search(text) is not None
+
+
+class StreamingCommandParser:
+    """
+    Finds commands and their code blocks in a GPT answer while it is still streaming in.
+    feed() takes chunks of any size, split anywhere, and returns the edit operations that just became complete:
+    a DELETE ROW as soon as its line is complete, a CREATE FUNCTION / EDIT ROW as soon as the closing fence of its code block arrives.
+    So edits can be sent to VS Code while GPT is still writing the explanation after them.
+
+    Operations look like {"op": "insert" | "replaceLine" | "deleteLine", "line": 1-based line or None for the cursor, "content": code}.
+    A command's code is the first code block after it (any fence language, ``` or ~~~). Command-like lines inside code are just code.
+    """
+
+    def __init__(self):
+        self.pending_line = ""
+        # (command, operation) still waiting for its code block
+        self.waiting_command = None
+        # The opening fence of the block we're inside, None outside code
+        self.fence = None
+        self.language = ""
+        self.code_lines = []
+        # Every finished code block, in order, whether or not a command claimed it
+        self.code_blocks = []
+        self.skipped_commands = []
+
+    def feed(self, text):
+        """Returns the operations completed by this chunk"""
+        operations = []
+        self.pending_line += text
+        if "\n" not in text:
+            return operations
+        *complete_lines, self.pending_line = self.pending_line.split("\n")
+        for line in complete_lines:
+            self._process_line(line, operations)
+        return operations
+
+    def finish(self):
+        """Call once the answer is complete. Returns whatever the last, unterminated line completes."""
+        operations = []
+        if self.pending_line:
+            self._process_line(self.pending_line, operations)
+            self.pending_line = ""
+        if self.fence is not None:
+            # The answer ended inside a code block, the code we got is still the best we have
+            self._close_block(operations)
+        self._skip_waiting_command()
+        return operations
+
+    def _process_line(self, line, operations):
+        if self.fence is not None:
+            fence_match = FENCE_LINE.match(line)
+            if fence_match and not fence_match.group(2) and fence_match.group(1)[0] == self.fence[0] and len(fence_match.group(1)) >= len(self.fence):
+                self._close_block(operations)
+            else:
+                self.code_lines.append(line.rstrip("\r"))
+            return
+
+        command_match = AI_COMMAND_LINE.match(line)
+        if command_match:
+            self._skip_waiting_command()
+            command, line_number = command_match.group(1), command_match.group(2)
+            operation = {"op": AI_COMMAND_OPERATIONS[command], "line": int(line_number) if line_number else None}
+            if operation["op"] == "deleteLine":
+                # Nothing more to wait for
+                operations.append(operation)
+            else:
+                self.waiting_command = (command, operation)
+            return
+
+        fence_match = FENCE_LINE.match(line)
+        if fence_match:
+            self.fence = fence_match.group(1)
+            self.language = fence_match.group(2)
+            self.code_lines = []
+
+    def _close_block(self, operations):
+        code_content = "\n".join(self.code_lines)
+        self.code_blocks.append(code_content)
+        self.fence = None
+        self.code_lines = []
+        if self.waiting_command is None:
+            return
+        command, operation = self.waiting_command
+        self.waiting_command = None
+        if not code_content.strip():
+            print(f"[yellow]⚠ {command}: has an empty code block after it, skipping it[/]")
+            self.skipped_commands.append(command)
+            return
+        operation["content"] = code_content
+        operations.append(operation)
+
+    def _skip_waiting_command(self):
+        if self.waiting_command is not None:
+            command, _ = self.waiting_command
+            print(f"[yellow]⚠ {command}: has no code block after it, skipping it[/]")
+            self.skipped_commands.append(command)
+            self.waiting_command = None
+
+
+# Tests
+if __name__ == '__main__':
+    import random
+
+    def parse_in_chunks(text, chunk_sizes):
+        parser = StreamingCommandParser()
+        operations = []
+        position = 0
+        for size in chunk_sizes:
+            operations += parser.feed(text[position:position + size])
+            position += size
+        operations += parser.feed(text[position:])
+        return operations + parser.finish(), parser
+
+    answer = (
+        "EDIT ROW: 12\n"
+        "I'll rename the variable.\n"
+        "```python\n"
+        "total = 0\n"
+        "```\n"
+        "DELETE ROW: 15\n"
+        "And drop the unused import.\n"
+        "CREATE FUNCTION:\n"
+        "Plus a helper at the cursor, written in TypeScript:\n"
+        "~~~~typescript\n"
+        "// DELETE ROW: in a comment is just code\n"
+        "```\n"
+        "function helper() {}\n"
+        "~~~~\n"
+        "Here's how you'd call it:\n"
+        "```\n"
+        "helper()\n"
+        "```\n"
+        "EDIT ROW:\n"
+        "This one never gets code, so it's skipped."
+    )
+    expected = [
+        {"op": "replaceLine", "line": 12, "content": "total = 0"},
+        {"op": "deleteLine", "line": 15},
+        {"op": "insert", "line": None, "content": "// DELETE ROW: in a comment is just code\n```\nfunction helper() {}"},
+    ]
+    operations, parser = parse_in_chunks(answer, [])
+    assert operations == expected, operations
+    assert parser.code_blocks[-1] == "helper()" and parser.skipped_commands == ["EDIT ROW"]
+
+    # Edits come out the moment their block closes, long before the answer is done
+    parser = StreamingCommandParser()
+    emitted_at = []
+    for position, character in enumerate(answer):
+        for operation in parser.feed(character):
+            emitted_at.append(position)
+    # i.e. at the newline ending the closing fence / the DELETE ROW line
+    assert emitted_at == [answer.index("```\nDELETE ROW") + 3, answer.index("DELETE ROW: 15\n") + 14, answer.index("~~~~\nHere") + 4], emitted_at
+    print("Edits are emitted as soon as their line / closing fence completes")
+
+    # Property test: however the stream is chopped up, the result is the same as parsing it in one go
+    rng = random.Random(0)
+    fences = ["```", "```python", "``` js", "~~~", "````rust"]
+    for _ in range(500):
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            kind = rng.choice(["CREATE FUNCTION:", "EDIT ROW:", "DELETE ROW:", "text"])
+            if kind == "text":
+                parts.append(rng.choice(["Sure thing.", "Here's why: it's faster.", "```", "DELETE ROW: is a command"]))
+                continue
+            parts.append(kind + rng.choice(["", f" {rng.randint(1, 200)}"]))
+            parts.append("Explanation line.")
+            if kind != "DELETE ROW:" and rng.random() < 0.9:
+                fence = rng.choice(fences)
+                closing = fence.split()[0].rstrip("abcdefghijklmnopqrstuvwxyz")
+                parts += [fence] + [f"line_{rng.randint(0, 99)} = {rng.randint(0, 9)}" for _ in range(rng.randint(0, 4))] + [closing]
+        text = "\n".join(parts) + rng.choice(["", "\n"])
+        whole, _ = parse_in_chunks(text, [])
+        split_points = sorted(rng.sample(range(len(text) + 1), rng.randint(0, min(20, len(text)))))
+        chunk_sizes = [end - start for start, end in zip([0] + split_points, split_points)]
+        chunked, _ = parse_in_chunks(text, chunk_sizes)
+        assert chunked == whole, (text, chunk_sizes)
+        one_by_one, _ = parse_in_chunks(text, [1] * len(text))
+        assert one_by_one == whole, text
+    print("500 random answers parse the same however they're split into chunks")
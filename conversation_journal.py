@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import atexit
+import threading
+from rich import print
+from token_budget import count_many_message_tokens
+
+
+class ConversationJournal:
+    """
+    Saves the conversation as it goes, so it survives a crash and can be picked up again on the next start.
+    Every message added to the history is appended as one JSON line (with its token count) to the journal file,
+    which is never rewritten, so a turn costs the same to save whether it's the 5th or the 10,000th.
+    Lines are buffered and written, flushed and fsynced together: when flush() is called (once per turn), or
+    once flush_every lines or flush_seconds have piled up.
+    Every snapshot_every messages, the history as it is right then (after trimming and summarizing) goes to a small
+    snapshot file, along with where the journal was at. resume() loads the snapshot and only reads the journal
+    after that point, with the saved token counts, so nothing is re-encoded and the whole journal is never read.
+
+    Parameters:
+    path (str): the journal file (JSON lines), the snapshot is kept next to it
+    flush_every (int): write the buffered lines once there are this many
+    flush_seconds (float): or once the oldest one has waited this long
+    snapshot_every (int): write a snapshot after this many messages
+    """
+
+    VERSION = 1
+
+    def __init__(self, path="ChatHistory.jsonl", flush_every=32, flush_seconds=5.0, snapshot_every=200):
+        self.path = os.path.abspath(path)
+        self.snapshot_path = self.path + ".snapshot.json"
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.pending_lines = []
+        self.first_pending_time = None
+        self.since_snapshot = 0
+        self.file = None
+        self.fsyncs = 0
+        self.snapshots = 0
+        self.write_seconds = 0.0
+        atexit.register(self.close)
+
+    def resume(self, history):
+        """
+        Adds the saved conversation to history (which should only hold the system prompt by now) and returns how many messages
+        were restored. Snapshot messages keep the token counts they were saved with, as long as the model is the same.
+        """
+        with self.lock:
+            messages, message_tokens, snapshot_seq, offset = [], [], 0, 0
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as file:
+                    snapshot = json.load(file)
+                if snapshot.get("version") == self.VERSION and snapshot.get("model") == history.model:
+                    messages, message_tokens = snapshot["messages"], snapshot["tokens"]
+                    snapshot_seq, offset = snapshot["seq"], snapshot["offset"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+            last_seq = snapshot_seq
+            try:
+                with open(self.path, "rb") as file:
+                    if offset > os.fstat(file.fileno()).st_size:
+                        # The journal isn't the one the snapshot was taken from, read all of it
+                        offset = 0
+                    file.seek(offset)
+                    for line in file:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # A line cut off by a crash, nothing after it was written
+                            break
+                        if "seq" not in record or record["seq"] <= snapshot_seq:
+                            continue
+                        messages.append(record["message"])
+                        message_tokens.append(record["tokens"] if record.get("model") == history.model else None)
+                        last_seq = record["seq"]
+            except OSError:
+                pass
+
+            if None in message_tokens:
+                recount = [index for index, tokens in enumerate(message_tokens) if tokens is None]
+                for index, tokens in zip(recount, count_many_message_tokens([messages[index] for index in recount], history.encoding)):
+                    message_tokens[index] = tokens
+            history.extend_with_counts(messages, message_tokens)
+            self.seq = last_seq
+            self.since_snapshot = last_seq - snapshot_seq
+            return len(messages)
+
+    def record(self, message, tokens, history=None):
+        """Adds a message that was just appended to history. history (everything after the system prompt) is snapshotted when one is due."""
+        with self.lock:
+            self.seq += 1
+            line = json.dumps({"seq": self.seq, "model": getattr(history, "model", None), "tokens": tokens, "message": message}, ensure_ascii=False)
+            self.pending_lines.append(line + "\n")
+            if self.first_pending_time is None:
+                self.first_pending_time = time.monotonic()
+            if len(self.pending_lines) >= self.flush_every or time.monotonic() - self.first_pending_time >= self.flush_seconds:
+                self._write_pending()
+            self.since_snapshot += 1
+            if history is not None and self.since_snapshot >= self.snapshot_every:
+                self._write_snapshot(history)
+
+    def flush(self):
+        """Writes and fsyncs whatever is buffered, e.g. at the end of a turn"""
+        with self.lock:
+            self._write_pending()
+
+    def snapshot(self, history):
+        with self.lock:
+            self._write_snapshot(history)
+
+    def close(self):
+        with self.lock:
+            self._write_pending()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "messages": self.seq,
+                "fsyncs": self.fsyncs,
+                "snapshots": self.snapshots,
+                "pending": len(self.pending_lines),
+                "write_ms": round(self.write_seconds * 1000, 1),
+            }
+
+    def _open(self):
+        if self.file is not None:
+            return
+        self.file = open(self.path, "ab+")
+        # A crash in the middle of a write leaves half a line at the end, cut it off so the next line starts clean
+        size = self.file.seek(0, os.SEEK_END)
+        if size:
+            self.file.seek(max(0, size - 64 * 1024))
+            tail = self.file.read()
+            if not tail.endswith(b"\n"):
+                self.file.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+            self.file.seek(0, os.SEEK_END)
+
+    def _write_pending(self):
+        if not self.pending_lines:
+            return
+        start_time = time.perf_counter()
+        self._open()
+        self.file.write("".join(self.pending_lines).encode("utf-8"))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending_lines = []
+        self.first_pending_time = None
+        self.fsyncs += 1
+        self.write_seconds += time.perf_counter() - start_time
+
+    def _write_snapshot(self, history):
+        # The snapshot has to point past every message in it, so the journal is written out first
+        self._write_pending()
+        start_time = time.perf_counter()
+        self._open()
+        snapshot = {
+            "version": self.VERSION,
+            "model": history.model,
+            "seq": self.seq,
+            "offset": self.file.tell(),
+            "messages": list(history[1:]),
+            "tokens": list(history.message_tokens[1:]),
+        }
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.since_snapshot = 0
+        self.snapshots += 1
+        self.write_seconds += time.perf_counter() - start_time
+
+
+# Tests and benchmark
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    from token_budget import TokenCountedHistory
+
+    SYSTEM_MESSAGE = {"role": "system", "content": "You are a coding assistant. " * 50}
+
+    def trim(history):
+        # Same as OpenAiManager._trim_chat_history
+        while history.total_tokens > 8000 and len(history) > 1:
+            history.pop(1)
+
+    def run_turns(journal, history, turns, start=0):
+        for i in range(start, start + turns):
+            for message in ({"role": "user", "content": f"Turn {i}: can you delete line {i % 300} in the parser?"},
+                            {"role": "assistant", "content": f"Sure, line {i % 300} was unused. " + "Here is why it is safe to remove. " * 10}):
+                history.append(message)
+                trim(history)
+                if journal is not None:
+                    journal.record(message, history.message_tokens[-1], history)
+            if journal is not None:
+                journal.flush()
+
+    test_dir = tempfile.mkdtemp()
+    try:
+        # Resume gives back exactly the history that was there, with the same token counts
+        path = os.path.join(test_dir, "ChatHistory.jsonl")
+        journal = ConversationJournal(path, snapshot_every=50)
+        history = TokenCountedHistory([SYSTEM_MESSAGE])
+        run_turns(journal, history, 130)
+        journal.close()
+        resumed = TokenCountedHistory([SYSTEM_MESSAGE])
+        restored = ConversationJournal(path).resume(resumed)
+        # The snapshot is trimmed, the messages after it aren't (the caller trims after resuming)
+        trim(resumed)
+        assert list(resumed) == list(history) and resumed.message_tokens == history.message_tokens, (len(resumed), len(history))
+        print(f"[green]Resumed {restored} messages, same history and token counts as before")
+
+        # Half a line from a crash is ignored, and cut off before the next write
+        with open(path, "ab") as file:
+            file.write(b'{"seq": 261, "model": "gpt-4o", "tok')
+        journal = ConversationJournal(path, snapshot_every=50)
+        resumed = TokenCountedHistory([SYSTEM_MESSAGE])
+        journal.resume(resumed)
+        trim(resumed)
+        assert list(resumed) == list(history)
+        run_turns(journal, resumed, 1, start=130)
+        journal.close()
+        resumed_again = TokenCountedHistory([SYSTEM_MESSAGE])
+        ConversationJournal(path).resume(resumed_again)
+        trim(resumed_again)
+        assert list(resumed_again) == list(resumed)
+        print("[green]A line cut off by a crash is dropped, the journal carries on after it")
+
+        # Benchmark: 10k turns (20k messages), saving after every turn
+        TURNS = 10000
+        history = TokenCountedHistory([SYSTEM_MESSAGE])
+        start = time.perf_counter()
+        run_turns(None, history, TURNS)
+        base_seconds = time.perf_counter() - start
+
+        # What chatgpt_character.py used to do: rewrite str(chat_history) after every answer
+        backup_path = os.path.join(test_dir, "ChatHistoryBackup.txt")
+        history = TokenCountedHistory([SYSTEM_MESSAGE])
+        rewrite_seconds = 0.0
+        rewritten_bytes = 0
+        for i in range(TURNS):
+            run_turns(None, history, 1, start=i)
+            start = time.perf_counter()
+            with open(backup_path, "w", encoding="utf-8") as file:
+                rewritten_bytes += file.write(str(history))
+            rewrite_seconds += time.perf_counter() - start
+
+        journal_path = os.path.join(test_dir, "Benchmark.jsonl")
+        journal = ConversationJournal(journal_path)
+        history = TokenCountedHistory([SYSTEM_MESSAGE])
+        start = time.perf_counter()
+        run_turns(journal, history, TURNS)
+        journal.close()
+        journal_seconds = time.perf_counter() - start - base_seconds
+        journal_bytes = os.path.getsize(journal_path) + os.path.getsize(journal_path + ".snapshot.json") * journal.snapshots
+
+        print(f"[green]Saving after each of {TURNS} turns:")
+        print(f"  rewrite str(history), no fsync: {rewrite_seconds / TURNS * 1000:.3f} ms per turn, {rewritten_bytes / 1e6:.0f} MB written, "
+              f"and only the last ~8000 tokens survive (as a repr that json can't read)")
+        print(f"  journal, one fsync per turn:    {journal_seconds / TURNS * 1000:.3f} ms per turn, {journal_bytes / 1e6:.1f} MB written, "
+              f"every message kept, {journal.stats()}")
+
+        journal = ConversationJournal(os.path.join(test_dir, "Batched.jsonl"), flush_every=32, flush_seconds=60)
+        start = time.perf_counter()
+        for i in range(TURNS):
+            for message in ({"role": "user", "content": f"Turn {i}"}, {"role": "assistant", "content": "Done. " * 40}):
+                journal.record(message, 30, history)
+        journal.close()
+        print(f"  journal, batched fsync:         {(time.perf_counter() - start) / TURNS * 1000:.3f} ms per turn, {journal.stats()}")
+
+        # Resuming after those 20k turns: the snapshot plus the journal after it, against re-encoding the whole transcript
+        start = time.perf_counter()
+        resumed = TokenCountedHistory([SYSTEM_MESSAGE])
+        ConversationJournal(journal_path).resume(resumed)
+        trim(resumed)
+        resume_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        with open(journal_path, "r", encoding="utf-8") as file:
+            everything = TokenCountedHistory([SYSTEM_MESSAGE] + [json.loads(line)["message"] for line in file])
+        trim(everything)
+        reencode_ms = (time.perf_counter() - start) * 1000
+        assert list(resumed) == list(everything)
+        print(f"  resume: {resume_ms:.1f} ms from the snapshot, {reencode_ms:.0f} ms reading and re-encoding the whole journal")
+    finally:
+        shutil.rmtree(test_dir)
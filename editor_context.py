@@ -0,0 +1,295 @@
+import time
+import threading
+from rich import print
+
+
+class EditorContextMirror:
+    """
+    A copy of the document that's open in VS Code, kept up to date on the Python side.
+    The extension sends the whole document once (when it connects, when another file becomes active, or when we ask for a resync),
+    and after that only the changes, so a big file isn't sent again every time the user types or asks something.
+
+    Messages (from extension.ts, through server.js):
+        {"type": "document", "uri", "languageId", "version", "text" (None if the file is too big to mirror), "lineCount", "cursorLine"}
+        {"type": "documentChange", "uri", "fromVersion", "version", "changes": [{"range": {"start": {"line", "character"}, "end": ...}, "text"}]}
+        {"type": "cursor", "uri", "line"}
+    Lines and characters are 0-based and characters count UTF-16 code units, like everywhere in VS Code.
+    If a change doesn't fit the version we have (a missed message), the copy is dropped and a fresh snapshot is requested.
+
+    Parameters:
+    request_resync (callable): asks the extension for a new snapshot
+    resync_interval (float): seconds to wait for a requested snapshot before asking again
+    """
+
+    def __init__(self, request_resync=None, resync_interval=2.0):
+        self.request_resync = request_resync
+        self.resync_interval = resync_interval
+        self.lock = threading.Lock()
+        self.uri = None
+        self.language_id = None
+        self.version = None
+        self.lines = []
+        self.line_count = 0
+        self.cursor_line = 0
+        self.too_large = False
+        self.last_resync_request = None
+        # line text -> token count, so building a window mostly skips encoding
+        self.token_counts = {}
+        self.max_cached_lines = 50000
+        self.snapshots = 0
+        self.snapshot_chars = 0
+        self.changes = 0
+        self.change_chars = 0
+        self.resyncs = 0
+
+    def handle_message(self, message):
+        """Returns True if the message was editor context (and has been applied)"""
+        message_type = message.get("type")
+        if message_type == "document":
+            self._apply_snapshot(message)
+        elif message_type == "documentChange":
+            self._apply_changes(message)
+        elif message_type == "cursor":
+            with self.lock:
+                if message.get("uri") == self.uri:
+                    self.cursor_line = message["line"]
+        else:
+            return False
+        return True
+
+    def has_document(self):
+        with self.lock:
+            return self.uri is not None and (self.version is not None or self.too_large)
+
+    def cursor_window(self, max_tokens, encoding, max_line_chars=400):
+        """
+        The lines around the cursor that fit in max_tokens, numbered from 1 like the line numbers GPT uses in its commands.
+        Returns None if there's no document, otherwise a dict: uri, language_id, version, line_count, cursor_line, start_line, end_line, text
+        (1-based lines, text is None if the file is too big to mirror). Very long lines (minified code) are cut at max_line_chars.
+        """
+        with self.lock:
+            if self.uri is None or (self.version is None and not self.too_large):
+                return None
+            window = {
+                "uri": self.uri,
+                "language_id": self.language_id,
+                "version": self.version,
+                "line_count": self.line_count,
+                "cursor_line": self.cursor_line + 1,
+                "start_line": None,
+                "end_line": None,
+                "text": None,
+            }
+            if self.too_large or not self.lines:
+                return window
+
+            cursor_line = min(self.cursor_line, len(self.lines) - 1)
+            numbered = {}
+            tokens_left = max_tokens
+            above, below = cursor_line - 1, cursor_line
+            # Grow the window one line at a time, alternating below and above the cursor, until the budget is used up
+            while above >= 0 or below < len(self.lines):
+                take_below = below < len(self.lines) and (above < 0 or below - cursor_line <= cursor_line - above)
+                line_index = below if take_below else above
+                numbered_line = self._numbered_line(line_index, max_line_chars)
+                line_tokens = self._count_tokens(numbered_line, encoding)
+                if line_tokens > tokens_left:
+                    break
+                tokens_left -= line_tokens
+                numbered[line_index] = numbered_line
+                if take_below:
+                    below += 1
+                else:
+                    above -= 1
+
+            if numbered:
+                window["start_line"] = above + 2
+                window["end_line"] = below
+                window["text"] = "\n".join(numbered[line_index] for line_index in range(above + 1, below))
+            return window
+
+    def stats(self):
+        with self.lock:
+            return {
+                "uri": self.uri,
+                "version": self.version,
+                "lines": self.line_count,
+                "snapshots": self.snapshots,
+                "snapshot_chars": self.snapshot_chars,
+                "changes": self.changes,
+                "change_chars": self.change_chars,
+                "resyncs": self.resyncs,
+            }
+
+    def _apply_snapshot(self, message):
+        text = message.get("text")
+        with self.lock:
+            self.uri = message.get("uri")
+            self.language_id = message.get("languageId")
+            self.cursor_line = message.get("cursorLine") or 0
+            self.last_resync_request = None
+            self.snapshots += 1
+            if text is None:
+                # Too big to mirror, GPT is only told the file is there
+                self.too_large = True
+                self.version = None
+                self.lines = []
+                self.line_count = message.get("lineCount") or 0
+                return
+            self.too_large = False
+            self.version = message.get("version")
+            self.lines = text.replace("\r\n", "\n").split("\n")
+            self.line_count = len(self.lines)
+            self.snapshot_chars += len(text)
+
+    def _apply_changes(self, message):
+        with self.lock:
+            if message.get("uri") != self.uri or self.too_large:
+                return
+            if self.version is None or message.get("fromVersion") != self.version:
+                resync_reason = f"missed a change (have version {self.version}, change is from {message.get('fromVersion')})"
+            else:
+                resync_reason = None
+                try:
+                    for change in message["changes"]:
+                        self._apply_change(change)
+                        self.change_chars += len(change["text"])
+                    self.version = message["version"]
+                    self.line_count = len(self.lines)
+                    self.changes += 1
+                except (IndexError, KeyError) as e:
+                    resync_reason = f"a change didn't fit the document ({e})"
+            if resync_reason is None:
+                return
+            was_in_sync = self.version is not None
+            # Whatever we have is wrong now, don't let it into a prompt
+            self.version = None
+            self.lines = []
+            request_resync = self._should_request_resync()
+        if was_in_sync:
+            print(f"[yellow]Editor copy of {self.uri} is out of date, {resync_reason}. Asking VS Code for the whole file again")
+        if request_resync:
+            self.request_resync()
+
+    def _apply_change(self, change):
+        start, end = change["range"]["start"], change["range"]["end"]
+        start_line, end_line = start["line"], end["line"]
+        if start_line > end_line or end_line >= len(self.lines):
+            raise IndexError(f"lines {start_line}-{end_line} of {len(self.lines)}")
+        head = self.lines[start_line][:self._utf16_to_index(self.lines[start_line], start["character"])]
+        tail = self.lines[end_line][self._utf16_to_index(self.lines[end_line], end["character"]):]
+        new_text = head + change["text"].replace("\r\n", "\n") + tail
+        self.lines[start_line:end_line + 1] = new_text.split("\n")
+
+    def _should_request_resync(self):
+        if self.request_resync is None:
+            return False
+        now = time.monotonic()
+        if self.last_resync_request is not None and now - self.last_resync_request < self.resync_interval:
+            return False
+        self.last_resync_request = now
+        self.resyncs += 1
+        return True
+
+    @staticmethod
+    def _utf16_to_index(line, character):
+        # VS Code counts UTF-16 code units, characters outside the BMP (emoji) are two of them but one Python character
+        if line.isascii():
+            return character
+        units = 0
+        for index, char in enumerate(line):
+            if units >= character:
+                return index
+            units += 2 if ord(char) > 0xFFFF else 1
+        return len(line)
+
+    def _numbered_line(self, line_index, max_line_chars):
+        line = self.lines[line_index]
+        if len(line) > max_line_chars:
+            line = line[:max_line_chars] + " …"
+        return f"{line_index + 1}: {line}"
+
+    def _count_tokens(self, text, encoding):
+        count = self.token_counts.get(text)
+        if count is None:
+            if len(self.token_counts) >= self.max_cached_lines:
+                self.token_counts.clear()
+            # +1 for the newline joining it to the next line
+            count = self.token_counts[text] = len(encoding.encode(text)) + 1
+        return count
+
+
+# Tests
+if __name__ == '__main__':
+    import random
+    from token_budget import get_encoding_for_model
+
+    resync_requests = []
+    mirror = EditorContextMirror(request_resync=lambda: resync_requests.append(time.monotonic()))
+    assert mirror.cursor_window(1000, get_encoding_for_model()) is None
+
+    def change(start_line, start_character, end_line, end_character, text):
+        return {"range": {"start": {"line": start_line, "character": start_character},
+                          "end": {"line": end_line, "character": end_character}}, "text": text}
+
+    mirror.handle_message({"type": "document", "uri": "file:///a.py", "languageId": "python", "version": 1,
+                           "text": "def a():\n    return 1\n\nprint(a())", "cursorLine": 1})
+    mirror.handle_message({"type": "documentChange", "uri": "file:///a.py", "fromVersion": 1, "version": 3, "changes": [
+        change(3, 6, 3, 9, "b()"),
+        change(1, 11, 1, 12, "2\n\ndef b():\n    return 3"),
+    ]})
+    assert mirror.lines == ["def a():", "    return 2", "", "def b():", "    return 3", "", "print(b())"], mirror.lines
+    # An emoji is two UTF-16 units in VS Code but one character here
+    mirror.handle_message({"type": "documentChange", "uri": "file:///a.py", "fromVersion": 3, "version": 4, "changes": [
+        change(0, 0, 0, 0, "# 🚀 fast\n")]})
+    mirror.handle_message({"type": "documentChange", "uri": "file:///a.py", "fromVersion": 4, "version": 5, "changes": [
+        change(0, 5, 0, 10, "quick")]})
+    assert mirror.lines[0] == "# 🚀 quick" and mirror.version == 5, mirror.lines
+    print("[green]Changes are applied to the copy, including multi-line and non-BMP edits")
+
+    # A missed change means the copy can't be trusted, so a snapshot is requested (once, not for every following change)
+    for version in range(7, 10):
+        mirror.handle_message({"type": "documentChange", "uri": "file:///a.py", "fromVersion": version, "version": version + 1,
+                               "changes": [change(0, 0, 0, 0, "x")]})
+    assert len(resync_requests) == 1 and mirror.cursor_window(1000, get_encoding_for_model()) is None
+    mirror.handle_message({"type": "document", "uri": "file:///a.py", "languageId": "python", "version": 12, "text": "fresh", "cursorLine": 0})
+    assert mirror.cursor_window(1000, get_encoding_for_model())["text"] == "1: fresh"
+    print("[green]Missed change triggers a resync")
+
+    # Randomized: the copy matches the real document after lots of random edits
+    rng = random.Random(1)
+    document = [f"line {i} ünïcode 😀 {i * 7}" for i in range(200)]
+    mirror.handle_message({"type": "document", "uri": "file:///big.py", "languageId": "python", "version": 1,
+                           "text": "\n".join(document), "cursorLine": 0})
+
+    def utf16_length(text):
+        return len(text.encode("utf-16-le")) // 2
+
+    for version in range(1, 500):
+        start_line = rng.randrange(len(document))
+        end_line = min(len(document) - 1, start_line + rng.choice([0, 0, 1, 3]))
+        start_index = rng.randint(0, len(document[start_line]))
+        end_index = rng.randint(start_index if end_line == start_line else 0, len(document[end_line]))
+        new_text = rng.choice(["", "x", "🎉", "a\nb", "\n", "def f():\n    pass\n"])
+        full_text = document[start_line][:start_index] + new_text + document[end_line][end_index:]
+        document[start_line:end_line + 1] = full_text.split("\n")
+        mirror.handle_message({"type": "documentChange", "uri": "file:///big.py", "fromVersion": version, "version": version + 1,
+                               "changes": [change(start_line, utf16_length(mirror.lines[start_line][:start_index]),
+                                                  end_line, utf16_length(mirror.lines[end_line][:end_index]), new_text)]})
+    assert mirror.lines == document
+    print("[green]Copy matches the document after 500 random edits")
+
+    # A big file: the window stays inside its budget and takes milliseconds to build
+    encoding = get_encoding_for_model()
+    source = "\n".join(f"    value_{i} = compute(value_{i - 1}, {i}) # step {i}" for i in range(100000))
+    mirror.handle_message({"type": "document", "uri": "file:///huge.py", "languageId": "python", "version": 1, "text": source, "cursorLine": 50000})
+    for attempt in ("cold", "warm"):
+        start = time.perf_counter()
+        window = mirror.cursor_window(1500, encoding)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        assert len(encoding.encode(window["text"])) <= 1500
+        assert window["start_line"] <= 50001 <= window["end_line"], window
+        print(f"[green]{attempt} window: lines {window['start_line']}-{window['end_line']} of {window['line_count']} in {elapsed_ms:.2f} ms")
+    mirror.handle_message({"type": "documentChange", "uri": "file:///huge.py", "fromVersion": 1, "version": 2,
+                           "changes": [change(50000, 4, 50000, 4, "# edited ")]})
+    print(f"[green]Mirror stats: {mirror.stats()}")
@@ -1,55 +1,220 @@
-from elevenlabs import generate, stream, set_api_key, voices, play, save
 import time
 import os
+import json
+import shutil
+from tts_cache import TTSAudioCache
+# The elevenlabs package is only imported once it's needed, it's slow to load and the window shouldn't wait for it
+
+ELEVENLABS_MODEL = "eleven_monolingual_v1"
+
+# Streams come back as raw 16 bit mono PCM, so playback doesn't have to decode anything
+STREAM_OUTPUT_FORMAT = "pcm_24000"
+STREAM_SAMPLE_RATE = 24000
+
+VOICE_LIST_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ai_voice_assistant", "elevenlabs_voices.json")
+VOICE_LIST_TTL_SECONDS = 24 * 3600
+
+
+def fetch_voice_list():
+    """The account's voices from the ElevenLabs API, as dicts (voice_id, name, category, settings)"""
+    from elevenlabs import voices
+    return [voice.dict() for voice in voices()]
+
+
+def load_voice_list(cache_path=VOICE_LIST_PATH, ttl_seconds=VOICE_LIST_TTL_SECONDS, fetch=fetch_voice_list, clock=time.time):
+    """
+    The account's voices, from the copy on disk while it's younger than ttl_seconds. Otherwise they're fetched
+    (fetch() returns the list of voice dicts) and the copy is saved again. If fetching fails, an old copy is better than nothing.
+    Returns (voices, where they came from: "cache", "api" or "old cache")
+    """
+    saved = None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as file:
+            saved = json.load(file)
+        if clock() - saved["fetched_at"] <= ttl_seconds:
+            return saved["voices"], "cache"
+    except (OSError, ValueError, KeyError, TypeError):
+        saved = None
+
+    try:
+        voice_list = fetch()
+    except Exception as e:
+        if saved is None:
+            raise
+        print(f"Couldn't refresh the ElevenLabs voices, using the ones saved before: {e}")
+        return saved["voices"], "old cache"
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Write to a temp file first so a crash never leaves a half-written list
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump({"fetched_at": clock(), "voices": voice_list}, file)
+    os.replace(temp_path, cache_path)
+    return voice_list, "api"
 
-try:
-  set_api_key(os.getenv('ELEVENLABS_API_KEY'))
-except TypeError:
-  exit("Ooops! You forgot to set ELEVENLABS_API_KEY in your environment!")
 
 class ElevenLabsManager:
 
-    def __init__(self):
-        # CALLING voices() IS NECESSARY TO INSTANTIATE 11LABS FOR SOME FUCKING REASON
-        all_voices = voices()
-        print(f"\nAll ElevenLabs voices: \n{all_voices}\n")
+    def __init__(self, audio_cache=None, synthesizer=None, voice_list_path=VOICE_LIST_PATH, stream_synthesizer=None, audio_manager=None):
+        # synthesizer(text, voice, model) -> mp3 bytes. The ElevenLabs API unless something else is passed in (benchmark_e2e.py uses a local stand-in)
+        self.synthesizer = synthesizer if synthesizer is not None else self._generate
+        # stream_synthesizer(text, voice, model) -> iterator of STREAM_OUTPUT_FORMAT chunks as they're synthesized.
+        # The ElevenLabs API by default, without one a passed in synthesizer's clips are "streamed" whole
+        if stream_synthesizer is None and synthesizer is None:
+          stream_synthesizer = self._generate_stream
+        self.stream_synthesizer = stream_synthesizer
+        # What text_to_audio_streamed() plays through, made on first use if it isn't passed in
+        self.audio_manager = audio_manager
+        # voice name -> elevenlabs Voice. generate() looks a voice name up with an API call unless it gets the Voice itself
+        self.voices = {}
+        if synthesizer is None:
+          api_key = os.getenv('ELEVENLABS_API_KEY')
+          if not api_key:
+            exit("Ooops! You forgot to set ELEVENLABS_API_KEY in your environment!")
+          from elevenlabs import set_api_key, Voice
+          set_api_key(api_key)
+          # The voice list hardly ever changes, so it's kept on disk for a day instead of fetched on every start
+          voice_list, source = load_voice_list(voice_list_path)
+          # Every voice comes with its settings, otherwise building the Voice would fetch them
+          self.voices = {voice["name"]: Voice(**voice) for voice in voice_list if voice.get("settings")}
+          print(f"{len(self.voices)} ElevenLabs voices ({source})")
+        # Every synthesized phrase is kept on disk, so repeats (confirmations, error messages, re-asked answers) skip the network
+        self.audio_cache = audio_cache if audio_cache is not None else TTSAudioCache()
 
     # Convert text to speech, then save it to file. Returns the file path
+    # Without a subdirectory the file belongs to the audio cache, so callers shouldn't delete it.
+    # With one, a copy is saved in that subdirectory of the current folder, like before the cache, and that copy is the caller's
     def text_to_audio(self, input_text, voice="Doug VO Only", save_as_wave=True, subdirectory=""):
-        audio_saved = generate(
+        file_format = "wav" if save_as_wave else "mp3"
+        tts_file = self.audio_cache.get_file(input_text, voice, ELEVENLABS_MODEL, file_format)
+        if not tts_file:
+          audio_saved = self.synthesizer(input_text, voice, ELEVENLABS_MODEL)
+          tts_file = self.audio_cache.put(input_text, voice, ELEVENLABS_MODEL, file_format, audio_saved)
+        if not subdirectory:
+          return tts_file
+        copied_file = os.path.join(os.path.abspath(os.curdir), subdirectory, f"___Msg{str(hash(input_text))}.{file_format}")
+        shutil.copyfile(tts_file, copied_file)
+        return copied_file
+
+    # Convert text to speech and return the mp3 bytes, so they can be played straight from memory
+    def text_to_audio_bytes(self, input_text, voice="Doug VO Only"):
+        audio = self.audio_cache.get_bytes(input_text, voice, ELEVENLABS_MODEL)
+        if audio is None:
+          audio = self.synthesizer(input_text, voice, ELEVENLABS_MODEL)
+          self.audio_cache.put(input_text, voice, ELEVENLABS_MODEL, "mp3", audio)
+        return audio
+
+    def text_to_audio_stream(self, input_text, voice="Doug VO Only"):
+        """
+        Starts synthesizing. Returns (chunks, audio format, sample rate) for AudioManager.open_stream() / play_stream(),
+        chunks being an iterator of the audio as it comes in. A stream that's read to the end goes into the audio cache,
+        and a phrase that's already in there comes back as a single chunk.
+        """
+        audio = self.audio_cache.get_bytes(input_text, voice, ELEVENLABS_MODEL, "pcm")
+        if audio is not None:
+          return [audio], "pcm", STREAM_SAMPLE_RATE
+        if self.stream_synthesizer is None:
+          return [self.text_to_audio_bytes(input_text, voice)], "mp3", None
+        audio = self.audio_cache.get_bytes(input_text, voice, ELEVENLABS_MODEL)
+        if audio is not None:
+          return [audio], "mp3", None
+        chunks = self.stream_synthesizer(input_text, voice, ELEVENLABS_MODEL)
+        return self._cache_when_complete(chunks, input_text, voice), "pcm", STREAM_SAMPLE_RATE
+
+    def _cache_when_complete(self, chunks, input_text, voice):
+        audio = bytearray()
+        for chunk in chunks:
+          audio += chunk
+          yield chunk
+        # Only reached if the whole stream was read, a stream that was cut off isn't cached
+        self.audio_cache.put(input_text, voice, ELEVENLABS_MODEL, "pcm", bytes(audio))
+
+    def _generate_stream(self, input_text, voice, model):
+        # The elevenlabs package's own streaming only does mp3, so this is its request with output_format added
+        from elevenlabs.api.base import API, api_base_url_v1
+        voice = self._find_voice(voice)
+        response = API.post(
+          f"{api_base_url_v1}/text-to-speech/{voice.voice_id}/stream",
+          json={"text": input_text, "model_id": model, "voice_settings": voice.settings.dict() if voice.settings else None},
+          params={"output_format": STREAM_OUTPUT_FORMAT},
+          stream=True
+        )
+        try:
+          for chunk in response.iter_content(chunk_size=4096):
+            if chunk:
+              yield chunk
+        finally:
+          response.close()
+
+    def _find_voice(self, voice):
+        if voice not in self.voices:
+          from elevenlabs import voices
+          found = next((v for v in voices() if v.name == voice), None)
+          if found is None:
+            raise ValueError(f"Voice '{voice}' not found.")
+          self.voices[voice] = found
+        return self.voices[voice]
+
+    def _generate(self, input_text, voice, model):
+        from elevenlabs import generate
+        return generate(
           text=input_text,
-          voice=voice,
-          model="eleven_monolingual_v1"
+          voice=self.voices.get(voice, voice),
+          model=model
         )
-        if save_as_wave:
-          file_name = f"___Msg{str(hash(input_text))}.wav"
-        else:
-          file_name = f"___Msg{str(hash(input_text))}.mp3"
-        tts_file = os.path.join(os.path.abspath(os.curdir), subdirectory, file_name)
-        save(audio_saved,tts_file)
-        return tts_file
 
     # Convert text to speech, then play it out loud
     def text_to_audio_played(self, input_text, voice="Doug VO Only"):
-        audio = generate(
-          text=input_text,
-          voice=voice,
-          model="eleven_monolingual_v1"
-        )
-        play(audio)
+        from elevenlabs import play
+        play(self.text_to_audio_bytes(input_text, voice))
 
     # Convert text to speech, then stream it out loud (don't need to wait for full speech to finish)
+    # Plays through the AudioManager as the audio comes in, returns the StreamPlayback once it's done playing
     def text_to_audio_streamed(self, input_text, voice="Doug VO Only"):
-        audio_stream = generate(
-          text=input_text,
-          voice=voice,
-          model="eleven_monolingual_v1",
-          stream=True
-        )
-        stream(audio_stream)
+        if self.audio_manager is None:
+          from audio_player import AudioManager
+          self.audio_manager = AudioManager()
+        chunks, audio_format, sample_rate = self.text_to_audio_stream(input_text, voice)
+        playback = self.audio_manager.play_stream(chunks, audio_format=audio_format, sample_rate=sample_rate)
+        playback.finished.result()
+        print(f"Streamed playback: {playback.stats()}")
+        return playback
 
 
 if __name__ == '__main__':
+    import tempfile
+
+    # The voice list is only fetched again once the saved copy is too old
+    test_dir = tempfile.mkdtemp()
+    try:
+        now = [1000.0]
+        fetches = []
+        def fake_fetch():
+            fetches.append(now[0])
+            return [{"voice_id": "a" * 20, "name": "Liam", "category": "premade", "settings": {"stability": 0.5, "similarity_boost": 0.75}}]
+        def failing_fetch():
+            raise ConnectionError("offline")
+        test_path = os.path.join(test_dir, "voices.json")
+        assert load_voice_list(test_path, 60, fake_fetch, lambda: now[0])[1] == "api"
+        assert load_voice_list(test_path, 60, fake_fetch, lambda: now[0])[1] == "cache" and len(fetches) == 1
+        now[0] += 61
+        assert load_voice_list(test_path, 60, failing_fetch, lambda: now[0]) == (fake_fetch(), "old cache")
+        assert load_voice_list(test_path, 60, fake_fetch, lambda: now[0])[1] == "api"
+        print("Voice list cache tests passed")
+
+        # With a subdirectory, the caller gets its own copy of the cached audio
+        offline_manager = ElevenLabsManager(TTSAudioCache(os.path.join(test_dir, "tts")), lambda text, voice, model: b"fake audio")
+        os.makedirs(os.path.join(test_dir, "out"))
+        cached_file = offline_manager.text_to_audio("Hello", "Liam")
+        copied_file = offline_manager.text_to_audio("Hello", "Liam", subdirectory=os.path.join(test_dir, "out"))
+        assert copied_file != cached_file and os.path.dirname(copied_file) == os.path.join(test_dir, "out")
+        os.remove(copied_file)
+        assert os.path.exists(cached_file) and offline_manager.audio_cache.stats()["hits"] == 1
+        offline_manager.audio_cache.flush()
+        print("Subdirectory copy test passed")
+    finally:
+        shutil.rmtree(test_dir)
+
     elevenlabs_manager = ElevenLabsManager()
 
     elevenlabs_manager.text_to_audio_streamed("This is my streamed test audio, I'm so much cooler than played", "Doug Melina")
@@ -57,6 +222,9 @@ if __name__ == '__main__':
     elevenlabs_manager.text_to_audio_played("This is my played test audio, helo hello", "Doug Melina")
     time.sleep(2)
     file_path = elevenlabs_manager.text_to_audio("This is my saved test audio, please make me beautiful", "Doug Melina")
+    # Same text again should come straight from the cache
+    file_path = elevenlabs_manager.text_to_audio("This is my saved test audio, please make me beautiful", "Doug Melina")
+    print(f"Audio cache stats: {elevenlabs_manager.audio_cache.stats()}")
     print("Finished with all tests")
 
     time.sleep(30)
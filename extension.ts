@@ -3,6 +3,21 @@ import WebSocket = require('ws');
 
 let ws: WebSocket | null = null;
 
+// The Python side keeps a copy of the active document (editor_context.py). It gets the whole text once,
+// then only the changes, batched for CHANGE_BATCH_MS so fast typing doesn't mean a message per keystroke.
+const MAX_MIRROR_CHARS = 5_000_000;
+const CHANGE_BATCH_MS = 50;
+let mirroredDocument: vscode.TextDocument | null = null;
+let mirroredVersion = 0;
+let mirroredCursorLine = -1;
+let pendingChanges: { range: vscode.Range; text: string }[] = [];
+let changeTimer: ReturnType<typeof setTimeout> | null = null;
+
+// Files created, changed or deleted in the workspace, so the Python side can re-index just those
+const FILE_CHANGE_BATCH_MS = 500;
+const changedPaths = new Set<string>();
+let fileChangeTimer: ReturnType<typeof setTimeout> | null = null;
+
 function connectWebSocket() {
     try {
         ws = new WebSocket('ws://localhost:5001', {
@@ -10,62 +25,40 @@ function connectWebSocket() {
         });
 
         ws.on('open', () => {
+            // Tell server.js we're the editor, so commands get routed to us
+            ws?.send(JSON.stringify({ type: 'hello', role: 'vscode' }));
+            sendWorkspace();
+            sendDocumentSnapshot();
             vscode.window.showInformationMessage('Connected to AI Assistant Server');
             console.log('Connected to WebSocket server');
         });
 
-        ws.on('message', (data: WebSocket.Data) => {
+        ws.on('message', async (data: WebSocket.Data) => {
+            let message: any;
             try {
                 console.log('Raw WebSocket message received:', data.toString());
-                const message = JSON.parse(data.toString());
+                message = JSON.parse(data.toString());
                 console.log('Parsed message:', message);
-                
-                if (message.command === 'insertGeneratedCode' && message.content) {
-                    console.log('Attempting to insert code:', message.content);
-                    const editor = vscode.window.activeTextEditor;
-                    if (editor) {
-                        console.log('Active editor found, inserting code...');
-                        editor.edit(editBuilder => {
-                            const position = editor.selection.active;
-                            editBuilder.insert(position, message.content);
-                        }).then(success => {
-                            console.log('Edit result:', success);
-                            if (success) {
-                                vscode.window.showInformationMessage('Code inserted!');
-                            }
-                        });
-                    } else {
-                        vscode.window.showErrorMessage('No active editor found. Please open a file first.');
-                    }
-                } else if (message.command === 'deleteLine') {
-                    console.log('Attempting to delete line');
-                    const editor = vscode.window.activeTextEditor;
-                    if (editor) {
-                        const selection = editor.selection;
-                        const lineToDelete = selection.active.line;
-                        
-                        editor.edit(editBuilder => {
-                            // Create a range that includes the line break
-                            const range = editor.document.validateRange(
-                                new vscode.Range(
-                                    lineToDelete, 0,
-                                    lineToDelete + 1, 0
-                                )
-                            );
-                            editBuilder.delete(range);
-                        }).then(success => {
-                            console.log('Delete line result:', success);
-                            if (success) {
-                                vscode.window.showInformationMessage('Line deleted!');
-                            }
-                        });
-                    } else {
-                        vscode.window.showErrorMessage('No active editor found. Please open a file first.');
-                    }
-                }
             } catch (error) {
-                console.error('Error processing WebSocket message:', error);
-                vscode.window.showErrorMessage('An error occurred while processing the WebSocket message.');
+                console.error('Error parsing WebSocket message:', error);
+                return;
+            }
+
+            if (message.type === 'resync') {
+                sendWorkspace();
+                sendDocumentSnapshot();
+                return;
+            }
+
+            // Edits are applied one at a time, in the order they came in, so a session's bookkeeping is always up to date
+            const previousCommand = commandChain;
+            let commandDone!: () => void;
+            commandChain = new Promise<void>(resolve => commandDone = resolve);
+            await previousCommand;
+            try {
+                await handleCommandMessage(message);
+            } finally {
+                commandDone();
             }
         }); 
 
@@ -84,12 +77,344 @@ function connectWebSocket() {
     }
 }
 
+// The command being applied right now, the next one waits for it
+let commandChain: Promise<void> = Promise.resolve();
+
+async function handleCommandMessage(message: any) {
+    // The answer is done, nothing more joins its undo step
+    if (message.type === 'endSession') {
+        await endEditSession(message.session);
+        return;
+    }
+
+    // Every command is answered with an ack (or nack), so the Python side knows whether the edit landed
+    const startedAt = Date.now();
+    try {
+        const success = await applyCommand(message);
+        sendAck(message.id, success, Date.now() - startedAt, success ? undefined : 'VS Code rejected the edit');
+    } catch (error) {
+        const errorMessage = error instanceof Error ? error.message : String(error);
+        console.error('Error processing WebSocket message:', error);
+        vscode.window.showErrorMessage('An error occurred while processing the WebSocket message.');
+        sendAck(message.id, false, Date.now() - startedAt, errorMessage);
+    }
+}
+
+function sendAck(id: string | undefined, ok: boolean, applyMs: number, error?: string) {
+    if (!id || !ws || ws.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    ws.send(JSON.stringify({ type: 'ack', id, ok, applyMs, error }));
+}
+
+// One edit, lines are 1-based and refer to the document as it was before any edit in the batch. No line means the cursor.
+interface EditOperation {
+    op: 'insert' | 'replaceLine' | 'deleteLine';
+    line?: number | null;
+    content?: string | null;
+}
+
+// The Python side sends an answer's edits one by one, as soon as each code block is complete, all with the same session.
+// Their line numbers still refer to the document before the first one, so we remember how earlier edits moved the lines.
+interface EditSession {
+    document: vscode.TextDocument;
+    // Original (0-based) lines from fromLine on have moved by delta
+    lineShifts: { fromLine: number; delta: number }[];
+    changedLines: Set<number>;
+    appliedBatches: number;
+    // Where the cursor was (0-based, in the original document) when the first batch came in. Edits at the cursor
+    // are recorded as edits at this line, they move the lines below it like any other edit.
+    cursorLine: number | null;
+}
+
+const MAX_EDIT_SESSIONS = 20;
+const editSessions = new Map<string, EditSession>();
+
+function getEditSession(id: string | undefined, document: vscode.TextDocument): EditSession | undefined {
+    if (!id) {
+        return undefined;
+    }
+    let session = editSessions.get(id);
+    if (!session) {
+        session = { document, lineShifts: [], changedLines: new Set<number>(), appliedBatches: 0, cursorLine: null };
+        editSessions.set(id, session);
+        // Old answers are done with, forget them
+        if (editSessions.size > MAX_EDIT_SESSIONS) {
+            editSessions.delete(editSessions.keys().next().value!);
+        }
+    } else if (session.document !== document) {
+        throw new Error('This answer\'s earlier edits went to another file');
+    }
+    return session;
+}
+
+// Closes the answer's undo step, so whatever the user types next is undone separately from the AI's edits
+async function endEditSession(id: string | undefined) {
+    const session = id ? editSessions.get(id) : undefined;
+    if (!session) {
+        return;
+    }
+    editSessions.delete(id!);
+    const editor = vscode.window.visibleTextEditors.find(editor => editor.document === session.document);
+    if (!editor || session.appliedBatches === 0) {
+        return;
+    }
+    try {
+        // An edit with nothing in it, only for the undo stop after it
+        await editor.edit(() => { }, { undoStopBefore: false, undoStopAfter: true });
+    } catch (error) {
+        console.error('Couldn\'t close the undo step of the AI\'s edits:', error);
+    }
+}
+
+async function applyCommand(message: any): Promise<boolean> {
+    const editor = vscode.window.activeTextEditor;
+    if (!editor) {
+        vscode.window.showErrorMessage('No active editor found. Please open a file first.');
+        throw new Error('No file is open in VS Code');
+    }
+
+    // Single commands are just batches of one
+    let operations: EditOperation[];
+    if (message.command === 'batch') {
+        operations = message.content || [];
+    } else if (message.command === 'insertGeneratedCode') {
+        operations = [{ op: 'insert', content: message.content }];
+    } else if (message.command === 'editLine') {
+        operations = [{ op: 'replaceLine', content: message.content }];
+    } else if (message.command === 'deleteLine') {
+        operations = [{ op: 'deleteLine' }];
+    } else {
+        throw new Error(`The extension can't do ${message.command} yet`);
+    }
+
+    console.log('Applying edits:', operations);
+    const success = await applyOperations(editor, operations, getEditSession(message.session, editor.document));
+    console.log('Edit result:', success);
+    if (success) {
+        vscode.window.showInformationMessage(operations.length === 1 ? 'Code updated!' : `Applied ${operations.length} changes!`);
+    }
+    return success;
+}
+
+async function applyOperations(editor: vscode.TextEditor, operations: EditOperation[], session?: EditSession): Promise<boolean> {
+    const document = editor.document;
+    const cursor = editor.selection.active;
+    if (session && session.cursorLine === null) {
+        session.cursorLine = cursor.line;
+    }
+    // Lines changed earlier in the session count too, nothing in one answer may change a line twice
+    const changedLines = new Set<number>(session ? session.changedLines : []);
+
+    // Check everything before touching the document, so a bad batch changes nothing
+    const resolved = operations.map(operation => {
+        // Where the edit is in the original document. At the cursor, that's the line the cursor was on when the session started.
+        const originalLine = operation.line ? operation.line - 1 : (session ? session.cursorLine! : cursor.line);
+        const line = !operation.line ? cursor.line : (session ? shiftLine(session, originalLine) : originalLine);
+        const lastLine = operation.op === 'insert' ? document.lineCount : document.lineCount - 1;
+        if (line < 0 || line > lastLine) {
+            throw new Error(`Line ${originalLine + 1} is outside the file, which has ${document.lineCount} lines`);
+        }
+        if (operation.op !== 'deleteLine' && !operation.content) {
+            throw new Error('There was no code to insert');
+        }
+        if (operation.op !== 'insert') {
+            if (changedLines.has(originalLine)) {
+                throw new Error(`Line ${originalLine + 1} is changed twice in the same answer`);
+            }
+            changedLines.add(originalLine);
+        }
+        return { ...operation, line, originalLine, atCursor: !operation.line };
+    });
+
+    // A single editor.edit, so the whole batch is one undo step. The later batches of a session join the first one's undo step.
+    const undoOptions = session ? { undoStopBefore: session.appliedBatches === 0, undoStopAfter: false } : undefined;
+    const success = await editor.edit(editBuilder => {
+        for (const operation of resolved) {
+            if (operation.op === 'insert') {
+                if (operation.atCursor) {
+                    editBuilder.insert(cursor, operation.content!);
+                } else {
+                    // With a line number, the code goes in above that line, as whole lines
+                    const content = operation.content!.endsWith('\n') ? operation.content! : operation.content! + '\n';
+                    editBuilder.insert(new vscode.Position(operation.line, 0), content);
+                }
+            } else if (operation.op === 'replaceLine') {
+                editBuilder.replace(document.lineAt(operation.line).range, operation.content!);
+            } else {
+                // Create a range that includes the line break
+                const range = document.validateRange(
+                    new vscode.Range(
+                        operation.line, 0,
+                        operation.line + 1, 0
+                    )
+                );
+                editBuilder.delete(range);
+            }
+        }
+    }, undoOptions);
+
+    if (success && session) {
+        session.changedLines = changedLines;
+        session.appliedBatches++;
+        for (const operation of resolved) {
+            if (operation.op === 'insert' && operation.atCursor) {
+                // Inserted into the cursor's line, the lines below it move down by however many line breaks came with it
+                session.lineShifts.push({ fromLine: operation.originalLine + 1, delta: operation.content!.split('\n').length - 1 });
+            } else if (operation.op === 'insert') {
+                session.lineShifts.push({ fromLine: operation.originalLine, delta: countLines(operation.content!) });
+            } else if (operation.op === 'replaceLine') {
+                // The line is replaced with the content exactly as it is
+                session.lineShifts.push({ fromLine: operation.originalLine + 1, delta: operation.content!.split('\n').length - 1 });
+            } else {
+                session.lineShifts.push({ fromLine: operation.originalLine + 1, delta: -1 });
+            }
+        }
+    }
+    return success;
+}
+
+// Where an original line of the session's document is now
+function shiftLine(session: EditSession, originalLine: number): number {
+    let line = originalLine;
+    for (const shift of session.lineShifts) {
+        if (shift.fromLine <= originalLine) {
+            line += shift.delta;
+        }
+    }
+    return line;
+}
+
+// Lines an insert at a line number adds (it always adds whole lines)
+function countLines(content: string): number {
+    return (content.endsWith('\n') ? content.slice(0, -1) : content).split('\n').length;
+}
+
+function sendMessage(message: object) {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify(message));
+    }
+}
+
+function sendDocumentSnapshot() {
+    pendingChanges = [];
+    if (changeTimer) {
+        clearTimeout(changeTimer);
+        changeTimer = null;
+    }
+    const editor = vscode.window.activeTextEditor;
+    if (!editor) {
+        mirroredDocument = null;
+        return;
+    }
+    const document = editor.document;
+    const text = document.getText();
+    mirroredDocument = document;
+    mirroredVersion = document.version;
+    mirroredCursorLine = editor.selection.active.line;
+    sendMessage({
+        type: 'document',
+        uri: document.uri.toString(),
+        languageId: document.languageId,
+        version: document.version,
+        // Python is only told about files too big to copy
+        text: text.length > MAX_MIRROR_CHARS ? null : text,
+        lineCount: document.lineCount,
+        cursorLine: mirroredCursorLine
+    });
+}
+
+function onDocumentChanged(event: vscode.TextDocumentChangeEvent) {
+    if (event.document !== mirroredDocument || event.contentChanges.length === 0) {
+        return;
+    }
+    // Changes in one event apply one after another, so they're kept in order
+    for (const change of event.contentChanges) {
+        pendingChanges.push({ range: change.range, text: change.text });
+    }
+    if (!changeTimer) {
+        changeTimer = setTimeout(flushDocumentChanges, CHANGE_BATCH_MS);
+    }
+}
+
+function flushDocumentChanges() {
+    if (changeTimer) {
+        clearTimeout(changeTimer);
+        changeTimer = null;
+    }
+    if (!mirroredDocument || pendingChanges.length === 0) {
+        return;
+    }
+    sendMessage({
+        type: 'documentChange',
+        uri: mirroredDocument.uri.toString(),
+        fromVersion: mirroredVersion,
+        version: mirroredDocument.version,
+        changes: pendingChanges.map(change => ({
+            range: {
+                start: { line: change.range.start.line, character: change.range.start.character },
+                end: { line: change.range.end.line, character: change.range.end.character }
+            },
+            text: change.text
+        }))
+    });
+    mirroredVersion = mirroredDocument.version;
+    pendingChanges = [];
+}
+
+function onSelectionChanged(event: vscode.TextEditorSelectionChangeEvent) {
+    const line = event.selections[0].active.line;
+    if (event.textEditor.document !== mirroredDocument || line === mirroredCursorLine) {
+        return;
+    }
+    mirroredCursorLine = line;
+    // The cursor line only makes sense after the changes that came before it
+    flushDocumentChanges();
+    sendMessage({ type: 'cursor', uri: event.textEditor.document.uri.toString(), line });
+}
+
+function sendWorkspace() {
+    const folders = (vscode.workspace.workspaceFolders || []).map(folder => folder.uri.fsPath);
+    sendMessage({ type: 'workspace', folders });
+}
+
+function onFileChanged(uri: vscode.Uri) {
+    if (uri.scheme !== 'file') {
+        return;
+    }
+    changedPaths.add(uri.fsPath);
+    if (!fileChangeTimer) {
+        fileChangeTimer = setTimeout(() => {
+            fileChangeTimer = null;
+            sendMessage({ type: 'filesChanged', paths: Array.from(changedPaths) });
+            changedPaths.clear();
+        }, FILE_CHANGE_BATCH_MS);
+    }
+}
+
 export function activate(context: vscode.ExtensionContext) {
     console.log('AI Assistant extension is now active!');
     
     // Initial connection
     connectWebSocket();
 
+    // Keep the Python side's copy of the open file up to date
+    context.subscriptions.push(
+        vscode.window.onDidChangeActiveTextEditor(() => sendDocumentSnapshot()),
+        vscode.workspace.onDidChangeTextDocument(onDocumentChanged),
+        vscode.window.onDidChangeTextEditorSelection(onSelectionChanged)
+    );
+
+    // Keep the Python side's workspace index up to date
+    const fileWatcher = vscode.workspace.createFileSystemWatcher('**/*');
+    context.subscriptions.push(
+        fileWatcher,
+        fileWatcher.onDidCreate(onFileChanged),
+        fileWatcher.onDidChange(onFileChanged),
+        fileWatcher.onDidDelete(onFileChanged),
+        vscode.workspace.onDidChangeWorkspaceFolders(() => sendWorkspace())
+    );
+
     // Register reconnect command
     let disposable = vscode.commands.registerCommand('ai-assistant.reconnect', () => {
         if (ws) {
@@ -0,0 +1,258 @@
+import time
+import threading
+from rich import print
+
+SUMMARY_PREFIX = "Summary of the earlier conversation (older messages were folded into it):\n"
+SUMMARIZER_PROMPT = (
+    "You keep a running summary of a conversation between a developer and their voice coding assistant. "
+    "Update the summary with the new messages. Keep file names, function names, line numbers, decisions, open tasks and the "
+    "developer's preferences; drop small talk and code that was already applied. Write plain sentences, at most {max_words} words."
+)
+
+
+class HistoryCompactor:
+    """
+    Keeps the chat history small by folding old messages into one running summary message, instead of dropping them.
+    Once the history goes over trigger_tokens, the oldest messages (never the system prompt or the last keep_recent_messages)
+    are handed to the summarizer together with the summary so far, until the history is back around target_tokens.
+    The summary sits right after the system prompt. Summarizing is slow (a GPT call), so maybe_compact does it on a background
+    thread, and the history is only locked to pick the messages and to swap them for the new summary.
+
+    Parameters:
+    history (TokenCountedHistory): the history to compact, system prompt first
+    summarizer (callable): summarizer(previous_summary, messages) -> new summary text (e.g. GptSummarizer, ExtractiveSummarizer)
+    lock (threading.RLock): held by everything else that changes the history
+    trigger_tokens (int): compact once the history is bigger than this
+    target_tokens (int): fold old messages until the history would be about this big
+    keep_recent_messages (int): the newest messages are always kept word for word
+    """
+
+    def __init__(self, history, summarizer, lock=None, trigger_tokens=4000, target_tokens=2500, keep_recent_messages=6):
+        self.history = history
+        self.summarizer = summarizer
+        self.lock = lock if lock is not None else threading.RLock()
+        self.trigger_tokens = trigger_tokens
+        self.target_tokens = target_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_message = None
+        self.summary_text = ""
+        self.thread = None
+        self.compactions = 0
+        self.folded_messages = 0
+        self.failures = 0
+        self.last_compaction_ms = None
+
+    def first_foldable_index(self):
+        """Index of the oldest message that may be folded (or dropped): after the system prompt and the summary"""
+        with self.lock:
+            if len(self.history) > 1 and self.history[1] is self.summary_message:
+                return 2
+            return 1
+
+    def restore_summary(self):
+        """After the history was restored from disk: picks up the summary message it starts with, if there is one"""
+        with self.lock:
+            if len(self.history) > 1 and self.history[1]["role"] == "system" and self.history[1]["content"].startswith(SUMMARY_PREFIX):
+                self.summary_message = self.history[1]
+                self.summary_text = self.summary_message["content"][len(SUMMARY_PREFIX):]
+                return True
+            return False
+
+    def needs_compaction(self):
+        with self.lock:
+            foldable = len(self.history) - self.keep_recent_messages - self.first_foldable_index()
+            return self.history.total_tokens > self.trigger_tokens and foldable > 0
+
+    def maybe_compact(self):
+        """Starts compacting on a background thread if the history is too big (and it isn't already being compacted)"""
+        if not self.needs_compaction() or (self.thread is not None and self.thread.is_alive()):
+            return False
+        self.thread = threading.Thread(target=self.compact, name="history-compactor", daemon=True)
+        self.thread.start()
+        return True
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def compact(self):
+        """Folds the oldest messages into the summary. Returns True if the history was compacted."""
+        start_time = time.perf_counter()
+        with self.lock:
+            start = self.first_foldable_index()
+            end = len(self.history) - self.keep_recent_messages
+            tokens = self.history.total_tokens
+            fold_count = 0
+            while start + fold_count < end and tokens > self.target_tokens:
+                tokens -= self.history.message_tokens[start + fold_count]
+                fold_count += 1
+            if fold_count == 0:
+                return False
+            folded = list(self.history[start:start + fold_count])
+            previous_summary = self.summary_text
+
+        try:
+            new_summary = self.summarizer(previous_summary, folded)
+        except Exception as e:
+            # The history just stays as it is, _trim_chat_history still keeps requests under the limit
+            self.failures += 1
+            print(f"[red]Couldn't summarize the older messages: {e}")
+            return False
+
+        with self.lock:
+            # Meanwhile the history may have been trimmed (or replaced), then these messages aren't where we left them
+            current = self.history[start:start + fold_count]
+            if self.first_foldable_index() != start or len(current) != fold_count or any(a is not b for a, b in zip(current, folded)):
+                return False
+            summary_message = {"role": "system", "content": SUMMARY_PREFIX + new_summary}
+            del self.history[start:start + fold_count]
+            if start == 2:
+                self.history[1] = summary_message
+            else:
+                self.history.insert(1, summary_message)
+            self.summary_message = summary_message
+            self.summary_text = new_summary
+            self.compactions += 1
+            self.folded_messages += fold_count
+            self.last_compaction_ms = (time.perf_counter() - start_time) * 1000
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "compactions": self.compactions,
+                "folded_messages": self.folded_messages,
+                "failures": self.failures,
+                "summary_tokens": self.history.message_tokens[1] if self.first_foldable_index() == 2 else 0,
+                "last_compaction_ms": self.last_compaction_ms,
+            }
+
+
+def format_transcript(messages):
+    return "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+
+
+class GptSummarizer:
+    """
+    Summarizes with a chat completion.
+
+    Parameters:
+    client: OpenAI client
+    model (str): model for the summaries
+    max_words (int): how long the summary may get
+    """
+
+    def __init__(self, client, model="gpt-4o", max_words=250):
+        self.client = client
+        self.model = model
+        self.max_words = max_words
+
+    def __call__(self, previous_summary, messages):
+        completion = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": SUMMARIZER_PROMPT.format(max_words=self.max_words)},
+                {"role": "user", "content": f"Summary so far:\n{previous_summary or '(nothing yet)'}\n\nNew messages:\n{format_transcript(messages)}"},
+            ],
+            max_tokens=self.max_words * 2,
+        )
+        return completion.choices[0].message.content.strip()
+
+
+class ExtractiveSummarizer:
+    """
+    Local stand-in for tests and offline use: keeps the first sentence of each folded message.
+    When the summary gets longer than max_lines, lines are dropped from the middle, so the start of the session
+    (what the project is, what the user wants) and the latest folded messages are both kept.
+    """
+
+    def __init__(self, max_lines=30, max_line_chars=160):
+        self.max_lines = max_lines
+        self.max_line_chars = max_line_chars
+        self.calls = 0
+
+    def __call__(self, previous_summary, messages):
+        self.calls += 1
+        lines = previous_summary.split("\n") if previous_summary else []
+        for message in messages:
+            first_sentence = message["content"].strip().split("\n")[0].split(". ")[0]
+            lines.append(f"{message['role']}: {first_sentence[:self.max_line_chars]}")
+        if len(lines) > self.max_lines:
+            keep_start = self.max_lines // 3
+            lines = lines[:keep_start] + lines[len(lines) - (self.max_lines - keep_start):]
+        return "\n".join(lines)
+
+
+# Tests and measurement: prompt tokens per turn over a scripted 200 turn session, dropping old turns vs compacting them
+if __name__ == '__main__':
+    import random
+    from token_budget import TokenCountedHistory
+    from latency_histogram import LatencyHistogram
+
+    rng = random.Random(0)
+    topics = ["parser", "websocket", "audio", "tokenizer", "index", "cache", "journal", "settings", "tests", "prompt"]
+
+    def scripted_turn(turn_number):
+        if turn_number == 0:
+            return "My project is called Zephyr. Please always use type hints.", "Got it, Zephyr with type hints everywhere."
+        topic = rng.choice(topics)
+        question = f"Turn {turn_number}: can you improve the {topic} code. " + " ".join(rng.choice(topics) for _ in range(rng.randint(20, 60)))
+        answer = f"Sure, here is how I'd change the {topic}. " + " ".join(rng.choice(topics) for _ in range(rng.randint(80, 300)))
+        return question, answer
+
+    def run_session(compactor_factory, turns=200, limit=8000):
+        history = TokenCountedHistory([{"role": "system", "content": "You are a coding assistant. " * 20}])
+        compactor = compactor_factory(history) if compactor_factory else None
+        prompt_tokens = LatencyHistogram(buckets_ms=(1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000))
+        rng.seed(0)
+        for turn_number in range(turns):
+            question, answer = scripted_turn(turn_number)
+            history.append({"role": "user", "content": question})
+            # Same hard limit as OpenAiManager._trim_chat_history
+            first_droppable = compactor.first_foldable_index() if compactor else 1
+            while history.total_tokens > limit and len(history) > first_droppable:
+                history.pop(first_droppable)
+            prompt_tokens.record(history.total_tokens)
+            history.append({"role": "assistant", "content": answer})
+            if compactor:
+                compactor.maybe_compact()
+                # A real session has the whole spoken answer and the user's next question to finish in
+                compactor.wait()
+        return history, compactor, prompt_tokens.summary()
+
+    history, _, dropping = run_session(None)
+    assert not any("Zephyr" in message["content"] for message in history)
+    summarizer = ExtractiveSummarizer()
+    history, compactor, compacting = run_session(lambda history: HistoryCompactor(history, summarizer))
+    assert history[1] is compactor.summary_message and "Zephyr" in history[1]["content"]
+    assert compacting["max_ms"] <= 8000 and compacting["mean_ms"] < dropping["mean_ms"]
+    print(f"[green]Dropping old turns:   mean {dropping['mean_ms']:.0f} prompt tokens per turn, p95 {dropping['p95_ms']:.0f}, "
+          f"total {dropping['mean_ms'] * dropping['count']:.0f} over {dropping['count']} turns, the first turn is forgotten")
+    print(f"[green]Compacting old turns: mean {compacting['mean_ms']:.0f} prompt tokens per turn, p95 {compacting['p95_ms']:.0f}, "
+          f"total {compacting['mean_ms'] * compacting['count']:.0f} over {compacting['count']} turns, the first turn is in the summary")
+    print(f"[green]Compactor stats: {compactor.stats()}, {summarizer.calls} summarizer calls")
+
+    # A history restored from disk keeps its summary where it is
+    restored_history = TokenCountedHistory(history)
+    restored_compactor = HistoryCompactor(restored_history, summarizer)
+    assert restored_compactor.restore_summary() and restored_compactor.first_foldable_index() == 2
+    assert restored_compactor.summary_text == compactor.summary_text
+
+    # A failing summarizer leaves the history alone
+    history = TokenCountedHistory([{"role": "system", "content": "system"}] + [{"role": "user", "content": f"message {i} " + "word " * 500} for i in range(12)])
+
+    def broken_summarizer(previous_summary, messages):
+        raise RuntimeError("offline")
+
+    compactor = HistoryCompactor(history, broken_summarizer)
+    assert not compactor.compact() and len(history) == 13 and compactor.failures == 1
+
+    # Messages trimmed away while the summary was being written aren't folded in twice
+    def slow_summarizer(previous_summary, messages):
+        with compactor.lock:
+            history.pop(1)
+        return "summary"
+
+    compactor = HistoryCompactor(history, slow_summarizer)
+    assert not compactor.compact() and compactor.summary_message is None
+    print("[green]Failed or outdated summaries leave the history as it was")
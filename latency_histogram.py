@@ -0,0 +1,81 @@
+import math
+import bisect
+import threading
+from collections import deque
+
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class LatencyHistogram:
+    """
+    Collects latencies in milliseconds. Counts go into fixed buckets (cheap, covers the whole run), and the most recent
+    samples are kept too, so p50/p95/p99 are exact for recent traffic.
+
+    Parameters:
+    buckets_ms (tuple): upper bounds of the buckets, anything above the last one goes into an overflow bucket
+    max_samples (int): how many recent samples the percentiles are computed from
+    """
+
+    def __init__(self, buckets_ms=DEFAULT_BUCKETS_MS, max_samples=1000):
+        self.buckets_ms = tuple(buckets_ms)
+        self.bucket_counts = [0] * (len(self.buckets_ms) + 1)
+        self.samples = deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+
+    def record(self, latency_ms):
+        with self.lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets_ms, latency_ms)] += 1
+            self.samples.append(latency_ms)
+            self.count += 1
+            self.total_ms += latency_ms
+            self.min_ms = latency_ms if self.min_ms is None else min(self.min_ms, latency_ms)
+            self.max_ms = latency_ms if self.max_ms is None else max(self.max_ms, latency_ms)
+
+    def percentile(self, percent):
+        """Nearest-rank percentile of the recent samples, None if nothing was recorded"""
+        with self.lock:
+            samples = sorted(self.samples)
+        return self._nearest_rank(samples, percent)
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            bucket_counts = list(self.bucket_counts)
+            summary = {
+                "count": self.count,
+                "mean_ms": self.total_ms / self.count if self.count else None,
+                "min_ms": self.min_ms,
+                "max_ms": self.max_ms,
+            }
+        summary["p50_ms"] = self._nearest_rank(samples, 50)
+        summary["p95_ms"] = self._nearest_rank(samples, 95)
+        summary["p99_ms"] = self._nearest_rank(samples, 99)
+        labels = [f"<={bound}ms" for bound in self.buckets_ms] + [f">{self.buckets_ms[-1]}ms"]
+        summary["buckets"] = {label: count for label, count in zip(labels, bucket_counts) if count}
+        return summary
+
+    @staticmethod
+    def _nearest_rank(sorted_samples, percent):
+        if not sorted_samples:
+            return None
+        rank = max(1, math.ceil(percent / 100 * len(sorted_samples)))
+        return sorted_samples[rank - 1]
+
+
+# Tests
+if __name__ == '__main__':
+    histogram = LatencyHistogram()
+    assert histogram.summary()["p50_ms"] is None
+    for latency_ms in range(1, 101):
+        histogram.record(latency_ms)
+    summary = histogram.summary()
+    assert summary["count"] == 100 and summary["p50_ms"] == 50 and summary["p95_ms"] == 95 and summary["p99_ms"] == 99
+    assert summary["min_ms"] == 1 and summary["max_ms"] == 100 and summary["mean_ms"] == 50.5
+    assert sum(summary["buckets"].values()) == 100 and summary["buckets"]["<=1ms"] == 1
+    histogram.record(60000)
+    assert histogram.summary()["buckets"][">30000ms"] == 1
+    print(f"Histogram summary: {histogram.summary()}")
@@ -0,0 +1,189 @@
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from latency_histogram import LatencyHistogram, DEFAULT_BUCKETS_MS
+
+# Spans worked out from a turn's marks once it's done: (span, from mark, to mark). A span is skipped if either mark is missing.
+TURN_SPANS = (
+    ("stop_to_transcript", "stop", "transcript"),
+    ("transcript_to_first_token", "prompt", "first_token"),
+    ("first_token_to_first_audio", "first_token", "first_audio"),
+    ("prompt_to_first_audio", "prompt", "first_audio"),
+    ("answer_stream", "first_token", "answer_done"),
+    ("turn", "start", "done"),
+)
+
+
+class TurnTrace:
+    """
+    The marks (perf_counter timestamps) of one turn. Only the first time a mark is set counts, so "first_token"
+    can be marked on every delta. finish() turns the marks into TURN_SPANS and hands them to the tracer.
+    """
+
+    def __init__(self, tracer, turn_id):
+        self.tracer = tracer
+        self.turn_id = turn_id
+        self.marks = {}
+        self.status = None
+
+    def mark(self, name, at=None):
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() if at is None else at
+
+    def finish(self, status="done"):
+        self.mark("done")
+        self.status = status
+        spans = {}
+        for span, start_mark, end_mark in TURN_SPANS:
+            if start_mark in self.marks and end_mark in self.marks:
+                spans[span] = (self.marks[end_mark] - self.marks[start_mark]) * 1000
+        self.tracer._finish_turn(self, spans)
+        return spans
+
+
+class LatencyTracer:
+    """
+    Where a turn spends its time. Two kinds of spans go into one LatencyHistogram each (p50/p95/p99 over the recent samples):
+    per-turn spans from the marks on a TurnTrace (stop -> transcript -> first GPT token -> first audio, see TURN_SPANS),
+    and stage spans timed directly with span() / record() (listening, each TTS sentence, sending a command, the editor's ack).
+    Recording is a perf_counter call and a histogram update, cheap enough to always leave on.
+    The last max_turns turns are kept with their spans for export().
+
+    Parameters:
+    max_turns (int): how many finished turns export() includes
+    buckets_ms (tuple): histogram buckets for every span
+    """
+
+    def __init__(self, max_turns=200, buckets_ms=DEFAULT_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.turns = deque(maxlen=max_turns)
+
+    def start_turn(self, turn_id):
+        trace = TurnTrace(self, turn_id)
+        trace.mark("start")
+        return trace
+
+    def record(self, name, latency_ms):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, LatencyHistogram(self.buckets_ms))
+        histogram.record(latency_ms)
+
+    @contextmanager
+    def span(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start_time) * 1000)
+
+    def traced(self, name, function):
+        """function, but every call is recorded as a span"""
+        def traced_function(*args, **kwargs):
+            with self.span(name):
+                return function(*args, **kwargs)
+        return traced_function
+
+    def summary(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {name: histogram.summary() for name, histogram in sorted(histograms.items())}
+
+    def export(self, path=None):
+        """Every span's summary plus the recent turns, as a dict. Written to path as JSON if one is given."""
+        with self.lock:
+            turns = list(self.turns)
+        data = {"spans": self.summary(), "turns": turns}
+        if path is not None:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(data, file, indent=2)
+        return data
+
+    def format_summary(self):
+        return format_summary(self.summary())
+
+    def _finish_turn(self, trace, spans):
+        for name, latency_ms in spans.items():
+            self.record(name, latency_ms)
+        with self.lock:
+            self.turns.append({"turn_id": trace.turn_id, "status": trace.status,
+                               "spans": {name: round(latency_ms, 1) for name, latency_ms in spans.items()}})
+
+
+def format_summary(span_summaries):
+    """A table of span summaries (as in LatencyTracer.summary() or an export's "spans"), one span per line"""
+    def cell(value):
+        return "-" if value is None else f"{value:.0f}" if value >= 10 else f"{value:.1f}"
+
+    turn_span_names = [name for name, _, _ in TURN_SPANS]
+    names = [name for name in turn_span_names if name in span_summaries] + \
+            [name for name in span_summaries if name not in turn_span_names]
+    width = max([len(name) for name in names] + [4])
+    lines = [f"{'span':<{width}} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+    for name in names:
+        summary = span_summaries[name]
+        lines.append(f"{name:<{width}} {summary['count']:>6} {cell(summary['p50_ms']):>8} {cell(summary['p95_ms']):>8} "
+                     f"{cell(summary['p99_ms']):>8} {cell(summary['max_ms']):>8}")
+    return "\n".join(lines)
+
+
+# Prints the summary of an exported trace: python latency_tracer.py latency_trace.json
+# Without a file, runs the tests
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r", encoding="utf-8") as file:
+            exported = json.load(file)
+        print(format_summary(exported["spans"]))
+        print(f"{len(exported['turns'])} turns in the trace")
+        sys.exit(0)
+
+    import os
+    import tempfile
+
+    tracer = LatencyTracer()
+    trace = tracer.start_turn(1)
+    trace.mark("stop", at=trace.marks["start"] + 0.1)
+    trace.mark("transcript", at=trace.marks["start"] + 0.4)
+    trace.mark("prompt", at=trace.marks["start"] + 0.4)
+    trace.mark("first_token", at=trace.marks["start"] + 1.0)
+    trace.mark("first_token", at=trace.marks["start"] + 5.0)  # only the first one counts
+    trace.mark("first_audio", at=trace.marks["start"] + 1.5)
+    spans = trace.finish()
+    assert round(spans["stop_to_transcript"]) == 300 and round(spans["transcript_to_first_token"]) == 600, spans
+    assert round(spans["first_token_to_first_audio"]) == 500 and "answer_stream" not in spans, spans
+    with tracer.span("tts_sentence"):
+        time.sleep(0.01)
+    assert tracer.summary()["tts_sentence"]["count"] == 1 and tracer.summary()["tts_sentence"]["p50_ms"] >= 10
+
+    export_path = os.path.join(tempfile.mkdtemp(), "latency_trace.json")
+    tracer.export(export_path)
+    with open(export_path, "r", encoding="utf-8") as file:
+        exported = json.load(file)
+    assert exported["turns"][0]["spans"]["transcript_to_first_token"] == 600.0
+    print(format_summary(exported["spans"]))
+
+    # Overhead: what tracing adds to every span and every turn
+    tracer = LatencyTracer()
+    count = 100000
+    start = time.perf_counter()
+    for _ in range(count):
+        with tracer.span("send_command"):
+            pass
+    span_us = (time.perf_counter() - start) / count * 1e6
+    start = time.perf_counter()
+    for turn_id in range(count // 10):
+        trace = tracer.start_turn(turn_id)
+        for mark in ("stop", "transcript", "prompt", "first_token", "first_audio", "answer_done"):
+            trace.mark(mark)
+        trace.finish()
+    turn_us = (time.perf_counter() - start) / (count // 10) * 1e6
+    start = time.perf_counter()
+    summary = tracer.summary()
+    summary_ms = (time.perf_counter() - start) * 1000
+    print(f"Overhead: {span_us:.2f} µs per span, {turn_us:.1f} µs per traced turn, {summary_ms:.1f} ms for a summary")
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class LocalWebSocketServer:
+    """
+    Tiny WebSocket server that runs in-process, on the standard library only.
+    Handy for trying the editor link without starting server.js and VS Code: it can be killed and restarted mid-session,
+    or told to stop answering pings to act like a peer that hung.
+
+    Parameters:
+    port (int): 0 picks a free port, see self.port once started
+    on_message (callable): on_message(server, client, text) for every text message received
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, on_message=None):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.answer_pings = True
+        self.received = []
+        self.lock = threading.Lock()
+        self.clients = []
+        self.listener = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen()
+        # Keep the same port when restarting, so clients can find us again
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept_loop, args=(self.listener,), daemon=True).start()
+        return self
+
+    def stop(self):
+        """Kills the server and every connection without a close handshake, like a crashed server.js"""
+        if self.listener is not None:
+            try:
+                # Wakes up the accept() call, closing alone doesn't on Linux
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            self.listener = None
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+
+    def send(self, client, text):
+        data = text.encode("utf-8")
+        with self.lock:
+            client.sendall(self._frame(0x1, data))
+
+    def broadcast(self, text):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                self.send(client, text)
+            except OSError:
+                pass
+
+    @property
+    def client_count(self):
+        with self.lock:
+            return len(self.clients)
+
+    def _accept_loop(self, listener):
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        try:
+            self._handshake(client)
+            with self.lock:
+                self.clients.append(client)
+            while True:
+                opcode, payload = self._read_frame(client)
+                if opcode == 0x1:
+                    text = payload.decode("utf-8")
+                    self.received.append(text)
+                    if self.on_message is not None:
+                        self.on_message(self, client, text)
+                elif opcode == 0x9 and self.answer_pings:
+                    with self.lock:
+                        client.sendall(self._frame(0xA, payload))
+                elif opcode == 0x8:
+                    with self.lock:
+                        client.sendall(self._frame(0x8, payload[:2]))
+                    break
+        except (OSError, ConnectionError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            client.close()
+
+    def _handshake(self, client):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = client.recv(4096)
+            if not chunk:
+                raise ConnectionError("Client left during the handshake")
+            request += chunk
+        headers = {}
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        client.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+
+    def _read_exact(self, client, size):
+        data = b""
+        while len(data) < size:
+            chunk = client.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Client disconnected")
+            data += chunk
+        return data
+
+    def _read_frame(self, client):
+        # Clients always mask their frames, and ours never need fragmenting
+        first, second = self._read_exact(client, 2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self._read_exact(client, 2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._read_exact(client, 8))[0]
+        mask = self._read_exact(client, 4) if second & 0x80 else b"\x00\x00\x00\x00"
+        payload = self._read_exact(client, length)
+        return opcode, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+    @staticmethod
+    def _frame(opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        return header + payload
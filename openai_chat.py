@@ -1,33 +1,28 @@
 from openai import OpenAI
-import tiktoken
 import os
+import time
+import threading
 from rich import print
 from vscode_api_handler import VSCodeAPIHandler
+from command_stream_parser import StreamingCommandParser
+from workspace_index import WorkspaceIndex
+from history_compactor import HistoryCompactor, GptSummarizer
+from token_budget import TokenCountedHistory, get_encoding_for_model, count_message_tokens, TOKENS_PER_REPLY
 
 def num_tokens_from_messages(messages, model='gpt-4o'):
   """Returns the number of tokens used by a list of messages.
   Copied with minor changes from: https://platform.openai.com/docs/guides/chat/managing-tokens """
 
-  encoding_name = None
-  if "gpt-4" in model or "gpt-3.5" in model or "o3-" in model:
-     encoding_name = "cl100k_base"
-# For older models like davinci  
-  elif "davinci" in model or "curie" in model or "babbage" in model or "ada" in model:
-     encoding_name = "p50k_base"
-  else:
-    # Default to cl100k_base for unknown models (safest for newer models)
-     encoding_name = "cl100k_base"
+  # A TokenCountedHistory already knows its own length
+  if isinstance(messages, TokenCountedHistory) and messages.model == model:
+      return messages.total_tokens
 
   try:
-      encoding = tiktoken.get_encoding(encoding_name)
+      encoding = get_encoding_for_model(model)
       num_tokens = 0
       for message in messages:
-          num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-          for key, value in message.items():
-              num_tokens += len(encoding.encode(value))
-              if key == "name":  # if there's a name, the role is omitted
-                  num_tokens += -1  # role is always required and always 1 token
-      num_tokens += 2  # every reply is primed with <im_start>assistant
+          num_tokens += count_message_tokens(message, encoding)
+      num_tokens += TOKENS_PER_REPLY
       return num_tokens
   except Exception:
       raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.
@@ -36,13 +31,30 @@ def num_tokens_from_messages(messages, model='gpt-4o'):
 
 class OpenAiManager:
     
-    def __init__(self):
-        self.chat_history = [] # Stores the entire conversation
-        self.vscode_api = VSCodeAPIHandler()  # Create an instance of VSCodeAPIHandler
+    def __init__(self, response_cache=None, vscode_api=None):
+        self.chat_history = TokenCountedHistory() # Stores the entire conversation, along with each message's token count
+        # Optional ResponseCache, repeated prompts in the same situation are answered from it instead of asking GPT again
+        self.response_cache = response_cache
+        self.vscode_api = vscode_api if vscode_api is not None else VSCodeAPIHandler()  # Create an instance of VSCodeAPIHandler
+        # How much of the file open in VS Code (around the cursor) goes along with every request
+        self.editor_context_tokens = 1500
+        # Code from the rest of the project that matches the prompt, from an index of the workspace VS Code has open
+        # (or ASSISTANT_WORKSPACE, if it's set)
+        self.workspace_context_tokens = 1000
+        self.workspace_index = None
+        if os.environ.get("ASSISTANT_WORKSPACE"):
+            self.workspace_index = WorkspaceIndex(os.environ["ASSISTANT_WORKSPACE"]).start()
+        self.vscode_api.workspace_listeners.append(self._on_workspace_message)
         try:
             self.client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
         except TypeError:
             exit("Ooops! You forgot to set OPENAI_API_KEY in your environment!")
+        # Old messages are folded into a running summary in the background, instead of being dropped.
+        # Everything that changes the history holds history_lock, since the compactor changes it from its own thread.
+        self.history_lock = threading.RLock()
+        self.history_compactor = HistoryCompactor(self.chat_history, GptSummarizer(self.client), lock=self.history_lock)
+        # Optional ConversationJournal every new message is saved to (see attach_journal)
+        self.journal = None
 
     # Asks a question with no chat history
     def chat(self, prompt=""):
@@ -78,41 +90,79 @@ class OpenAiManager:
         except Exception as e:
             print(f"[red]❌ Error calling OpenAI: {str(e)}[/]")
 
-    
-    def process_ai_command(self, ai_response):
-        """Process AI response and send commands to VS Code API"""
-        
-        print("working")
-        # Remove debug prints that might interfere with command detection
-        lines = ai_response.strip().split('\n')
-        if not lines:
-            print("[red]❌ Empty response from AI[/]")
+    # Asks a question with no chat history, yielding the answer piece by piece as GPT generates it
+    def chat_streamed(self, prompt=""):
+        if not prompt:
+            print("Didn't receive input!")
+            return
+
+        print(f"\n🎤 [bold blue]Received prompt:[/] {prompt}")
+
+        # Check that the prompt is under the token context limit
+        chat_question = [{"role": "user", "content": prompt}]
+        if num_tokens_from_messages(chat_question) > 8000:
+            print("[red]The length of this chat question is too large for the GPT model[/]")
             return
-            
-        first_line = lines[0].strip()
-        print(f"[blue]📝 Processing command:[/] '{first_line}'")
-        
-        # Extract the code content after the command
-        code_content = '\n'.join(lines[2:]) if len(lines) > 2 else ""
-        
-        # Check for commands without any trailing characters
-        if first_line == "CREATE FUNCTION:":
-            print("[green]✅ Code generation command detected![/]")
-            self.vscode_api.insert_generated_code(code_content)
-            return True
-        elif first_line == "EDIT ROW:":
-            print("[green]✅ Edit line command detected![/]")
-            self.vscode_api.edit_line()
-            return True
-        if first_line == "DELETE ROW:":
-            print("[green]✅ Delete line command detected![/]")
-            # If there's any specific line number or content in code_content, we could process it here
-            self.vscode_api.delete_line()
-            print("[blue]🗑️ Sending delete command to VS Code[/]")
-            return True
-        
-        print(f"[yellow]ℹ No command detected. First line: '{first_line}'[/]")
-        return False
+
+        print("[yellow]\nAsking ChatGPT a question (streamed)...[/]")
+        try:
+            answer_parts = []
+            for text_delta in self._stream_completion(chat_question):
+                answer_parts.append(text_delta)
+                yield text_delta
+        except Exception as e:
+            print(f"[red]❌ Error calling OpenAI: {str(e)}[/]")
+            return
+
+        openai_answer = "".join(answer_parts)
+        print("[bold yellow]🔍 Starting command processing...[/]")
+        self.process_ai_command(openai_answer)
+
+    def _stream_completion(self, messages):
+        """Calls the chat completion API with stream=True and yields the text deltas as they arrive"""
+        response_stream = self.client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            stream=True
+        )
+        try:
+            for chunk in response_stream:
+                if not chunk.choices:
+                    continue
+                text_delta = chunk.choices[0].delta.content
+                if text_delta:
+                    yield text_delta
+        finally:
+            # Closing the stream drops the HTTP connection if the caller stopped reading early
+            response_stream.close()
+
+    def parse_ai_commands(self, ai_response):
+        """
+        Finds every command in the response, in order. Each one becomes an edit operation for VS Code:
+        {"op": "insert" | "replaceLine" | "deleteLine", "line": 1-based line or None for the cursor, "content": code}
+        The code for a command is the first code block after it, before the next command (see StreamingCommandParser).
+        """
+        # Same parser the orchestrator feeds while the answer streams in, here it just gets the whole answer at once
+        parser = StreamingCommandParser()
+        return parser.feed(ai_response) + parser.finish()
+
+    def process_ai_command(self, ai_response):
+        """
+        Process AI response and send commands to VS Code API.
+        All the commands in the response go to VS Code as one batch, which the extension applies as a single edit (one undo step).
+        Returns a Future for VS Code's answer (see VSCodeAPIHandler.send_command), or False if there was no command.
+        """
+        operations = self.parse_ai_commands(ai_response)
+        if not operations:
+            first_line = ai_response.strip().split('\n')[0] if ai_response.strip() else ""
+            print(f"[yellow]ℹ No command detected. First line: '{first_line}'[/]")
+            return False
+
+        for operation in operations:
+            where = f"line {operation['line']}" if operation["line"] else "the cursor"
+            print(f"[blue]📝 Processing command:[/] {operation['op']} at {where}")
+        print(f"[green]✅ Sending {len(operations)} edit(s) to VS Code as one batch[/]")
+        return self.vscode_api.apply_edits(operations)
 
     # Asks a question that includes the full conversation history
     def chat_with_history(self, prompt=""):
@@ -121,40 +171,262 @@ class OpenAiManager:
             return
 
         # Add our prompt into the chat history
-        self.chat_history.append({"role": "user", "content": prompt})
+        self._add_to_history({"role": "user", "content": prompt})
 
-        # Check total token limit. Remove old messages as needed
-        print(f"[coral]Chat History has a current token length of {num_tokens_from_messages(self.chat_history)}")
-        while num_tokens_from_messages(self.chat_history) > 8000:
-            self.chat_history.pop(1) # We skip the 1st message since it's the system message
-            print(f"Popped a message! New token length is: {num_tokens_from_messages(self.chat_history)}")
-
-        print("[yellow]\nAsking ChatGPT a question...")
-        completion = self.client.chat.completions.create(
-          model="gpt-4o",
-          messages=self.chat_history
-        )
+        request_messages = self.build_request_messages(self.chat_history)
+        openai_answer = self.response_cache.get(request_messages) if self.response_cache is not None else None
+        if openai_answer is not None:
+            print("[yellow]\nAnswering from the response cache...")
+        else:
+            print("[yellow]\nAsking ChatGPT a question...")
+            start_time = time.perf_counter()
+            completion = self.client.chat.completions.create(
+              model="gpt-4o",
+              messages=request_messages
+            )
+            openai_answer = completion.choices[0].message.content
+            if self.response_cache is not None:
+                self.response_cache.put(request_messages, openai_answer, (time.perf_counter() - start_time) * 1000)
 
         # Add this answer to our chat history
-        self.chat_history.append({"role": completion.choices[0].message.role, "content": completion.choices[0].message.content})
+        self._add_to_history({"role": "assistant", "content": openai_answer})
 
         # Process the answer
-        openai_answer = completion.choices[0].message.content
         print(f"[green]\n{openai_answer}\n")
         
         # Add this line to process commands in chat_with_history
         self.process_ai_command(openai_answer)
         
         return openai_answer
+
+    # Same as chat_with_history, but yields the answer piece by piece as GPT generates it.
+    # The full answer is still added to the chat history and processed for commands once the stream ends.
+    # If cancel_event (a threading.Event) gets set, e.g. because the user talked over the assistant, the stream is dropped right away.
+    # completion_stream can be a request that was already started for this prompt (see SpeculativePrefetcher), otherwise a new one is made.
+    def chat_with_history_streamed(self, prompt="", cancel_event=None, completion_stream=None, process_commands=True):
+        if not prompt:
+            print("Didn't receive input!")
+            return
+
+        # Add our prompt into the chat history
+        self._add_to_history({"role": "user", "content": prompt})
+
+        start_time = time.perf_counter()
+        request_messages = None
+        if completion_stream is None or self.response_cache is not None:
+            request_messages = self.build_request_messages(self.chat_history)
+        cached_answer = self.response_cache.get(request_messages) if self.response_cache is not None else None
+        if cached_answer is not None:
+            print("[yellow]\nAnswering from the response cache...")
+            if completion_stream is not None:
+                # A speculative request for this prompt, not needed anymore
+                completion_stream.close()
+            completion_stream = self._replay_answer(cached_answer)
+        else:
+            print("[yellow]\nAsking ChatGPT a question (streamed)...")
+            if completion_stream is None:
+                completion_stream = self._stream_completion(request_messages)
+        answer_parts = []
+        try:
+            for text_delta in completion_stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                answer_parts.append(text_delta)
+                yield text_delta
+        finally:
+            completion_stream.close()
+
+        openai_answer = "".join(answer_parts)
+        if cancel_event is not None and cancel_event.is_set():
+            # Keep what was said so far, so GPT knows where it got cut off, but don't run half a command
+            print("[yellow]Answer was interrupted, skipping command processing")
+            if openai_answer:
+                self._add_to_history({"role": "assistant", "content": openai_answer})
+            return
+
+        # Add the assembled answer to our chat history
+        self._add_to_history({"role": "assistant", "content": openai_answer})
+        if self.response_cache is not None and cached_answer is None:
+            self.response_cache.put(request_messages, openai_answer, (time.perf_counter() - start_time) * 1000)
+
+        # Callers with their own command stage (the TurnOrchestrator) run the command themselves
+        if process_commands:
+            self.process_ai_command(openai_answer)
+
+    @staticmethod
+    def _replay_answer(answer):
+        # Same shape as _stream_completion, so a cached answer goes down the same path as a streamed one
+        yield answer
+
+    def editor_context_message(self):
+        """A system message with the part of the file open in VS Code around the cursor, None if VS Code hasn't sent us a file"""
+        window = self.vscode_api.editor_context.cursor_window(self.editor_context_tokens, self.chat_history.encoding)
+        if window is None:
+            return None
+        file_name = window["uri"].rsplit("/", 1)[-1]
+        if window["text"] is None:
+            content = (f"The file open in VS Code is {file_name} ({window['line_count']} lines), it's too big to show. "
+                       f"The cursor is on line {window['cursor_line']}.")
+        else:
+            content = (f"The file open in VS Code is {file_name} ({window['language_id']}, {window['line_count']} lines), "
+                       f"the cursor is on line {window['cursor_line']}. Lines {window['start_line']}-{window['end_line']}, "
+                       f"each as 'line number: code':\n{window['text']}")
+        return {"role": "system", "content": content}
+
+    def workspace_context_message(self, prompt):
+        """A system message with the project code that best matches the prompt, None if there's no index or no match"""
+        if self.workspace_index is None:
+            return None
+        snippets = self.workspace_index.relevant_snippets(prompt, self.workspace_context_tokens, self.chat_history.encoding)
+        if not snippets:
+            return None
+        return {"role": "system", "content": f"Code from elsewhere in the user's project that may be relevant:\n{snippets}"}
+
+    def _on_workspace_message(self, message):
+        # Called on the VS Code connection's thread
+        if message["type"] == "workspace":
+            folders = message.get("folders") or []
+            if os.environ.get("ASSISTANT_WORKSPACE") or not folders:
+                return
+            if self.workspace_index is None or self.workspace_index.root != os.path.abspath(folders[0]):
+                if self.workspace_index is not None:
+                    self.workspace_index.stop()
+                print(f"[green]Indexing the workspace {folders[0]}")
+                self.workspace_index = WorkspaceIndex(folders[0]).start()
+        elif self.workspace_index is not None:
+            self.workspace_index.notify_changed(message.get("paths") or [])
+
+    def build_request_messages(self, messages):
+        """
+        What actually gets sent for a history (a TokenCountedHistory ending with the user's prompt): the history, plus right
+        before the prompt the project code that matches it and the open file around the cursor. Neither is kept in the history,
+        every request gets the latest version of them. If it all doesn't fit in 8000 tokens, the oldest messages are left out of this request.
+        """
+        request_messages = TokenCountedHistory(model=messages.model)
+        # A copy, so the compactor can't change it while it's being sent
+        with self.history_lock:
+            request_messages.extend_with_counts(messages, messages.message_tokens)
+        if not request_messages:
+            return request_messages
+        context_messages = [message for message in (self.workspace_context_message(request_messages[-1]["content"]), self.editor_context_message())
+                            if message is not None]
+        for context_message in context_messages:
+            request_messages.insert(len(request_messages) - 1, context_message)
+        while request_messages.total_tokens > 8000 and len(request_messages) > len(context_messages) + 1:
+            request_messages.pop(1)
+        return request_messages
+
+    def attach_journal(self, journal, resume=True):
+        """
+        Saves every new message to journal (a ConversationJournal) from now on. With resume, the conversation saved in it
+        is added back to the history first (call this once the system prompt is in). Returns how many messages were restored.
+        """
+        with self.history_lock:
+            restored = journal.resume(self.chat_history) if resume else 0
+            if restored:
+                if self.history_compactor is not None:
+                    self.history_compactor.restore_summary()
+                self._trim_chat_history()
+            self.journal = journal
+        self._compact_history()
+        return restored
+
+    def _add_to_history(self, message):
+        with self.history_lock:
+            self.chat_history.append(message)
+            if self.journal is not None:
+                self.journal.record(message, self.chat_history.message_tokens[-1], self.chat_history)
+            if message["role"] == "user":
+                self._trim_chat_history()
+        if message["role"] == "assistant":
+            self._compact_history()
+
+    def _trim_chat_history(self):
+        # Check total token limit. Remove old messages as needed
+        # The history keeps a running token total, so none of this re-encodes any messages
+        # Normally the compactor keeps the history well under the limit, this is the fallback if it can't keep up (or fails)
+        print(f"[coral]Chat History has a current token length of {self.chat_history.total_tokens}")
+        # We skip the 1st message since it's the system message (and the summary after it)
+        first_droppable = self.history_compactor.first_foldable_index() if self.history_compactor is not None else 1
+        while self.chat_history.total_tokens > 8000 and len(self.chat_history) > first_droppable:
+            self.chat_history.pop(first_droppable)
+            print(f"Popped a message! New token length is: {self.chat_history.total_tokens}")
+
+    def _compact_history(self):
+        if self.history_compactor is not None:
+            self.history_compactor.maybe_compact()
    
 
 if __name__ == '__main__':
+    # COMMAND PARSING TEST (offline, nothing is sent)
+    command_parser = OpenAiManager.__new__(OpenAiManager)
+    operations = command_parser.parse_ai_commands(
+        "EDIT ROW: 12\nI'll rename the variable.\n```python\ntotal = 0\n```\n"
+        "DELETE ROW: 15\nAnd drop the unused import.\n"
+        "CREATE FUNCTION:\nPlus a helper at the cursor.\n```python\ndef helper():\n    pass\n```\n"
+        "EDIT ROW:\nThis one has no code, so it's skipped."
+    )
+    assert operations == [
+        {"op": "replaceLine", "line": 12, "content": "total = 0"},
+        {"op": "deleteLine", "line": 15},
+        {"op": "insert", "line": None, "content": "def helper():\n    pass"},
+    ], operations
+    assert command_parser.parse_ai_commands("No commands here, DELETE ROW: is mid-sentence") == []
+    print("[green]Command parsing test passed")
+
+    # EDITOR CONTEXT TEST (offline): a big file only adds a window around the cursor, and the request stays under 8000 tokens
+    from editor_context import EditorContextMirror
+    context_manager = OpenAiManager.__new__(OpenAiManager)
+    context_manager.vscode_api = VSCodeAPIHandler.__new__(VSCodeAPIHandler)
+    context_manager.vscode_api.editor_context = EditorContextMirror()
+    context_manager.editor_context_tokens = 1500
+    context_manager.workspace_context_tokens = 1000
+    context_manager.workspace_index = None
+    context_manager.history_lock = threading.RLock()
+    context_manager.history_compactor = None
+    context_manager.chat_history = TokenCountedHistory([{"role": "system", "content": "You are a coding assistant."}])
+    for i in range(60):
+        context_manager.chat_history.append({"role": "user", "content": f"Question {i} " + "about the code " * 30})
+        context_manager.chat_history.append({"role": "assistant", "content": f"Answer {i} " + "explaining it " * 60})
+    context_manager._trim_chat_history()
+    context_manager.chat_history.append({"role": "user", "content": "What does the function at the cursor do?"})
+    assert context_manager.build_request_messages(context_manager.chat_history) == context_manager.chat_history
+    source = "\n".join(f"def function_{i}(value):\n    return value * {i}\n" for i in range(20000))
+    context_manager.vscode_api.editor_context.handle_message(
+        {"type": "document", "uri": "file:///project/big.py", "languageId": "python", "version": 1, "text": source, "cursorLine": 30000})
+    start = time.perf_counter()
+    request_messages = context_manager.build_request_messages(context_manager.chat_history)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    assert request_messages.total_tokens <= 8000 and request_messages[-1] == context_manager.chat_history[-1]
+    assert request_messages[-2]["content"].startswith("The file open in VS Code is big.py") and "30001: " in request_messages[-2]["content"]
+    # Older messages made room for the file in the request, the history itself keeps them
+    assert len(request_messages) < len(context_manager.chat_history) + 1
+    print(f"[green]Editor context for a {len(source)} character file: {request_messages.message_tokens[-2]} tokens, "
+          f"{request_messages.total_tokens} in the whole request, built in {elapsed_ms:.2f} ms")
+
+    # WORKSPACE CONTEXT TEST (offline): project code matching the prompt goes in too
+    import tempfile
+    workspace = tempfile.mkdtemp()
+    with open(os.path.join(workspace, "billing.py"), "w") as file:
+        file.write("def calculateInvoiceTotal(items):\n    return sum(item.price for item in items)\n")
+    context_manager.workspace_index = WorkspaceIndex(workspace, index_path=os.path.join(workspace, "index.npz"))
+    context_manager.workspace_index.refresh()
+    context_manager.chat_history.append({"role": "user", "content": "Why is the invoice total wrong?"})
+    request_messages = context_manager.build_request_messages(context_manager.chat_history)
+    assert "billing.py, lines 1-3" in request_messages[-3]["content"] and request_messages.total_tokens <= 8000, request_messages[-3]
+    print(f"[green]Workspace snippets added: {request_messages.message_tokens[-3]} tokens")
+
     openai_manager = OpenAiManager()
     openai_manager.chat("Sukurk funkciją fetchData su parametru url")  # Example test command
 
     # CHAT TEST
     chat_without_history = openai_manager.chat("Hey ChatGPT what is 2 + 2? But tell it to me as Yoda")
 
+    # STREAMED CHAT TEST
+    for text_delta in openai_manager.chat_streamed("Count from 1 to 20, one number per line"):
+        print(text_delta, end="", flush=True)
+    print()
+
     # CHAT WITH HISTORY TEST
     FIRST_SYSTEM_MESSAGE = {"role": "system", "content": "Act like you are Captain Jack Sparrow from the Pirates of Carribean movie series!"}
     FIRST_USER_MESSAGE = {"role": "user", "content": "Ahoy there! Who are you, and what are you doing in these parts? Please give me a 1 sentence background on how you got here."}
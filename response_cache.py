@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+from command_stream_parser import contains_ai_command
+from speculative_prefetch import normalize_transcript
+
+
+class ResponseCache:
+    """
+    Remembers GPT's answers, so a prompt that's repeated in the same situation ("explain this function" on the same code)
+    is answered straight away instead of going through another completion.
+    The key is the normalized prompt plus a digest of what else GPT sees that the answer depends on: the system messages
+    in the request (the system prompt, the history summary, the project snippets and the open file around the cursor) and
+    the last history_messages messages before the prompt. By default that's the last answer, so a follow-up like "why?" or
+    "yes, do that" only hits after the same answer. Asking the same thing again right away skips back over the earlier
+    asks, so the repeat has the same key as the first time. Change the code or move the cursor, and it's a different key.
+    Answers with editor commands aren't stored unless allow_commands is on, replaying one would apply the edit again.
+    Entries expire after ttl_seconds, and past max_entries the least recently used ones are evicted.
+
+    Parameters:
+    cache_path (str): JSON file the cache is kept in between runs, defaults to ~/.cache/ai_voice_assistant/responses.json
+    ttl_seconds (float): how long an answer stays valid
+    max_entries (int): how many answers are kept
+    history_messages (int): how many of the latest conversation messages are part of the key
+    allow_commands (bool): also cache (and replay) answers that edit the code
+    clock (callable): returns the current time in seconds, for tests
+    """
+
+    def __init__(self, cache_path=None, ttl_seconds=24 * 3600, max_entries=500, history_messages=1, allow_commands=False, clock=time.time):
+        if cache_path is None:
+            cache_path = os.path.join(os.path.expanduser("~"), ".cache", "ai_voice_assistant", "responses.json")
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.history_messages = history_messages
+        self.allow_commands = allow_commands
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> [answer, stored at, how long GPT took for it in ms], ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.skipped_commands = 0
+        self.saved_ms = 0.0
+        self.dirty = False
+        self._load()
+        # Hits only reorder the LRU list, so the file is written on puts and once on the way out
+        atexit.register(self.flush)
+
+    def make_key(self, messages, model="gpt-4o"):
+        """messages is the whole request, ending with the user's prompt"""
+        prompt = normalize_transcript(messages[-1]["content"])
+        earlier_messages = messages[:-1]
+        context = [message for message in earlier_messages if message["role"] == "system"]
+        if self.history_messages:
+            conversation = [message for message in earlier_messages if message["role"] != "system"]
+            # The same prompt asked again straight after its answer is asked in the same context as the first time
+            while (len(conversation) >= 2 and conversation[-2]["role"] == "user"
+                   and normalize_transcript(conversation[-2]["content"]) == prompt):
+                conversation = conversation[:-2]
+            context += conversation[-self.history_messages:]
+        context_digest = hashlib.sha256(json.dumps([[message["role"], message["content"]] for message in context],
+                                                   ensure_ascii=False).encode("utf-8")).hexdigest()
+        return hashlib.sha256(json.dumps([model, prompt, context_digest], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, messages, model="gpt-4o"):
+        """Returns the cached answer for this request, or None"""
+        start_time = time.perf_counter()
+        key = self.make_key(messages, model)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.clock() - entry[1] > self.ttl_seconds:
+                del self.entries[key]
+                self.expirations += 1
+                self.dirty = True
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.dirty = True
+            self.hits += 1
+            self.saved_ms += max(0.0, entry[2] - (time.perf_counter() - start_time) * 1000)
+            return entry[0]
+
+    def put(self, messages, answer, latency_ms, model="gpt-4o"):
+        """Stores GPT's answer for this request. latency_ms is how long it took, i.e. what a hit saves. Returns False if it wasn't stored."""
+        if not answer:
+            return False
+        if not self.allow_commands and contains_ai_command(answer):
+            self.skipped_commands += 1
+            return False
+        key = self.make_key(messages, model)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = [answer, self.clock(), latency_ms]
+            self._evict()
+            self._save()
+        return True
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_ms": round(self.saved_ms),
+                "skipped_commands": self.skipped_commands,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self._save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _evict(self):
+        now = self.clock()
+        for key in [key for key, entry in self.entries.items() if now - entry[1] > self.ttl_seconds]:
+            del self.entries[key]
+            self.expirations += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as file:
+                saved_entries = json.load(file)
+        except (OSError, ValueError):
+            return
+        for key, answer, stored_at, latency_ms in saved_entries:
+            self.entries[key] = [answer, stored_at, latency_ms]
+        self._evict()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        # Write to a temp file first so a crash never leaves a half-written cache
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump([[key] + entry for key, entry in self.entries.items()], file, ensure_ascii=False)
+        os.replace(temp_path, self.cache_path)
+        self.dirty = False
+
+
+# Tests
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    test_dir = tempfile.mkdtemp()
+    try:
+        now = [1000.0]
+        cache_path = os.path.join(test_dir, "responses.json")
+        cache = ResponseCache(cache_path, ttl_seconds=60, max_entries=2, clock=lambda: now[0])
+        system_prompt = {"role": "system", "content": "You are a coding assistant."}
+        editor = {"role": "system", "content": "The file open in VS Code is app.py, the cursor is on line 3. 3: def total(items):"}
+
+        def request(prompt, *earlier):
+            return [system_prompt, *earlier, editor, {"role": "user", "content": prompt}]
+
+        assert cache.get(request("Explain this function.")) is None
+        assert cache.put(request("Explain this function."), "It adds up the items.", latency_ms=1800)
+        # Same words however they were transcribed, also when it's asked again right after the answer
+        asked_before = [{"role": "user", "content": "Explain this function."}, {"role": "assistant", "content": "It adds up the items."}]
+        assert cache.get(request("explain this function", *asked_before)) == "It adds up the items."
+        # A follow-up depends on the answer it follows
+        earlier_turn = [{"role": "user", "content": "What time is it?"}, {"role": "assistant", "content": "No idea."}]
+        followup_cache = ResponseCache(os.path.join(test_dir, "followups.json"))
+        assert followup_cache.put(request("Why?", *earlier_turn), "I don't have a clock.", latency_ms=900)
+        assert followup_cache.get(request("Why?", *asked_before)) is None
+        assert followup_cache.get(request("why", *earlier_turn)) == "I don't have a clock."
+        # Different code at the cursor, different answer
+        moved = [system_prompt, {"role": "system", "content": "The file open in VS Code is app.py, the cursor is on line 9. 9: pass"},
+                 {"role": "user", "content": "Explain this function."}]
+        assert cache.get(moved) is None
+
+        # Answers that edit the code aren't replayed, unless that's allowed
+        assert not cache.put(request("Delete this line."), "DELETE ROW: 3\nDone.", latency_ms=1500)
+        assert cache.get(request("Delete this line.")) is None and cache.skipped_commands == 1
+        command_cache = ResponseCache(os.path.join(test_dir, "commands.json"), allow_commands=True)
+        assert command_cache.put(request("Delete this line."), "DELETE ROW: 3\nDone.", latency_ms=1500)
+        assert command_cache.get(request("Delete this line.")) == "DELETE ROW: 3\nDone."
+
+        # Least recently used goes first, expired entries are gone
+        cache.put(request("What does line 3 do?"), "It starts the function.", latency_ms=1200)
+        cache.get(request("Explain this function."))
+        cache.put(request("Is this fast?"), "Yes, it's linear.", latency_ms=1400)
+        assert cache.get(request("What does line 3 do?")) is None and cache.evictions == 1
+        now[0] += 61
+        assert cache.get(request("Is this fast?")) is None and cache.expirations >= 1
+        now[0] -= 61
+        print(f"Cache stats: {cache.stats()}")
+
+        # The next run picks up where this one left off
+        cache.put(request("Is this fast?"), "Yes, it's linear.", latency_ms=1400)
+        reloaded_cache = ResponseCache(cache_path, ttl_seconds=60, max_entries=2, clock=lambda: now[0])
+        assert reloaded_cache.get(request("Is this fast?")) == "Yes, it's linear."
+
+        # A lookup has to hash the whole request, which is still nothing next to a completion
+        big_request = [system_prompt] + [{"role": "system", "content": "line of code\n" * 500}] * 3 + [{"role": "user", "content": "Explain this function."}]
+        start = time.perf_counter()
+        for _ in range(1000):
+            reloaded_cache.get(big_request)
+        print(f"Lookup on a {sum(len(message['content']) for message in big_request)} character request: "
+              f"{(time.perf_counter() - start):.3f} ms")
+        print(f"Reloaded cache stats: {reloaded_cache.stats()}")
+        reloaded_cache.flush()
+        command_cache.flush()
+        followup_cache.flush()
+    finally:
+        shutil.rmtree(test_dir)
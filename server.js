@@ -7,27 +7,82 @@ app.use(express.json());
 const PORT = 5000;
 const wss = new WebSocket.Server({ port: 5001 });
 
+// Every client says who it is in its first message: {"type": "hello", "role": "vscode" | "python"}
 let vscodeClient = null;
+const pythonClients = new Set();
+// Command id -> the Python client waiting for its ack
+const pendingCommands = new Map();
+// batch: several edits applied together, see applyOperations in extension.ts
+const EDITOR_COMMANDS = ['insertGeneratedCode', 'editLine', 'deleteLine', 'batch'];
+// The extension keeps every Python client's copy of the open file up to date with these (see editor_context.py),
+// and tells them about the workspace folder and changed files (for the workspace index)
+const EDITOR_CONTEXT_MESSAGES = ['document', 'documentChange', 'cursor', 'workspace', 'filesChanged'];
 
 wss.on('connection', (ws) => {
-    console.log("✅ VS Code extension connected!");
-    vscodeClient = ws;
-
     ws.on('message', (message) => {
         try {
             const data = JSON.parse(message.toString());
+
+            if (data.type === 'hello') {
+                if (data.role === 'vscode') {
+                    console.log("✅ VS Code extension connected!");
+                    vscodeClient = ws;
+                } else {
+                    console.log("✅ Python client connected!");
+                    pythonClients.add(ws);
+                    // A new Python client has no copy of the open file yet (if VS Code connects later, it sends one anyway)
+                    if (vscodeClient) {
+                        sendToVSCode({ type: 'resync' }, null);
+                    }
+                }
+                return;
+            }
+
+            if (EDITOR_CONTEXT_MESSAGES.includes(data.type)) {
+                // Forwarded as is, this is sent on every keystroke so it isn't logged
+                const raw = message.toString();
+                for (const pythonClient of pythonClients) {
+                    if (pythonClient.readyState === WebSocket.OPEN) {
+                        pythonClient.send(raw);
+                    }
+                }
+                return;
+            }
+
+            // A Python client's copy of the file got out of step, the extension sends the whole file again
+            if (data.type === 'resync') {
+                if (vscodeClient) {
+                    sendToVSCode(data, null);
+                }
+                return;
+            }
+
+            // An answer's last edit has been sent, the extension closes its undo step
+            if (data.type === 'endSession') {
+                if (vscodeClient) {
+                    sendToVSCode(data, null);
+                }
+                return;
+            }
+
+            // The extension's answer to a command, goes back to whoever sent the command
+            if (data.type === 'ack') {
+                const pythonClient = pendingCommands.get(data.id);
+                pendingCommands.delete(data.id);
+                if (pythonClient && pythonClient.readyState === WebSocket.OPEN) {
+                    pythonClient.send(JSON.stringify(data));
+                }
+                return;
+            }
+
             console.log("📩 Message from Python client:", data);
-            
+
             // Forward the command to VS Code
-            if (data.command === 'insertGeneratedCode') {
-                console.log("🔄 Forwarding insertGeneratedCode command");
-                sendToVSCode("insertGeneratedCode", data.content);
-            } else if (data.command === 'editLine') {
-                console.log("🔄 Forwarding editLine command");
-                sendToVSCode("editLine", null);
-            } else if (data.command === 'deleteLine') {
-                console.log("🔄 Forwarding deleteLine command");
-                sendToVSCode("deleteLine", null);
+            if (EDITOR_COMMANDS.includes(data.command)) {
+                console.log(`🔄 Forwarding ${data.command} command`);
+                sendToVSCode(data, ws);
+            } else {
+                sendAck(ws, data.id, false, `Unknown command: ${data.command}`);
             }
         } catch (error) {
             console.error("❌ Error processing message:", error);
@@ -35,34 +90,61 @@ wss.on('connection', (ws) => {
     });
 
     ws.on('close', () => {
-        console.log("❌ VS Code extension disconnected!");
-        vscodeClient = null;
+        if (ws === vscodeClient) {
+            console.log("❌ VS Code extension disconnected!");
+            vscodeClient = null;
+            // Those commands will never be answered now
+            for (const [id, pythonClient] of pendingCommands) {
+                sendAck(pythonClient, id, false, "VS Code extension disconnected");
+            }
+            pendingCommands.clear();
+        } else {
+            pythonClients.delete(ws);
+            for (const [id, pythonClient] of pendingCommands) {
+                if (pythonClient === ws) {
+                    pendingCommands.delete(id);
+                }
+            }
+        }
     });
 });
 
 app.post('/insertGeneratedCode', (req, res) => {
-    sendToVSCode("insertGeneratedCode", res);
+    replyOverHttp(res, "insertGeneratedCode", req.body.content);
 });
 
 app.post('/editLine', (req, res) => {
-    sendToVSCode("editLine", res);
+    replyOverHttp(res, "editLine", null);
 });
 
 app.post('/deleteLine', (req, res) => {
-    sendToVSCode("deleteLine", res);
+    replyOverHttp(res, "deleteLine", null);
 });
 
-function sendToVSCode(command, content) {
-    if (vscodeClient) {
-        vscodeClient.send(JSON.stringify({ command, content }));
-        if (content && content.send) {
-            content.send({ message: `✅ Sent ${command} command to VS Code!` });
-        }
+function replyOverHttp(res, command, content) {
+    if (sendToVSCode({ command, content }, null)) {
+        res.send({ message: `✅ Sent ${command} command to VS Code!` });
     } else {
-        if (content && content.status) {
-            content.status(500).send({ error: "❌ No active VS Code extension connection!" });
+        res.status(500).send({ error: "❌ No active VS Code extension connection!" });
+    }
+}
+
+function sendToVSCode(message, pythonClient) {
+    if (vscodeClient && vscodeClient.readyState === WebSocket.OPEN) {
+        if (message.id && pythonClient) {
+            pendingCommands.set(message.id, pythonClient);
         }
-        console.error("❌ No active VS Code extension connection!");
+        vscodeClient.send(JSON.stringify(message));
+        return true;
+    }
+    console.error("❌ No active VS Code extension connection!");
+    sendAck(pythonClient, message.id, false, "No active VS Code extension connection");
+    return false;
+}
+
+function sendAck(pythonClient, id, ok, error) {
+    if (id && pythonClient && pythonClient.readyState === WebSocket.OPEN) {
+        pythonClient.send(JSON.stringify({ type: 'ack', id, ok, error }));
     }
 }
 
@@ -0,0 +1,113 @@
+import time
+import threading
+from concurrent.futures import Future
+
+
+class ServiceStartup:
+    """
+    Builds the service managers in the background, all at the same time, so the window can come up straight away.
+    Every task builds one service, imports included, so the slow imports (openai, the speech SDK, pygame, elevenlabs)
+    happen on the task's thread too. Most of the rest is waiting on the network or a device (the Azure connection,
+    the audio device, the voice list), which overlaps.
+    Once every task is done, on_ready(services, error) is called on the startup thread: services is name -> what that task
+    returned, or None if a task failed, with error being the first failure. A task calling exit() counts as a failure too.
+
+    Parameters:
+    tasks (dict): name -> function() that builds and returns the service
+    on_ready (callable): on_ready(services, error), called once when everything is built (or something failed)
+    """
+
+    def __init__(self, tasks, on_ready=None):
+        self.tasks = dict(tasks)
+        self.on_ready = on_ready
+        self.futures = {name: Future() for name in self.tasks}
+        self.task_ms = {}
+        self.ready_ms = None
+        self.started_at = None
+        self.ready_event = threading.Event()
+        self.services = None
+        self.error = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        # Daemon threads, so closing the window never waits for a service that's still connecting
+        for name, task in self.tasks.items():
+            threading.Thread(target=self._run_task, args=(name, task), name=f"startup-{name}", daemon=True).start()
+        threading.Thread(target=self._wait_for_tasks, name="startup", daemon=True).start()
+        return self
+
+    def result(self, name, timeout=None):
+        """Waits for one service and returns it, raises whatever its task raised"""
+        return self.futures[name].result(timeout)
+
+    def wait(self, timeout=None):
+        """Waits for every service and returns them (name -> service), raises the first failure"""
+        if not self.ready_event.wait(timeout):
+            raise TimeoutError(f"services still starting after {timeout}s")
+        if self.error is not None:
+            raise self.error
+        return self.services
+
+    def stats(self):
+        return {
+            "ready_ms": None if self.ready_ms is None else round(self.ready_ms),
+            "task_ms": {name: round(ms) for name, ms in self.task_ms.items()},
+        }
+
+    def _run_task(self, name, task):
+        start_time = time.perf_counter()
+        try:
+            service = task()
+        except BaseException as e:
+            self.task_ms[name] = (time.perf_counter() - start_time) * 1000
+            self.futures[name].set_exception(e)
+            return
+        self.task_ms[name] = (time.perf_counter() - start_time) * 1000
+        self.futures[name].set_result(service)
+
+    def _wait_for_tasks(self):
+        services = {}
+        for name, future in self.futures.items():
+            if future.exception() is not None:
+                self.error = future.exception()
+                break
+            services[name] = future.result()
+        else:
+            self.services = services
+        self.ready_ms = (time.perf_counter() - self.started_at) * 1000
+        self.ready_event.set()
+        if self.on_ready is not None:
+            self.on_ready(self.services, self.error)
+
+
+# Tests
+if __name__ == '__main__':
+    def slow_service(name, seconds):
+        def build():
+            time.sleep(seconds)
+            return name
+        return build
+
+    ready = []
+    startup = ServiceStartup({"a": slow_service("a", 0.2), "b": slow_service("b", 0.2), "c": slow_service("c", 0.1)},
+                             on_ready=lambda services, error: ready.append((services, error))).start()
+    assert startup.result("c", timeout=5) == "c"
+    assert startup.wait(timeout=5) == {"a": "a", "b": "b", "c": "c"}
+    # Built side by side, so it takes as long as the slowest one, not all of them added up
+    assert startup.ready_ms < 350, startup.stats()
+    assert ready == [({"a": "a", "b": "b", "c": "c"}, None)]
+    print(f"Startup stats: {startup.stats()}")
+
+    def missing_key():
+        exit("Ooops! You forgot to set SOME_KEY in your environment!")
+
+    ready = []
+    startup = ServiceStartup({"a": slow_service("a", 0.05), "b": missing_key},
+                             on_ready=lambda services, error: ready.append((services, error))).start()
+    try:
+        startup.wait(timeout=5)
+        assert False, "the failed task should have been raised"
+    except SystemExit as e:
+        assert "SOME_KEY" in str(e)
+    assert ready[0][0] is None and isinstance(ready[0][1], SystemExit)
+    print("Service startup tests passed")
@@ -0,0 +1,183 @@
+import re
+import queue
+import threading
+from rich import print
+from token_budget import TokenCountedHistory, get_encoding_for_model
+
+
+def normalize_transcript(text):
+    """Lowercase, no punctuation, single spaces. Partial hypotheses have no punctuation, the final transcript does."""
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+
+class SpeculativePrefetcher:
+    """
+    Starts the GPT request before the user has finished talking.
+    Once the partial transcript has stopped changing for stable_seconds, the request for it is sent in the background.
+    When the final transcript arrives, claim() hands that request over if the transcript still matches (a hit),
+    otherwise the speculative request is cancelled and the caller asks GPT normally (a miss).
+    For short commands like "delete this line" this hides most of the GPT latency.
+
+    Usage for one utterance:
+        prefetcher.begin_utterance()
+        final_text = speech_to_text.speechtotext_from_mic_continuous(on_partial=prefetcher.on_partial)
+        for text_delta in openai_manager.chat_with_history_streamed(final_text, completion_stream=prefetcher.claim(final_text)):
+            ...
+
+    Parameters:
+    openai_manager: OpenAiManager whose history and client are used for the speculative request
+    stable_seconds (float): how long the partial transcript must stay the same before we speculate
+    min_words (int): don't speculate on anything shorter than this
+    """
+
+    def __init__(self, openai_manager, stable_seconds=0.5, min_words=2):
+        self.openai_manager = openai_manager
+        self.stable_seconds = stable_seconds
+        self.min_words = min_words
+        self.lock = threading.Lock()
+        self.prefix = ""
+        self.latest_transcript = ""
+        self.stability_timer = None
+        self.speculation = None
+        # Counters, so we can tell whether speculating pays for itself
+        self.utterances = 0
+        self.speculations_started = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted_prompt_tokens = 0
+        self.wasted_completion_tokens = 0
+
+    def begin_utterance(self, prefix=""):
+        """Call before listening. prefix is text already heard for this question (e.g. carried over from a barge-in)."""
+        with self.lock:
+            self._cancel_speculation()
+            self.prefix = prefix
+            self.latest_transcript = ""
+
+    def on_partial(self, partial_transcript):
+        """Feed every partial transcript here (SpeechToTextManager's on_partial callback)"""
+        transcript = f"{self.prefix} {partial_transcript}".strip()
+        with self.lock:
+            if normalize_transcript(transcript) == normalize_transcript(self.latest_transcript):
+                return
+            self.latest_transcript = transcript
+            # The user kept talking, so whatever we guessed before is already wrong
+            if self.speculation and self.speculation.normalized_prompt != normalize_transcript(transcript):
+                self._cancel_speculation()
+            if self.stability_timer:
+                self.stability_timer.cancel()
+            self.stability_timer = threading.Timer(self.stable_seconds, self._on_stable, args=(transcript,))
+            self.stability_timer.daemon = True
+            self.stability_timer.start()
+
+    def claim(self, final_transcript):
+        """
+        Returns a completion stream (iterator of text deltas) for the final transcript if our speculation matches it,
+        or None if the caller should make a normal request.
+        """
+        with self.lock:
+            self.utterances += 1
+            if self.stability_timer:
+                self.stability_timer.cancel()
+                self.stability_timer = None
+            speculation = self.speculation
+            self.speculation = None
+            if speculation is None:
+                return None
+            if speculation.normalized_prompt == normalize_transcript(final_transcript):
+                self.hits += 1
+                print(f"[green]⚡ Speculative request hit, GPT already started answering '{final_transcript}'")
+                return speculation.replay()
+            self.misses += 1
+            self._waste(speculation)
+            print(f"[yellow]Speculative request missed ('{speculation.prompt}' vs '{final_transcript}'), asking again")
+            return None
+
+    def stats(self):
+        return {
+            "utterances": self.utterances,
+            "speculations_started": self.speculations_started,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / self.utterances if self.utterances else 0.0,
+            "wasted_prompt_tokens": self.wasted_prompt_tokens,
+            "wasted_completion_tokens": self.wasted_completion_tokens,
+        }
+
+    def _on_stable(self, transcript):
+        with self.lock:
+            if transcript != self.latest_transcript or self.speculation is not None:
+                return
+            if len(normalize_transcript(transcript).split()) < self.min_words:
+                return
+            # Build exactly what chat_with_history_streamed would send, without touching the real history
+            messages = TokenCountedHistory(model=self.openai_manager.chat_history.model)
+            with self.openai_manager.history_lock:
+                messages.extend_with_counts(self.openai_manager.chat_history, self.openai_manager.chat_history.message_tokens)
+                first_droppable = self.openai_manager.history_compactor.first_foldable_index() if self.openai_manager.history_compactor else 1
+            messages.append({"role": "user", "content": transcript})
+            while messages.total_tokens > 8000 and len(messages) > first_droppable:
+                messages.pop(first_droppable)
+            messages = self.openai_manager.build_request_messages(messages)
+            self.speculation = Speculation(self.openai_manager, transcript, messages)
+            self.speculations_started += 1
+
+    def _cancel_speculation(self):
+        if self.speculation is not None:
+            self._waste(self.speculation)
+            self.speculation = None
+
+    def _waste(self, speculation):
+        speculation.cancel()
+        self.wasted_prompt_tokens += speculation.prompt_tokens
+        self.wasted_completion_tokens += speculation.completion_tokens()
+
+
+class Speculation:
+    """One speculative GPT request, streamed into a buffer on a background thread"""
+
+    def __init__(self, openai_manager, prompt, messages):
+        self.prompt = prompt
+        self.normalized_prompt = normalize_transcript(prompt)
+        self.prompt_tokens = messages.total_tokens
+        self.encoding = get_encoding_for_model(messages.model)
+        self.received = []
+        self.deltas = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(openai_manager, messages), daemon=True)
+        self.thread.start()
+
+    def _run(self, openai_manager, messages):
+        completion_stream = openai_manager._stream_completion(messages)
+        try:
+            for text_delta in completion_stream:
+                if self.cancel_event.is_set():
+                    break
+                self.received.append(text_delta)
+                self.deltas.put(text_delta)
+        except Exception as e:
+            self.deltas.put(e)
+        finally:
+            completion_stream.close()
+            # None marks the end of the stream
+            self.deltas.put(None)
+
+    def replay(self):
+        """Yields everything received so far, then keeps yielding live deltas until the answer is done"""
+        try:
+            while True:
+                text_delta = self.deltas.get()
+                if text_delta is None:
+                    return
+                if isinstance(text_delta, Exception):
+                    raise text_delta
+                yield text_delta
+        finally:
+            # If the consumer stops early (e.g. barge-in), stop the request too
+            self.cancel()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def completion_tokens(self):
+        return len(self.encoding.encode("".join(self.received)))
@@ -0,0 +1,181 @@
+import functools
+
+# Every message follows <im_start>{role/name}\n{content}<im_end>\n
+TOKENS_PER_MESSAGE = 4
+# Every reply is primed with <im_start>assistant
+TOKENS_PER_REPLY = 2
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding_for_model(model='gpt-4o'):
+    """Returns the tiktoken encoding for a model. Loading an encoding is slow, so each one is only built once per process."""
+    if "gpt-4" in model or "gpt-3.5" in model or "o3-" in model:
+        encoding_name = "cl100k_base"
+    # For older models like davinci
+    elif "davinci" in model or "curie" in model or "babbage" in model or "ada" in model:
+        encoding_name = "p50k_base"
+    else:
+        # Default to cl100k_base for unknown models (safest for newer models)
+        encoding_name = "cl100k_base"
+    # Imported here, so only whoever needs an encoding pays for loading tiktoken
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_message_tokens(message, encoding):
+    """Number of tokens a single chat message adds to the prompt"""
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":  # if there's a name, the role is omitted
+            num_tokens += -1  # role is always required and always 1 token
+    return num_tokens
+
+
+def count_many_message_tokens(messages, encoding):
+    """Same as count_message_tokens, but encodes all the messages in one batch (much faster for big history restores)"""
+    values = [value for message in messages for value in message.values()]
+    encoded_lengths = iter(len(tokens) for tokens in encoding.encode_batch(values))
+    message_tokens = []
+    for message in messages:
+        num_tokens = TOKENS_PER_MESSAGE
+        for key in message:
+            num_tokens += next(encoded_lengths)
+            if key == "name":
+                num_tokens += -1
+        message_tokens.append(num_tokens)
+    return message_tokens
+
+
+class TokenCountedHistory(list):
+    """
+    A chat history list that remembers how many tokens each message is worth.
+    Each message is encoded exactly once, when it's added, and a running total is kept up to date,
+    so checking the history length or popping old messages never re-encodes anything.
+    It's still a normal list, so it can be passed straight to the OpenAI client.
+    """
+
+    def __init__(self, messages=(), model='gpt-4o'):
+        super().__init__()
+        self.model = model
+        self.message_tokens = []
+        self.total_tokens = TOKENS_PER_REPLY
+        self.extend(messages)
+
+    @property
+    def encoding(self):
+        return get_encoding_for_model(self.model)
+
+    def append(self, message):
+        num_tokens = count_message_tokens(message, self.encoding)
+        super().append(message)
+        self.message_tokens.append(num_tokens)
+        self.total_tokens += num_tokens
+
+    def extend(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+        new_tokens = count_many_message_tokens(messages, self.encoding)
+        self.extend_with_counts(messages, new_tokens)
+
+    def extend_with_counts(self, messages, message_tokens):
+        """Adds messages whose token counts are already known (e.g. restored from disk), without encoding them again"""
+        messages = list(messages)
+        message_tokens = list(message_tokens)
+        if len(messages) != len(message_tokens):
+            raise ValueError("Need exactly one token count per message")
+        super().extend(messages)
+        self.message_tokens.extend(message_tokens)
+        self.total_tokens += sum(message_tokens)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, message):
+        num_tokens = count_message_tokens(message, self.encoding)
+        super().insert(index, message)
+        self.message_tokens.insert(index, num_tokens)
+        self.total_tokens += num_tokens
+
+    def pop(self, index=-1):
+        message = super().pop(index)
+        self.total_tokens -= self.message_tokens.pop(index)
+        return message
+
+    def remove(self, message):
+        self.pop(self.index(message))
+
+    def clear(self):
+        super().clear()
+        self.message_tokens.clear()
+        self.total_tokens = TOKENS_PER_REPLY
+
+    def reverse(self):
+        super().reverse()
+        self.message_tokens.reverse()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            new_tokens = count_many_message_tokens(value, self.encoding) if value else []
+        else:
+            new_tokens = count_message_tokens(value, self.encoding)
+        super().__setitem__(index, value)
+        if isinstance(index, slice):
+            self.message_tokens[index] = new_tokens
+            self.total_tokens = TOKENS_PER_REPLY + sum(self.message_tokens)
+        else:
+            self.total_tokens += new_tokens - self.message_tokens[index]
+            self.message_tokens[index] = new_tokens
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        if isinstance(index, slice):
+            removed = self.message_tokens[index]
+            del self.message_tokens[index]
+            self.total_tokens -= sum(removed)
+        else:
+            self.total_tokens -= self.message_tokens.pop(index)
+
+
+# Benchmark
+if __name__ == '__main__':
+    import time
+    from openai_chat import num_tokens_from_messages
+
+    TOKEN_LIMIT = 8000
+    SYSTEM_MESSAGE = {"role": "system", "content": "You are an advanced AI-powered coding assistant. " * 300}
+    history_messages = [SYSTEM_MESSAGE] + [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message number {i}, please refactor the fetchData function to use async/await."}
+        for i in range(1000)
+    ]
+
+    # Old approach: a plain list, fully re-counted on every pop
+    start = time.perf_counter()
+    plain_history = list(history_messages)
+    while num_tokens_from_messages(plain_history) > TOKEN_LIMIT:
+        plain_history.pop(1)
+    old_seconds = time.perf_counter() - start
+
+    # New approach: counts cached on add (one batch encode), O(1) total update per pop
+    start = time.perf_counter()
+    counted_history = TokenCountedHistory(history_messages)
+    while counted_history.total_tokens > TOKEN_LIMIT:
+        counted_history.pop(1)
+    new_seconds = time.perf_counter() - start
+
+    assert len(plain_history) == len(counted_history)
+    assert num_tokens_from_messages(list(counted_history)) == counted_history.total_tokens
+    print(f"Trimming a {len(history_messages)}-message history down to {TOKEN_LIMIT} tokens:")
+    print(f"  num_tokens_from_messages loop: {old_seconds * 1000:.1f} ms")
+    print(f"  TokenCountedHistory:           {new_seconds * 1000:.1f} ms ({old_seconds / new_seconds:.0f}x faster)")
+
+    # Steady state: one new message per turn on an already-full history
+    start = time.perf_counter()
+    for i in range(100):
+        counted_history.append({"role": "user", "content": f"Turn {i}, delete this line please."})
+        while counted_history.total_tokens > TOKEN_LIMIT:
+            counted_history.pop(1)
+    print(f"  100 turns of append + trim:    {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,162 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class TTSAudioCache:
+    """
+    On-disk cache of synthesized speech. Files are named by a stable digest of (text, voice, model, format),
+    so the same phrase is only ever synthesized once, even across runs.
+    Total size is capped, and the least recently used files are evicted first.
+
+    Parameters:
+    cache_dir (str): folder the audio files and the index live in
+    max_bytes (int): the cache evicts old files once the audio in it adds up to more than this
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir="tts_cache", max_bytes=200 * 1024 * 1024):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> file size, ordered from least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index_dirty = False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+        # Hits only reorder the LRU list, so we don't rewrite the index for each one, just once on the way out
+        atexit.register(self.flush)
+
+    @staticmethod
+    def make_key(text, voice, model, file_format="mp3"):
+        """Stable across runs and machines, unlike Python's salted hash()"""
+        digest = hashlib.sha256(json.dumps([text, voice, model], ensure_ascii=False).encode("utf-8")).hexdigest()
+        return f"{digest}.{file_format}"
+
+    def get_file(self, text, voice, model, file_format="mp3"):
+        """Returns the path of the cached audio, or None if this phrase hasn't been synthesized before"""
+        key = self.make_key(text, voice, model, file_format)
+        with self.lock:
+            if key in self.entries:
+                file_path = os.path.join(self.cache_dir, key)
+                if os.path.exists(file_path):
+                    self.entries.move_to_end(key)
+                    self.index_dirty = True
+                    self.hits += 1
+                    return file_path
+                # Somebody deleted the file behind our back, forget about it
+                self.total_bytes -= self.entries.pop(key)
+            self.misses += 1
+            return None
+
+    def get_bytes(self, text, voice, model, file_format="mp3"):
+        file_path = self.get_file(text, voice, model, file_format)
+        if file_path is None:
+            return None
+        with open(file_path, "rb") as file:
+            return file.read()
+
+    def put(self, text, voice, model, file_format, audio_bytes):
+        """Stores the audio and returns the path it was saved to"""
+        key = self.make_key(text, voice, model, file_format)
+        file_path = os.path.join(self.cache_dir, key)
+        # Write to a temp file first so a crash never leaves a half-written file under a valid key
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(audio_bytes)
+        os.replace(temp_path, file_path)
+
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            self.entries[key] = len(audio_bytes)
+            self.total_bytes += len(audio_bytes)
+            self._evict_over_limit(keep_key=key)
+            self._save_index()
+        return file_path
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def flush(self):
+        with self.lock:
+            if self.index_dirty:
+                self._save_index()
+
+    def _evict_over_limit(self, keep_key=None):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            oldest_key = next(iter(self.entries))
+            if oldest_key == keep_key:
+                break
+            self.total_bytes -= self.entries.pop(oldest_key)
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, oldest_key))
+            except OSError:
+                pass
+
+    def _load_index(self):
+        # The index is a single small JSON list in LRU order, so loading it doesn't need to touch the audio files
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                saved_entries = json.load(file)
+        except (OSError, ValueError):
+            return
+        for key, size in saved_entries:
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict_over_limit()
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        temp_path = index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(list(self.entries.items()), file)
+        os.replace(temp_path, index_path)
+        self.index_dirty = False
+
+
+# Tests
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    test_dir = tempfile.mkdtemp()
+    try:
+        cache = TTSAudioCache(test_dir, max_bytes=250)
+        assert cache.get_file("Done!", "Liam", "eleven_monolingual_v1") is None
+        cache.put("Done!", "Liam", "eleven_monolingual_v1", "mp3", b"a" * 100)
+        cache.put("Sorry, try again.", "Liam", "eleven_monolingual_v1", "mp3", b"b" * 100)
+        assert cache.get_bytes("Done!", "Liam", "eleven_monolingual_v1") == b"a" * 100
+        # "Done!" was used most recently, so "Sorry" is the one that gets evicted
+        cache.put("Third phrase", "Liam", "eleven_monolingual_v1", "mp3", b"c" * 100)
+        assert cache.get_file("Sorry, try again.", "Liam", "eleven_monolingual_v1") is None
+        assert cache.get_file("Done!", "Doug", "eleven_monolingual_v1") is None  # different voice, different key
+        cache.flush()
+
+        # A fresh cache (i.e. the next run) picks up where the last one left off
+        reloaded_cache = TTSAudioCache(test_dir, max_bytes=250)
+        assert reloaded_cache.get_file("Done!", "Liam", "eleven_monolingual_v1") is not None
+        print(f"Cache stats: {cache.stats()}")
+        print(f"Reloaded cache stats: {reloaded_cache.stats()}")
+        reloaded_cache.flush()
+    finally:
+        shutil.rmtree(test_dir)
@@ -0,0 +1,261 @@
+import re
+import time
+import queue
+import threading
+from rich import print
+from concurrent.futures import ThreadPoolExecutor
+
+# A sentence ends with . ! or ? (plus any closing quotes/brackets) followed by whitespace, or with a line break
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+["\')\]]*\s+|\n+')
+# Softer break points we can use when a single sentence gets too long
+CLAUSE_END_PATTERN = re.compile(r'[,;:]\s+')
+
+
+def split_into_sentences(text, min_chars=12, max_chars=200):
+    """Splits text into speakable chunks. Returns (complete_chunks, leftover_text).
+    The leftover is whatever comes after the last sentence boundary, it might still be growing if the text is streamed in."""
+    chunks = []
+    start = 0
+    for match in SENTENCE_END_PATTERN.finditer(text):
+        chunk = text[start:match.end()].strip()
+        # Tiny fragments like "Ok." get merged into the next sentence so we don't pay a TTS round-trip for them
+        if len(chunk) < min_chars:
+            continue
+        chunks.append(chunk)
+        start = match.end()
+
+    leftover = text[start:]
+    # If there is no sentence end in sight, cut a long run at the last clause break instead
+    while len(leftover) > max_chars:
+        clause_ends = [m.end() for m in CLAUSE_END_PATTERN.finditer(leftover, 0, max_chars)]
+        cut = clause_ends[-1] if clause_ends else max_chars
+        chunks.append(leftover[:cut].strip())
+        leftover = leftover[cut:]
+    return chunks, leftover
+
+
+class SentenceTTSPipeline:
+    """
+    Turns a reply into audio sentence by sentence. Sentences are synthesized concurrently (bounded worker pool)
+    and played back strictly in order through the audio manager's gapless queue, so the first sentence is
+    audible after a single short TTS round-trip instead of after the whole reply has been synthesized.
+    With streamed on, a sentence doesn't wait to be synthesized in full: its audio is streamed into a buffer and starts
+    playing once preroll_ms of it is there, while the rest is still coming in.
+
+    Parameters:
+    tts_manager: anything with text_to_audio_bytes(text, voice) that returns encoded audio (e.g. ElevenLabsManager),
+                 and text_to_audio_stream(text, voice) if streamed
+    audio_manager: anything with play_audio_queued(audio) and wait_for_queued_audio() (e.g. AudioManager),
+                   and open_stream() / play_stream() if streamed
+    max_workers (int): how many sentences can be synthesized (or streamed) at the same time
+    tracer (LatencyTracer): if given, each sentence's synthesis is recorded as a "tts_sentence" span (up to its preroll, if streamed)
+    streamed (bool): stream each sentence's audio instead of waiting for the whole clip
+    preroll_ms (float): how much of a streamed sentence is buffered before it plays
+    """
+
+    def __init__(self, tts_manager, audio_manager, voice="Liam", max_workers=3, tracer=None, streamed=False, preroll_ms=150):
+        self.tts_manager = tts_manager
+        self.streamed = streamed
+        self.preroll_ms = preroll_ms
+        synthesize = self._open_stream if streamed else tts_manager.text_to_audio_bytes
+        self.synthesize = synthesize if tracer is None else tracer.traced("tts_sentence", synthesize)
+        self.audio_manager = audio_manager
+        self.voice = voice
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+        # A stream keeps its TTS request open until it's read to the end, so no more than max_workers are open at a time
+        self.stream_slots = threading.Semaphore(max_workers)
+        self.open_streams = []
+        self.pending_text = ""
+        self.chunk_futures = queue.Queue()
+        self.cancelled = False
+        self.started_at = None
+        self.first_audio_at = None
+        self.playback_thread = threading.Thread(target=self._playback_loop, daemon=True)
+        self.playback_thread.start()
+
+    def feed(self, text_delta):
+        """Adds more reply text (e.g. a streamed GPT delta). Every completed sentence is sent off to be synthesized right away."""
+        if self.cancelled or not text_delta:
+            return
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        chunks, self.pending_text = split_into_sentences(self.pending_text + text_delta)
+        for chunk in chunks:
+            self._submit(chunk)
+
+    def finish(self):
+        """Call this once the reply is complete, it flushes whatever text is left after the last sentence end"""
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        leftover = self.pending_text.strip()
+        self.pending_text = ""
+        if leftover and not self.cancelled:
+            self._submit(leftover)
+        # None tells the playback loop there is nothing more coming
+        self.chunk_futures.put(None)
+
+    def wait_until_done(self):
+        """Blocks until every sentence has finished playing"""
+        self.playback_thread.join()
+        self.executor.shutdown(wait=True)
+
+    def speak(self, text):
+        """Convenience for when the full reply is already known"""
+        self.feed(text)
+        self.finish()
+        self.wait_until_done()
+
+    def cancel(self, fade_ms=150):
+        """Stops the sentence that is playing (with a short fade) and drops every sentence that hasn't played yet"""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        while True:
+            try:
+                chunk_future = self.chunk_futures.get_nowait()
+            except queue.Empty:
+                break
+            if chunk_future is not None:
+                # Only sentences still waiting for a worker can be cancelled, ones already being synthesized are just ignored
+                chunk_future.cancel()
+        self.chunk_futures.put(None)
+        self.audio_manager.stop_audio(fade_ms)
+        # Sentences that were streaming but never got to play
+        for audio_stream in self.open_streams:
+            audio_stream.cancel()
+
+    @property
+    def time_to_first_audio(self):
+        """Seconds between the first text arriving and the first sentence starting to play (None if nothing played yet)"""
+        if self.started_at is None or self.first_audio_at is None:
+            return None
+        return self.first_audio_at - self.started_at
+
+    def _submit(self, chunk):
+        chunk_future = self.executor.submit(self.synthesize, chunk, self.voice)
+        self.chunk_futures.put(chunk_future)
+
+    def _open_stream(self, chunk, voice):
+        """Starts streaming a sentence's audio into a buffer, returns the AudioStream once preroll_ms of it is there"""
+        self.stream_slots.acquire()
+        try:
+            chunks, audio_format, sample_rate = self.tts_manager.text_to_audio_stream(chunk, voice)
+            audio_stream = self.audio_manager.open_stream(chunks, audio_format, sample_rate, on_done=self.stream_slots.release)
+        except BaseException:
+            self.stream_slots.release()
+            raise
+        self.open_streams.append(audio_stream)
+        if self.cancelled:
+            audio_stream.cancel()
+        audio_stream.wait_for_preroll(self.preroll_ms)
+        return audio_stream
+
+    def _playback_loop(self):
+        while True:
+            chunk_future = self.chunk_futures.get()
+            if chunk_future is None or self.cancelled:
+                break
+            try:
+                audio = chunk_future.result()
+            except Exception as e:
+                print(f"[red]Couldn't synthesize a sentence, skipping it: {e}")
+                continue
+            if self.streamed:
+                if audio.error is not None and not audio.ring.buffered():
+                    print(f"[red]Couldn't stream a sentence, skipping it: {audio.error}")
+                    continue
+                playback = self.audio_manager.play_stream(audio, preroll_ms=self.preroll_ms)
+                # Once the whole sentence is queued on the channel, the next one can follow it without a gap
+                playback.fed.result()
+                if self.first_audio_at is None:
+                    self.first_audio_at = playback.first_audio_at
+            else:
+                # Waits until the previous sentence is about to end, so this one starts without a gap
+                self.audio_manager.play_audio_queued(audio)
+            if self.cancelled:
+                # We were cancelled while waiting for the channel, so make sure this sentence doesn't play
+                self.audio_manager.stop_audio(0)
+                break
+            if self.first_audio_at is None:
+                self.first_audio_at = time.perf_counter()
+        self.audio_manager.wait_for_queued_audio()
+
+
+class FakeTTSManager:
+    """Offline stand-in for ElevenLabsManager. Takes a fixed amount of time plus a bit per character, like the real API."""
+
+    def __init__(self, base_latency=0.2, latency_per_char=0.002):
+        self.base_latency = base_latency
+        self.latency_per_char = latency_per_char
+        self.synthesized = []
+
+    def text_to_audio_bytes(self, input_text, voice="Fake Voice"):
+        time.sleep(self.base_latency + self.latency_per_char * len(input_text))
+        self.synthesized.append(input_text)
+        return input_text.encode("utf-8")
+
+
+class FakeAudioPlayer:
+    """Offline stand-in for AudioManager's queued playback. 'Plays' each clip for a fixed time and records the order."""
+
+    def __init__(self, seconds_per_clip=0.1):
+        self.seconds_per_clip = seconds_per_clip
+        self.played = []
+        self.play_until = 0
+
+    def play_audio_queued(self, audio):
+        # Just like a real channel queue, we only accept the next clip once the current one is about to end
+        time.sleep(max(0, self.play_until - time.perf_counter()))
+        self.played.append(audio)
+        self.play_until = time.perf_counter() + self.seconds_per_clip
+
+    def wait_for_queued_audio(self):
+        time.sleep(max(0, self.play_until - time.perf_counter()))
+
+    def stop_audio(self, fade_ms=150):
+        self.play_until = 0
+
+
+# Tests
+if __name__ == '__main__':
+    REPLY = ("CREATE FUNCTION:\nHere's a function that fetches data from a URL. "
+             "It uses the requests library and raises an error for bad status codes. "
+             "You can call it with any URL you like! Does that work for you? "
+             "Let me know if you want retries added as well.")
+
+    # Sentence splitting test
+    chunks, leftover = split_into_sentences(REPLY)
+    print(f"Split into {len(chunks)} sentences, leftover: '{leftover}'")
+    assert leftover == "Let me know if you want retries added as well."
+
+    # Serial baseline: synthesize everything, then play
+    fake_tts = FakeTTSManager()
+    start = time.perf_counter()
+    fake_tts.text_to_audio_bytes(REPLY)
+    serial_first_audio = time.perf_counter() - start
+
+    # Pipelined, with the reply streamed in a few characters at a time like GPT does
+    fake_tts = FakeTTSManager()
+    fake_player = FakeAudioPlayer()
+    pipeline = SentenceTTSPipeline(fake_tts, fake_player, max_workers=3)
+    for i in range(0, len(REPLY), 7):
+        pipeline.feed(REPLY[i:i + 7])
+    pipeline.finish()
+    pipeline.wait_until_done()
+
+    expected_order = [chunk.encode("utf-8") for chunk in chunks + [leftover]]
+    assert fake_player.played == expected_order, fake_player.played
+    print(f"Played {len(fake_player.played)} sentences in order")
+    print(f"Time to first audio: serial {serial_first_audio:.3f}s, pipelined {pipeline.time_to_first_audio:.3f}s")
+    assert pipeline.time_to_first_audio < serial_first_audio
+
+    # Cancelling halfway through (barge-in) should drop the remaining sentences
+    fake_player = FakeAudioPlayer(seconds_per_clip=0.3)
+    pipeline = SentenceTTSPipeline(FakeTTSManager(base_latency=0.05), fake_player)
+    pipeline.feed(REPLY)
+    pipeline.finish()
+    time.sleep(0.5)
+    pipeline.cancel()
+    pipeline.wait_until_done()
+    assert 0 < len(fake_player.played) < len(expected_order), fake_player.played
+    print(f"Cancelled after {len(fake_player.played)} of {len(expected_order)} sentences")
@@ -0,0 +1,599 @@
+import os
+import asyncio
+import itertools
+import threading
+import concurrent.futures
+from rich import print
+from tts_pipeline import SentenceTTSPipeline
+from barge_in import BargeInController
+from speculative_prefetch import SpeculativePrefetcher
+from voice_activity import MicrophoneEndpointer
+from command_stream_parser import StreamingCommandParser
+from latency_tracer import LatencyTracer
+
+
+class Turn:
+    """One user request making its way through the pipeline"""
+
+    def __init__(self, turn_id, text="", from_voice=False, carried_over_text=""):
+        self.turn_id = turn_id
+        self.text = text
+        self.from_voice = from_voice
+        self.carried_over_text = carried_over_text
+        # The turn's LatencyTracer marks, set once it starts
+        self.trace = None
+        # Resolves with the turn's result dict once the answer has finished playing
+        self.future = concurrent.futures.Future()
+
+
+class TurnOrchestrator:
+    """
+    Runs the whole assistant pipeline (STT -> GPT -> TTS -> playback -> editor commands) on one asyncio loop in a background thread.
+    Turns run one at a time, in the order they were submitted. Inside a turn the stages overlap: GPT deltas go through a bounded
+    queue to the TTS pipeline while GPT is still answering. The same deltas go through a StreamingCommandParser, and every edit is sent to
+    VS Code the moment its code block is complete, while GPT is still writing the rest; a separate stage waits for VS Code's answers.
+    Blocking work (the Azure mic, the OpenAI stream, waiting for playback) runs in worker threads via asyncio.to_thread.
+
+    The GUI and the F4 loop only submit turns and subscribe to events, they never run a stage themselves.
+    Every event is a dict with "type" and "turn_id", plus:
+        turn_queued, turn_started, turn_rejected (the queue was full)
+        listening (carried_over_text), partial (text), heard (text), no_speech
+        thinking (text), delta (text), answer_done (text), speaking
+        command_queued (op, line), command_done (op, line, command, ok, error, apply_ms, round_trip_ms: VS Code's answer)
+        turn_done (status, prompt, response, carried_over_text), timeout, error (stage, error)
+    Callbacks are called on the orchestrator's thread, so a GUI has to hand them over to its own thread.
+    Every turn is traced (see LatencyTracer): the time from the user stopping to the transcript, to GPT's first token, to the
+    first audio, plus stage spans for listening, each TTS sentence, playback, sending edits and VS Code's acks. See tracer.summary().
+
+    Parameters:
+    openai_manager: OpenAiManager
+    speech_to_text: SpeechToTextManager
+    tts_manager: anything with text_to_audio_bytes(text, voice) (e.g. ElevenLabsManager), and text_to_audio_stream(text, voice) for streamed_speech
+    audio_manager: AudioManager (or anything the SentenceTTSPipeline can play through)
+    voice (str): ElevenLabs voice for the answers
+    barge_in (bool): listen for the user talking over the answer, and cut the answer off when they do
+    speculative_prefetch (bool): start the GPT request while the user is still talking
+    auto_stop (bool): stop listening by itself once the user stops talking
+    streamed_speech (bool): play each sentence while its audio is still coming in, instead of once it's all synthesized
+    turn_timeout (float): seconds a turn may take from the prompt being known to the answer finishing playing
+    max_pending_turns (int): turns waiting behind the current one, anything submitted beyond this is rejected
+    max_buffered_deltas (int): GPT deltas that can pile up ahead of the TTS stage before GPT is made to wait
+    max_pending_commands (int): edits sent to VS Code whose answer hasn't been waited for yet
+    tracer (LatencyTracer): where the turns' latencies go, a new one by default
+    """
+
+    def __init__(self, openai_manager, speech_to_text, tts_manager, audio_manager, voice="Liam",
+                 barge_in=True, speculative_prefetch=False, auto_stop=True, turn_timeout=120.0,
+                 max_pending_turns=3, max_buffered_deltas=64, max_pending_commands=8, tracer=None, streamed_speech=False):
+        self.openai_manager = openai_manager
+        self.speech_to_text = speech_to_text
+        self.tts_manager = tts_manager
+        self.audio_manager = audio_manager
+        self.voice = voice
+        self.listen_for_barge_in = barge_in
+        self.speculative_prefetch = speculative_prefetch
+        self.auto_stop = auto_stop
+        self.streamed_speech = streamed_speech
+        self.turn_timeout = turn_timeout
+        self.max_pending_turns = max_pending_turns
+        self.max_buffered_deltas = max_buffered_deltas
+        # How long a cancelled turn waits for the GPT thread to notice, so its partial answer is in the history before the next turn
+        self.cancel_grace_seconds = 2.0
+        self.tracer = tracer if tracer is not None else LatencyTracer()
+
+        self.barge_in = BargeInController(speech_to_text)
+        self.prefetcher = SpeculativePrefetcher(openai_manager)
+        self.endpointer = MicrophoneEndpointer(self.stop_listening)
+        # Set once the endpointer couldn't open the mic, so the fallback is only reported the first time
+        self.endpointer_failed = False
+
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.turn_ids = itertools.count(1)
+        self.pending_turns = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        self.current_turn = None
+
+        self.loop = asyncio.new_event_loop()
+        self.turn_queue = asyncio.Queue(max_pending_turns)
+        self.command_queue = asyncio.Queue(max_pending_commands)
+        # Held while something is being spoken, so a spoken error never talks over an answer
+        self.speech_lock = asyncio.Lock()
+        # Errors to say out loud. Unbounded, and spoken by their own task, so the command stage never waits for the
+        # answer that's holding speech_lock (which could itself be waiting for room in command_queue)
+        self.spoken_errors = asyncio.Queue()
+        self.tasks = [
+            self.loop.create_task(self._process_turns()),
+            self.loop.create_task(self._process_commands()),
+            self.loop.create_task(self._speak_errors()),
+        ]
+        self.thread = threading.Thread(target=self.loop.run_forever, name="turn-orchestrator", daemon=True)
+        self.thread.start()
+
+    def subscribe(self, callback):
+        """callback(event) is called for every pipeline event, see the class docstring"""
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def submit_text_turn(self, text):
+        """Queues a typed message. Returns a Future for the turn's result dict."""
+        return self._submit(Turn(next(self.turn_ids), text=text))
+
+    def submit_voice_turn(self, carried_over_text=""):
+        """Queues a turn that starts by listening to the mic. Returns a Future for the turn's result dict."""
+        return self._submit(Turn(next(self.turn_ids), from_voice=True, carried_over_text=carried_over_text))
+
+    def interrupt(self):
+        """Cuts off the answer that is being streamed or played right now. Safe to call from any thread."""
+        self.barge_in.interrupt()
+
+    def stop_listening(self):
+        """Ends the utterance a voice turn is listening to (the Stop button / P key, or the endpointer)"""
+        turn = self.current_turn
+        if turn is not None and turn.trace is not None:
+            turn.trace.mark("stop")
+        self.speech_to_text.stop_recording()
+
+    def wait_until_idle(self, timeout=None):
+        """Blocks until every submitted turn (and any follow-up after a barge-in) is done. Returns False on timeout."""
+        return self.idle.wait(timeout)
+
+    def shutdown(self):
+        self.stop_listening()
+        self.interrupt()
+        try:
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result(timeout=5)
+        except concurrent.futures.TimeoutError:
+            print("[red]Turn orchestrator didn't stop in time")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+    async def _cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def _submit(self, turn):
+        with self.lock:
+            if self.pending_turns >= self.max_pending_turns:
+                accepted = False
+            else:
+                accepted = True
+                self.pending_turns += 1
+                self.idle.clear()
+        if not accepted:
+            # Better to say no right away than to pile up turns (and threads) behind a slow answer
+            self._emit("turn_rejected", turn, text=turn.text)
+            turn.future.set_result(self._result(turn, "rejected"))
+            return turn.future
+        self._emit("turn_queued", turn, text=turn.text, from_voice=turn.from_voice)
+        # Never blocks, pending_turns already made sure there is room
+        self.loop.call_soon_threadsafe(self.turn_queue.put_nowait, turn)
+        return turn.future
+
+    def _emit(self, event_type, turn, **data):
+        event = {"type": event_type, "turn_id": turn.turn_id, **data}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[red]Turn event subscriber failed on {event_type}: {e}")
+
+    @staticmethod
+    def _result(turn, status, response="", carried_over_text=""):
+        return {
+            "turn_id": turn.turn_id,
+            "status": status,
+            "prompt": turn.text,
+            "response": response,
+            "carried_over_text": carried_over_text,
+        }
+
+    async def _process_turns(self):
+        while True:
+            turn = await self.turn_queue.get()
+            with self.lock:
+                self.pending_turns -= 1
+            while turn is not None:
+                # A barge-in hands back a follow-up voice turn, which goes ahead of anything else that's waiting
+                turn = await self._run_turn(turn)
+            with self.lock:
+                if self.pending_turns == 0:
+                    self.idle.set()
+
+    async def _run_turn(self, turn):
+        turn.trace = self.tracer.start_turn(turn.turn_id)
+        self.current_turn = turn
+        self._emit("turn_started", turn, from_voice=turn.from_voice)
+        result = self._result(turn, "done")
+        follow_up = None
+        try:
+            if turn.from_voice:
+                turn.text = await self._listen_stage(turn)
+                result["prompt"] = turn.text
+                if not turn.text:
+                    result["status"] = "no_speech"
+                    self._emit("no_speech", turn)
+                    return None
+                turn.trace.mark("transcript")
+                self._emit("heard", turn, text=turn.text)
+            turn.trace.mark("prompt")
+            async with self.speech_lock:
+                await asyncio.wait_for(self._answer(turn, result), self.turn_timeout)
+        except asyncio.TimeoutError:
+            result["status"] = "timeout"
+            print(f"[red]Turn {turn.turn_id} took longer than {self.turn_timeout}s, cancelled it")
+            self._emit("timeout", turn, seconds=self.turn_timeout)
+        except Exception as e:
+            result["status"] = "error"
+            stage = "listening" if turn.from_voice and not turn.text else "answer"
+            print(f"[red]Turn {turn.turn_id} failed while {stage}: {e}")
+            self._emit("error", turn, stage=stage, error=str(e))
+        finally:
+            self.current_turn = None
+            if result["status"] != "no_speech":
+                result["carried_over_text"] = await asyncio.to_thread(self.barge_in.end_turn)
+                if result["carried_over_text"]:
+                    result["status"] = "interrupted"
+                    follow_up = Turn(next(self.turn_ids), from_voice=True, carried_over_text=result["carried_over_text"])
+            turn.trace.finish(result["status"])
+            self._emit("turn_done", turn, **{key: value for key, value in result.items() if key != "turn_id"})
+            turn.future.set_result(result)
+        return follow_up
+
+    async def _listen_stage(self, turn):
+        self._emit("listening", turn, carried_over_text=turn.carried_over_text)
+        return await asyncio.to_thread(self._listen, turn)
+
+    def _listen(self, turn):
+        self.prefetcher.begin_utterance(turn.carried_over_text)
+
+        def on_partial(partial_text):
+            self._emit("partial", turn, text=partial_text)
+            if self.speculative_prefetch:
+                self.prefetcher.on_partial(partial_text)
+
+        try:
+            if self.auto_stop:
+                try:
+                    self.endpointer.start()
+                except Exception as e:
+                    # No capture device, or the mic can't be opened: this turn is stopped by hand (F4 / the stop button)
+                    if not self.endpointer_failed:
+                        print(f"[yellow]Can't listen for the end of speech ({e}), stop recording by hand instead")
+                        self.endpointer_failed = True
+            with self.tracer.span("listen"):
+                heard_text = self.speech_to_text.speechtotext_from_mic_continuous(on_partial)
+        finally:
+            self.endpointer.stop()
+        return f"{turn.carried_over_text} {heard_text}".strip()
+
+    async def _answer(self, turn, result):
+        tts_pipeline = SentenceTTSPipeline(self.tts_manager, self.audio_manager, self.voice, tracer=self.tracer,
+                                           streamed=self.streamed_speech)
+        cancel_event = await asyncio.to_thread(self.barge_in.start_turn, tts_pipeline, self.listen_for_barge_in)
+        completion_stream = self.prefetcher.claim(turn.text) if self.speculative_prefetch and turn.from_voice else None
+        delta_queue = asyncio.Queue(self.max_buffered_deltas)
+        abandoned = threading.Event()
+        self._emit("thinking", turn, text=turn.text)
+        producer = asyncio.ensure_future(asyncio.to_thread(
+            self._produce_deltas, turn.text, cancel_event, completion_stream, delta_queue, abandoned
+        ))
+        command_parser = StreamingCommandParser()
+        # All of the answer's edits share one undo step in VS Code (closed once the answer is done), and line numbers that refer to the file before the answer
+        edit_session = f"py{os.getpid()}-turn{turn.turn_id}"
+        edits_sent = 0
+        response_parts = []
+        try:
+            while (text_delta := await delta_queue.get()) is not None:
+                turn.trace.mark("first_token")
+                response_parts.append(text_delta)
+                tts_pipeline.feed(text_delta)
+                self._emit("delta", turn, text=text_delta)
+                for operation in command_parser.feed(text_delta):
+                    edits_sent += await self._send_edit(turn, operation, edit_session, cancel_event)
+            # Raises whatever went wrong with the GPT request
+            await producer
+            tts_pipeline.finish()
+            for operation in command_parser.finish():
+                edits_sent += await self._send_edit(turn, operation, edit_session, cancel_event)
+            response = "".join(response_parts)
+            result["response"] = response
+            turn.trace.mark("answer_done")
+            self._emit("answer_done", turn, text=response)
+
+            self._emit("speaking", turn)
+            with self.tracer.span("playback_after_answer"):
+                await asyncio.to_thread(tts_pipeline.wait_until_done)
+            if tts_pipeline.first_audio_at is not None:
+                turn.trace.mark("first_audio", at=tts_pipeline.first_audio_at)
+            if cancel_event.is_set():
+                result["status"] = "interrupted"
+        except BaseException:
+            # Timed out, failed or shutting down: stop everything this turn started
+            abandoned.set()
+            cancel_event.set()
+            tts_pipeline.cancel(self.barge_in.fade_ms)
+            while not delta_queue.empty():
+                delta_queue.get_nowait()
+            result["response"] = "".join(response_parts)
+            await asyncio.wait({producer}, timeout=self.cancel_grace_seconds)
+            raise
+        finally:
+            if edits_sent:
+                self.openai_manager.vscode_api.end_edit_session(edit_session)
+
+    def _produce_deltas(self, prompt, cancel_event, completion_stream, delta_queue, abandoned):
+        # Runs in a worker thread. Waiting on the bounded queue means GPT is paused if the TTS stage falls behind.
+        def put(item):
+            if not abandoned.is_set():
+                asyncio.run_coroutine_threadsafe(delta_queue.put(item), self.loop).result()
+
+        try:
+            for text_delta in self.openai_manager.chat_with_history_streamed(prompt, cancel_event, completion_stream, process_commands=False):
+                put(text_delta)
+        finally:
+            # None marks the end of the answer
+            put(None)
+
+    async def _send_edit(self, turn, operation, edit_session, cancel_event):
+        # An interrupted answer sends nothing more, edits whose code block was already complete have been sent.
+        # Returns whether the edit was sent
+        if cancel_event.is_set():
+            return False
+        where = f"line {operation['line']}" if operation["line"] else "the cursor"
+        print(f"[blue]📝 Sending {operation['op']} at {where} to VS Code while the answer streams[/]")
+        with self.tracer.span("send_command"):
+            command_future = self.openai_manager.vscode_api.apply_edits([operation], edit_session)
+        await self.command_queue.put((turn, operation, command_future))
+        self._emit("command_queued", turn, op=operation["op"], line=operation["line"])
+        return True
+
+    async def _process_commands(self):
+        # Waiting for VS Code's answers gets its own stage, so it never holds up the answer being spoken (or the next turn)
+        while True:
+            turn, operation, command_future = await self.command_queue.get()
+            try:
+                # Wait for VS Code to say whether the edit actually landed
+                command_result = await asyncio.wrap_future(command_future)
+                if command_result["round_trip_ms"] is not None:
+                    self.tracer.record("command_to_editor_ack", command_result["round_trip_ms"])
+                if command_result["apply_ms"] is not None:
+                    self.tracer.record("editor_apply", command_result["apply_ms"])
+                self._emit("command_done", turn, op=operation["op"], line=operation["line"],
+                           **{key: value for key, value in command_result.items() if key != "id"})
+                if not command_result["ok"]:
+                    self.spoken_errors.put_nowait(f"Sorry, that change didn't make it into VS Code. {command_result['error']}")
+            except Exception as e:
+                print(f"[red]Couldn't apply the editor command from turn {turn.turn_id}: {e}")
+                self._emit("error", turn, stage="command", error=str(e))
+
+    async def _speak_errors(self):
+        while True:
+            text = await self.spoken_errors.get()
+            try:
+                await self._say(text)
+            except Exception as e:
+                print(f"[red]Couldn't say an error out loud: {e}")
+
+    async def _say(self, text):
+        async with self.speech_lock:
+            tts_pipeline = SentenceTTSPipeline(self.tts_manager, self.audio_manager, self.voice, tracer=self.tracer,
+                                               streamed=self.streamed_speech)
+            await asyncio.to_thread(tts_pipeline.speak, text)
+
+
+# Tests
+if __name__ == '__main__':
+    import time
+    from openai_chat import OpenAiManager
+    from token_budget import TokenCountedHistory
+    from editor_context import EditorContextMirror
+    from tts_pipeline import FakeTTSManager, FakeAudioPlayer
+    from azure_speech_to_text import SpeechToTextManager, FakeRecognizer
+
+    class FakeEditor:
+        """Stands in for VSCodeAPIHandler, every edit succeeds except replacing a line"""
+
+        def __init__(self):
+            self.commands = []
+            self.sessions = set()
+            self.ended_sessions = []
+            self.editor_context = EditorContextMirror()
+
+        def apply_edits(self, operations, session=None):
+            self.commands.extend(operation["op"] for operation in operations)
+            self.sessions.add(session)
+            ok = all(operation["op"] != "replaceLine" for operation in operations)
+            future = concurrent.futures.Future()
+            future.set_result({"id": str(len(self.commands)), "command": "batch", "ok": ok,
+                               "error": None if ok else "No active editor", "apply_ms": 1, "round_trip_ms": 2})
+            return future
+
+        def end_edit_session(self, session):
+            self.ended_sessions.append(session)
+
+    class FakeGptManager(OpenAiManager):
+        """OpenAiManager that answers offline, word by word, with a fixed reply"""
+
+        def __init__(self, answer, seconds_per_word=0.01):
+            self.chat_history = TokenCountedHistory()
+            self.vscode_api = FakeEditor()
+            self.editor_context_tokens = 1500
+            self.workspace_index = None
+            self.history_lock = threading.RLock()
+            self.history_compactor = None
+            self.response_cache = None
+            self.journal = None
+            self.answer = answer
+            self.seconds_per_word = seconds_per_word
+
+        def _stream_completion(self, messages):
+            for word in self.answer.split(" "):
+                time.sleep(self.seconds_per_word)
+                yield word + " "
+
+    def make_orchestrator(answer, seconds_per_word=0.01, **kwargs):
+        gpt = FakeGptManager(answer, seconds_per_word)
+        speech_to_text = SpeechToTextManager(FakeRecognizer(speed=20.0))
+        kwargs.setdefault("auto_stop", False)
+        orchestrator = TurnOrchestrator(gpt, speech_to_text, FakeTTSManager(0.02, 0), FakeAudioPlayer(0.02),
+                                        barge_in=False, **kwargs)
+        events = []
+        orchestrator.subscribe(events.append)
+        return gpt, orchestrator, events
+
+    answer = "Sure thing. Here is a short answer. It has a few sentences. That is all."
+
+    # A typed turn goes through every stage, in order
+    gpt, orchestrator, events = make_orchestrator(answer)
+    result = orchestrator.submit_text_turn("Say something").result(timeout=10)
+    assert result["status"] == "done" and result["response"].strip() == answer, result
+    event_types = [event["type"] for event in events]
+    assert event_types[:3] == ["turn_queued", "turn_started", "thinking"], event_types
+    assert event_types[-2:] == ["speaking", "turn_done"], event_types
+    assert "".join(event["text"] for event in events if event["type"] == "delta").strip() == answer
+    assert [message["role"] for message in gpt.chat_history] == ["user", "assistant"]
+    print("[green]Text turn streams through GPT, TTS and playback")
+
+    # Voice turns listen first (the fake recognizer replays TestAudio_WAV.wav 20x faster)
+    threading.Timer(0.2, orchestrator.stop_listening).start()
+    result = orchestrator.submit_voice_turn().result(timeout=10)
+    assert result["prompt"] == "This is a test recording" and result["status"] == "done", result
+    print("[green]Voice turn hears the recording and answers it")
+
+    # Both turns were traced, stage by stage
+    spans = orchestrator.tracer.summary()
+    for span in ("stop_to_transcript", "transcript_to_first_token", "first_token_to_first_audio", "turn", "listen", "tts_sentence"):
+        assert spans.get(span, {}).get("count"), (span, list(spans))
+    assert spans["turn"]["count"] == 2 and spans["stop_to_transcript"]["count"] == 1
+    print(orchestrator.tracer.format_summary())
+
+    # Sending lots of messages quickly queues a few and rejects the rest, instead of starting a thread for each
+    threads_before = threading.active_count()
+    futures = [orchestrator.submit_text_turn(f"Message {i}") for i in range(10)]
+    statuses = [future.result(timeout=20)["status"] for future in futures]
+    assert statuses.count("rejected") >= 6 and statuses.count("done") >= 3, statuses
+    assert orchestrator.wait_until_idle(5)
+    print(f"[green]10 rapid messages: {statuses.count('done')} answered, {statuses.count('rejected')} rejected, "
+          f"{threading.active_count() - threads_before} extra threads left over")
+    orchestrator.shutdown()
+
+    # Interrupting stops the answer, keeps the partial answer and skips the edit whose code never finished
+    gpt, orchestrator, events = make_orchestrator("EDIT ROW:\n" + answer * 5 + "\n```python\nx = 1\n```", seconds_per_word=0.02)
+    future = orchestrator.submit_text_turn("Delete this line")
+    while not any(event["type"] == "delta" for event in events):
+        time.sleep(0.01)
+    orchestrator.interrupt()
+    result = future.result(timeout=10)
+    assert len(result["response"]) < len(gpt.answer) and gpt.vscode_api.commands == [], result
+    assert gpt.chat_history[-1]["role"] == "assistant"
+    print("[green]Interrupted turn stops early and doesn't touch the editor")
+
+    # A finished command answer is applied by the command stage
+    gpt.answer = "DELETE ROW:\nI'll delete the selected line."
+    orchestrator.submit_text_turn("Delete this line").result(timeout=10)
+    time.sleep(0.1)
+    assert gpt.vscode_api.commands == ["deleteLine"], gpt.vscode_api.commands
+    assert [event["ok"] for event in events if event["type"] == "command_done"] == [True]
+    print("[green]Command stage applies the editor command")
+
+    # Edits go to VS Code as soon as their code block closes, long before the explanation after it is done
+    gpt.answer = ("CREATE FUNCTION: 3\n```js\nfunction a() {}\n```\n" + answer * 3 +
+                  "\nCREATE FUNCTION: 9\n```\nfunction b() {}\n```\n" + answer * 3)
+    events.clear()
+    orchestrator.submit_text_turn("Add two functions").result(timeout=10)
+    event_types = [event["type"] for event in events]
+    deltas_before_first_edit = event_types[:event_types.index("command_queued")].count("delta")
+    assert event_types.count("command_queued") == 2 and deltas_before_first_edit < event_types.count("delta") / 4, event_types
+    assert event_types.index("command_queued") < event_types.index("answer_done")
+    assert len(gpt.vscode_api.sessions) == 2 and None not in gpt.vscode_api.sessions
+    # Each answer's undo step is closed once its last edit is out
+    assert sorted(gpt.vscode_api.ended_sessions) == sorted(gpt.vscode_api.sessions), gpt.vscode_api.ended_sessions
+    print(f"[green]First edit sent after {deltas_before_first_edit} of {event_types.count('delta')} deltas, before the answer was done")
+
+    # When VS Code says no, the assistant says so out loud
+    gpt.answer = "EDIT ROW:\nI'll fix that line.\n```python\nx = 1\n```"
+    spoken_before = len(orchestrator.audio_manager.played)
+    orchestrator.submit_text_turn("Fix this line").result(timeout=10)
+    time.sleep(0.5)
+    failed = [event for event in events if event["type"] == "command_done" and not event["ok"]]
+    assert failed and failed[0]["error"] == "No active editor", failed
+    spoken = [audio.decode() for audio in orchestrator.audio_manager.played[spoken_before:]]
+    assert any("didn't make it into VS Code" in text for text in spoken), spoken
+    assert orchestrator.tracer.summary()["command_to_editor_ack"]["count"] == len(gpt.vscode_api.commands)
+    print("[green]Failed command is reported out loud")
+
+    # A failed edit followed by more edits than the command stage holds: its spoken error waits for the answer to finish,
+    # the edits behind it don't
+    gpt.answer = "EDIT ROW: 1\n```python\nx = 1\n```\n" + "".join(
+        f"CREATE FUNCTION: {line}\n```python\ndef f{line}(): pass\n```\n" for line in range(2, 13))
+    commands_before = len(gpt.vscode_api.commands)
+    start = time.perf_counter()
+    result = orchestrator.submit_text_turn("Fix it and add eleven functions").result(timeout=10)
+    assert result["status"] == "done" and time.perf_counter() - start < 5, result
+    assert len(gpt.vscode_api.commands) - commands_before == 12, gpt.vscode_api.commands
+    print("[green]A failed edit followed by 11 more didn't hold up the answer")
+    orchestrator.shutdown()
+
+    # Without a mic for the endpointer, voice turns still work with a manual stop
+    gpt, orchestrator, events = make_orchestrator(answer, auto_stop=True)
+    def no_microphone():
+        raise RuntimeError("No microphone found for voice activity detection")
+    orchestrator.endpointer.start = no_microphone
+    for _ in range(2):
+        threading.Timer(0.2, orchestrator.stop_listening).start()
+        result = orchestrator.submit_voice_turn().result(timeout=10)
+        assert result["status"] == "done" and result["prompt"] == "This is a test recording", result
+    assert orchestrator.endpointer_failed
+    print("[green]Voice turns fall back to a manual stop when the endpointer can't open the mic")
+    orchestrator.shutdown()
+
+    # A turn that takes too long is cancelled and the next one still works
+    gpt, orchestrator, events = make_orchestrator(answer, seconds_per_word=0.2, turn_timeout=0.5)
+    start = time.perf_counter()
+    result = orchestrator.submit_text_turn("Take your time").result(timeout=10)
+    assert result["status"] == "timeout", result
+    print(f"[green]Slow turn timed out after {time.perf_counter() - start:.2f}s")
+    gpt.seconds_per_word = 0.0
+    assert orchestrator.submit_text_turn("Now be quick").result(timeout=10)["status"] == "done"
+    print("[green]Next turn after a timeout runs normally")
+    orchestrator.shutdown()
+
+    # A repeated question is answered from the response cache, without waiting for GPT again
+    import tempfile
+    from response_cache import ResponseCache
+    gpt, orchestrator, events = make_orchestrator(answer, seconds_per_word=0.05)
+    gpt.response_cache = ResponseCache(os.path.join(tempfile.mkdtemp(), "responses.json"))
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        result = orchestrator.submit_text_turn("Explain this function.").result(timeout=10)
+        assert result["status"] == "done" and result["response"].strip() == answer, result
+        timings.append(time.perf_counter() - start)
+    assert gpt.response_cache.stats()["hits"] == 1 and timings[1] < timings[0], timings
+    print(f"[green]Repeated question: {timings[0]:.2f}s asking GPT, {timings[1]:.2f}s from the cache, {gpt.response_cache.stats()}")
+    orchestrator.shutdown()
+
+    # Every message goes to the journal, and the next run picks the conversation up from it
+    from conversation_journal import ConversationJournal
+    journal_path = os.path.join(tempfile.mkdtemp(), "ChatHistory.jsonl")
+    gpt, orchestrator, events = make_orchestrator(answer, seconds_per_word=0.0)
+    gpt.chat_history.append({"role": "system", "content": "You are a coding assistant."})
+    gpt.attach_journal(ConversationJournal(journal_path))
+    for prompt in ("First question", "Second question"):
+        orchestrator.submit_text_turn(prompt).result(timeout=10)
+    gpt.journal.flush()
+    orchestrator.shutdown()
+    next_run = FakeGptManager(answer)
+    next_run.chat_history.append({"role": "system", "content": "You are a coding assistant."})
+    assert next_run.attach_journal(ConversationJournal(journal_path)) == 4
+    assert list(next_run.chat_history) == list(gpt.chat_history) and next_run.chat_history.total_tokens == gpt.chat_history.total_tokens
+    print("[green]Conversation resumed from the journal")
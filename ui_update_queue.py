@@ -0,0 +1,181 @@
+import time
+import threading
+from collections import deque
+
+
+class UiUpdateQueue:
+    """
+    Hands UI updates from worker threads to the Tk main loop, which is the only thread allowed to touch widgets.
+    Anything can queue updates from any thread without blocking. Once per frame, the main loop drains the queue with root.after(),
+    and runs of small text appends to the same widget (e.g. streamed GPT deltas) are merged into one insert.
+    Frame times and queue depth are tracked, so we can check the UI keeps up during long streamed answers.
+
+    Parameters:
+    root: the Tk root (anything with after(ms, callback))
+    frame_ms (int): how often the queue is drained
+    max_updates_per_frame (int): caps the work done in one frame, whatever is left waits for the next one
+    """
+
+    def __init__(self, root, frame_ms=16, max_updates_per_frame=500):
+        self.root = root
+        self.frame_ms = frame_ms
+        self.max_updates_per_frame = max_updates_per_frame
+        self.lock = threading.Lock()
+        self.updates = deque()
+        self.running = False
+        # Metrics
+        self.frame_times_ms = deque(maxlen=1000)
+        self.frame_gaps_ms = deque(maxlen=1000)
+        self.last_frame_at = None
+        self.max_queue_depth = 0
+        self.updates_queued = 0
+        self.inserts = 0
+
+    def start(self):
+        """Call from the Tk thread, before root.mainloop()"""
+        self.running = True
+        self.root.after(self.frame_ms, self._on_frame)
+
+    def stop(self):
+        self.running = False
+
+    def append_text(self, widget, text, tag=None, scroll=True):
+        """Queues widget.insert(END, text, tag), merged with neighbouring appends to the same widget and tag"""
+        self._put(("text", widget, text, tag, scroll))
+
+    def call(self, callback, *args):
+        """Queues any other UI update, callback(*args) runs on the Tk thread in order with the text appends"""
+        self._put(("call", callback, args))
+
+    def drain(self):
+        """Applies everything queued so far (up to max_updates_per_frame). Must run on the Tk thread."""
+        started_at = time.perf_counter()
+        with self.lock:
+            count = min(len(self.updates), self.max_updates_per_frame)
+            updates = [self.updates.popleft() for _ in range(count)]
+
+        scroll_widgets = set()
+        text_run = []
+        for update in updates:
+            if update[0] == "text":
+                if text_run and (text_run[0][1], text_run[0][3]) != (update[1], update[3]):
+                    self._insert(text_run, scroll_widgets)
+                    text_run = []
+                text_run.append(update)
+            else:
+                if text_run:
+                    self._insert(text_run, scroll_widgets)
+                    text_run = []
+                callback, args = update[1], update[2]
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"UI update {getattr(callback, '__name__', callback)} failed: {e}")
+        if text_run:
+            self._insert(text_run, scroll_widgets)
+        # Scrolling makes Tk lay the text out again, so only do it once per widget per frame
+        for widget in scroll_widgets:
+            widget.see("end")
+
+        if updates:
+            self.frame_times_ms.append((time.perf_counter() - started_at) * 1000)
+
+    def stats(self):
+        frame_times = sorted(self.frame_times_ms)
+        return {
+            "frames": len(frame_times),
+            "avg_frame_ms": sum(frame_times) / len(frame_times) if frame_times else 0.0,
+            "p95_frame_ms": frame_times[int(len(frame_times) * 0.95)] if frame_times else 0.0,
+            "max_frame_ms": frame_times[-1] if frame_times else 0.0,
+            # Time between frames. Much more than frame_ms means something is holding up the main loop.
+            "max_frame_gap_ms": max(self.frame_gaps_ms, default=0.0),
+            "queue_depth": len(self.updates),
+            "max_queue_depth": self.max_queue_depth,
+            "updates_queued": self.updates_queued,
+            "inserts": self.inserts,
+        }
+
+    def _put(self, update):
+        with self.lock:
+            self.updates.append(update)
+            self.updates_queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.updates))
+
+    def _insert(self, text_run, scroll_widgets):
+        _, widget, _, tag, _ = text_run[0]
+        text = "".join(update[2] for update in text_run)
+        if tag is None:
+            widget.insert("end", text)
+        else:
+            widget.insert("end", text, tag)
+        self.inserts += 1
+        if any(update[4] for update in text_run):
+            scroll_widgets.add(widget)
+
+    def _on_frame(self):
+        now = time.perf_counter()
+        if self.last_frame_at is not None:
+            self.frame_gaps_ms.append((now - self.last_frame_at) * 1000)
+        self.last_frame_at = now
+        try:
+            self.drain()
+        finally:
+            if self.running:
+                self.root.after(self.frame_ms, self._on_frame)
+
+
+# Tests
+if __name__ == '__main__':
+    class FakeTextWidget:
+        def __init__(self):
+            self.text = ""
+            self.inserts = 0
+            self.scrolls = 0
+
+        def insert(self, index, text, tag=None):
+            self.text += text
+            self.inserts += 1
+
+        def see(self, index):
+            self.scrolls += 1
+
+    class FakeRoot:
+        def after(self, ms, callback):
+            pass
+
+    # A long streamed answer from a worker thread, a few tokens at a time, with the odd status update in between
+    widget = FakeTextWidget()
+    statuses = []
+    ui_updates = UiUpdateQueue(FakeRoot())
+    answer_tokens = [f"token{i} " for i in range(5000)]
+
+    def stream_answer():
+        for i, token in enumerate(answer_tokens):
+            ui_updates.append_text(widget, token)
+            if i % 1000 == 0:
+                ui_updates.call(statuses.append, f"status {i}")
+
+    worker = threading.Thread(target=stream_answer)
+    worker.start()
+    while worker.is_alive() or ui_updates.updates:
+        ui_updates.drain()
+        time.sleep(0.001)
+    worker.join()
+    ui_updates.drain()
+
+    assert widget.text == "".join(answer_tokens)
+    assert statuses == [f"status {i}" for i in range(0, 5000, 1000)]
+    stats = ui_updates.stats()
+    print(f"5000 appends became {widget.inserts} inserts and {widget.scrolls} scrolls")
+    print(f"UI stats: {stats}")
+    assert widget.inserts < 5000 / 5
+
+    # Appends with different tags (e.g. "AI: " in its own colour) are kept apart, and order is preserved
+    widget = FakeTextWidget()
+    ui_updates = UiUpdateQueue(FakeRoot())
+    ui_updates.append_text(widget, "AI: ", "ai")
+    ui_updates.append_text(widget, "Hello ")
+    ui_updates.append_text(widget, "there")
+    ui_updates.drain()
+    assert widget.text == "AI: Hello there" and widget.inserts == 2
+    print("Tags and ordering preserved")
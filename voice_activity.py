@@ -0,0 +1,241 @@
+import threading
+import numpy as np
+
+
+class EnergyVAD:
+    """
+    Voice activity detector that works on raw PCM frames with NumPy.
+    A frame counts as speech when it's loud enough above the background noise level, which is tracked while nobody talks.
+    Once at least min_utterance_ms of speech has been heard, hangover_ms of continuous silence ends the utterance.
+
+    Parameters:
+    sample_rate (int): samples per second of the PCM fed in
+    frame_ms (int): length of one analysis frame
+    threshold_db (float): how far above the noise floor a frame must be to count as speech
+    min_speech_db (float): frames quieter than this (dBFS) are never speech, however quiet the room is
+    hangover_ms (int): how much silence after speech ends the utterance (the endpointing delay, before tuning)
+    min_utterance_ms (int): utterances shorter than this (coughs, clicks) are ignored
+    start_frames (int): consecutive speech frames needed before we say the user started talking
+    calibration_ms (int): the very first audio is assumed to be background, and sets the starting noise floor
+    """
+
+    def __init__(self, sample_rate=16000, frame_ms=20, threshold_db=12.0, min_speech_db=-45.0,
+                 hangover_ms=700, min_utterance_ms=300, start_frames=3, calibration_ms=100):
+        self.sample_rate = sample_rate
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.frame_ms = frame_ms
+        self.threshold_db = threshold_db
+        self.min_speech_db = min_speech_db
+        self.hangover_frames = max(1, int(hangover_ms / frame_ms))
+        self.min_utterance_frames = max(1, int(min_utterance_ms / frame_ms))
+        self.start_frames = start_frames
+        self.calibration_frames = max(1, int(calibration_ms / frame_ms))
+        self.calibration_levels = []
+        self.noise_floor_db = None
+        self.reset()
+
+    def reset(self):
+        """Get ready for the next utterance (keeps the learned noise floor)"""
+        self.leftover = np.zeros(0, dtype=np.float32)
+        self.frames_seen = 0
+        self.in_speech = False
+        self.speech_run = 0
+        self.speech_frames = 0
+        self.silence_run = 0
+        self.speech_end_frame = None
+        self.utterance_ended = False
+
+    def process(self, pcm):
+        """
+        Feeds more audio in. pcm can be int16 or float samples (mono, or shaped (samples, channels)).
+        Returns True once, at the moment the end of the utterance is detected.
+        """
+        if self.utterance_ended:
+            return False
+        samples = np.asarray(pcm)
+        if samples.ndim == 2:
+            samples = samples.mean(axis=1)
+        if samples.dtype == np.int16:
+            samples = samples.astype(np.float32) / 32768.0
+        samples = np.concatenate((self.leftover, samples.astype(np.float32, copy=False)))
+
+        frame_count = len(samples) // self.frame_size
+        self.leftover = samples[frame_count * self.frame_size:]
+        if frame_count == 0:
+            return False
+        # Energy of every frame in one go, in dBFS
+        frames = samples[:frame_count * self.frame_size].reshape(frame_count, self.frame_size)
+        frame_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+
+        for energy_db in frame_db.tolist():
+            self.frames_seen += 1
+            if self._update(energy_db):
+                self.utterance_ended = True
+                return True
+        return False
+
+    @property
+    def speech_end_seconds(self):
+        """Stream time (seconds since reset) of the last speech frame of the utterance, once it has ended"""
+        if self.speech_end_frame is None:
+            return None
+        return self.speech_end_frame * self.frame_ms / 1000
+
+    @property
+    def detected_at_seconds(self):
+        """Stream time (seconds since reset) of the audio we had processed when the end was detected"""
+        return self.frames_seen * self.frame_ms / 1000
+
+    def _update(self, energy_db):
+        if self.noise_floor_db is None:
+            self.calibration_levels.append(energy_db)
+            if len(self.calibration_levels) >= self.calibration_frames:
+                self.noise_floor_db = float(np.median(self.calibration_levels))
+            return False
+
+        is_speech = energy_db > self.min_speech_db and energy_db > self.noise_floor_db + self.threshold_db
+        if not is_speech:
+            # Learn the room: drop quickly to quieter levels, rise slowly so speech tails don't pull the floor up
+            rate = 0.2 if energy_db < self.noise_floor_db else 0.02
+            self.noise_floor_db += rate * (energy_db - self.noise_floor_db)
+
+        if not self.in_speech:
+            self.speech_run = self.speech_run + 1 if is_speech else 0
+            if self.speech_run >= self.start_frames:
+                self.in_speech = True
+                self.speech_frames = self.speech_run
+                self.silence_run = 0
+            return False
+
+        if is_speech:
+            self.speech_frames += 1
+            self.silence_run = 0
+            self.speech_end_frame = self.frames_seen
+            return False
+
+        self.silence_run += 1
+        if self.silence_run < self.hangover_frames:
+            return False
+        if self.speech_frames < self.min_utterance_frames:
+            # Too short to be a real utterance, go back to waiting for speech
+            self.in_speech = False
+            self.speech_run = 0
+            self.speech_end_frame = None
+            return False
+        return True
+
+
+class MicrophoneEndpointer:
+    """
+    Listens to the first mic (through pygame's SDL2 capture device) and calls on_end_of_speech() as soon as
+    the user stops talking, so nobody has to press stop. Azure keeps its own mic stream, this only decides when to stop it.
+
+    Parameters:
+    on_end_of_speech (callable): called once per utterance, e.g. SpeechToTextManager.stop_recording
+    vad (EnergyVAD): optional detector with custom tuning, its sample_rate is used for capture
+    """
+
+    def __init__(self, on_end_of_speech, vad=None):
+        self.on_end_of_speech = on_end_of_speech
+        self.vad = vad if vad is not None else EnergyVAD()
+        self.capture_device = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        import pygame
+        from pygame._sdl2 import audio as sdl2_audio
+
+        with self.lock:
+            self.vad.reset()
+            if not pygame.mixer.get_init():
+                pygame.mixer.init(frequency=48000, buffer=1024)
+            capture_devices = sdl2_audio.get_audio_device_names(True)
+            if not capture_devices:
+                raise RuntimeError("No microphone found for voice activity detection")
+            self.capture_device = sdl2_audio.AudioDevice(
+                devicename=capture_devices[0],
+                iscapture=True,
+                frequency=self.vad.sample_rate,
+                audioformat=sdl2_audio.AUDIO_S16,
+                numchannels=1,
+                chunksize=self.vad.frame_size,
+                allowed_changes=0,
+                callback=self._on_audio
+            )
+            # Devices start paused
+            self.capture_device.pause(0)
+
+    def stop(self):
+        with self.lock:
+            if self.capture_device is not None:
+                self.capture_device.close()
+                self.capture_device = None
+
+    def _on_audio(self, audio_device, audio_memoryview):
+        # Runs on SDL's audio thread, so keep it short
+        if self.vad.process(np.frombuffer(audio_memoryview, dtype=np.int16)):
+            threading.Thread(target=self.on_end_of_speech, daemon=True).start()
+
+
+# Tests and benchmark
+if __name__ == '__main__':
+    import time
+    import wave
+
+    with wave.open("TestAudio_WAV.wav", "rb") as wav_file:
+        sample_rate = wav_file.getframerate()
+        channels = wav_file.getnchannels()
+        speech = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16).reshape(-1, channels)
+    speech = speech.mean(axis=1).astype(np.int16)
+
+    # Where the speech in the test file really ends: the last 20 ms frame above -40 dBFS
+    frame_size = sample_rate // 50
+    speech_frames = speech[:len(speech) // frame_size * frame_size].astype(np.float32).reshape(-1, frame_size) / 32768.0
+    loud_frames = np.nonzero(10 * np.log10(np.mean(speech_frames ** 2, axis=1) + 1e-12) > -40)[0]
+    speech_end_in_file = (loud_frames[-1] + 1) / 50
+
+    rng = np.random.default_rng(0)
+    def noise(seconds, level_db):
+        return (rng.standard_normal(int(seconds * sample_rate)) * 32768 * 10 ** (level_db / 20)).astype(np.int16)
+    def silence(seconds):
+        return np.zeros(int(seconds * sample_rate), dtype=np.int16)
+
+    def run_vad(stream, hangover_ms, chunk_ms=20):
+        vad = EnergyVAD(sample_rate=sample_rate, hangover_ms=hangover_ms)
+        chunk = int(sample_rate * chunk_ms / 1000)
+        for start in range(0, len(stream), chunk):
+            if vad.process(stream[start:start + chunk]):
+                return vad
+        return None
+
+    lead_in = 1.0
+    true_end = lead_in + speech_end_in_file
+    scenarios = {
+        "silence": np.concatenate((silence(lead_in), speech, silence(3))),
+        "noise -50 dBFS": np.concatenate((noise(lead_in, -50), speech + noise(len(speech) / sample_rate, -50), noise(3, -50))),
+        "noise -40 dBFS": np.concatenate((noise(lead_in, -40), speech + noise(len(speech) / sample_rate, -40), noise(3, -40))),
+    }
+
+    print(f"Speech in TestAudio_WAV.wav ends at {speech_end_in_file:.2f}s\n")
+    for hangover_ms in (300, 500, 700):
+        for name, stream in scenarios.items():
+            vad = run_vad(stream, hangover_ms)
+            assert vad is not None, f"No end of speech detected with {name}"
+            delay = vad.detected_at_seconds - true_end
+            print(f"hangover {hangover_ms} ms, {name:15}: end detected {delay * 1000:6.0f} ms after speech ended")
+            assert 0 < delay < hangover_ms / 1000 + 0.3
+
+    # Background alone should never count as an utterance
+    for name, stream in (("pure silence", silence(5)), ("pure noise", noise(5, -40))):
+        assert run_vad(stream, 500) is None, f"False end of speech on {name}"
+    print("\nNo false triggers on pure silence or noise")
+
+    # Speed: how much faster than real time the detector runs
+    long_stream = np.tile(scenarios["noise -40 dBFS"], 10)
+    vad = EnergyVAD(sample_rate=sample_rate, hangover_ms=10 ** 9)
+    start = time.perf_counter()
+    for chunk_start in range(0, len(long_stream), 960):
+        vad.process(long_stream[chunk_start:chunk_start + 960])
+    elapsed = time.perf_counter() - start
+    audio_seconds = len(long_stream) / sample_rate
+    print(f"Processed {audio_seconds:.0f}s of audio in {elapsed * 1000:.0f} ms ({audio_seconds / elapsed:.0f}x real time)")
@@ -1,67 +1,515 @@
 import websocket
+import os
 import json
+import time
+import random
+import socket
+import itertools
+import threading
+import concurrent.futures
+from collections import deque
+from latency_histogram import LatencyHistogram
+from command_stream_parser import StreamingCommandParser
+from editor_context import EditorContextMirror
+
+
+class EditorConnection:
+    """
+    Keeps a WebSocket to server.js alive for as long as the app runs.
+    The connection is (re)opened in the background with exponential backoff, so server.js can be started late or restarted.
+    Sending never blocks: messages go into a bounded outbox that a sender thread flushes whenever we're connected.
+    A heartbeat ping goes out whenever the line has been quiet for a while, so a peer that hung is noticed in seconds.
+
+    Parameters:
+    url (str): WebSocket server URL
+    max_outbox (int): messages kept while disconnected, the oldest are dropped beyond this
+    max_queued_seconds (float): messages older than this are dropped instead of sent, an edit meant for where the cursor was a minute ago does more harm than good
+    heartbeat_interval (float): seconds of silence before we ping
+    heartbeat_timeout (float): seconds to wait for the pong before giving up on the connection
+    min_backoff, max_backoff (float): range of the wait between reconnect attempts
+    on_message (callable): on_message(text) for every text message from the server, called on the receiver thread
+    hello_message (str): sent first on every (re)connect, before anything in the outbox, so the server knows who we are
+    """
+
+    def __init__(self, url, max_outbox=100, max_queued_seconds=30.0, heartbeat_interval=2.0, heartbeat_timeout=2.0,
+                 min_backoff=0.1, max_backoff=5.0, connect_timeout=2.0, on_message=None, hello_message=None):
+        self.url = url
+        self.max_outbox = max_outbox
+        self.max_queued_seconds = max_queued_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.on_message = on_message
+        self.hello_message = hello_message
+        # How often the receiver wakes up to check on the heartbeat
+        self.tick = min(heartbeat_interval, heartbeat_timeout) / 4
+
+        self.condition = threading.Condition()
+        self.outbox = deque()  # (time queued, message, on_sent, on_dropped)
+        self.ws = None
+        self.closed = False
+        self.closed_event = threading.Event()
+        self.connected_event = threading.Event()
+        self.connects = 0
+        self.sent = 0
+        self.dropped = 0
+        self.expired = 0
+        self.heartbeat_failures = 0
+        self.receiver_thread = threading.Thread(target=self._connection_loop, name="editor-receiver", daemon=True)
+        self.sender_thread = threading.Thread(target=self._send_loop, name="editor-sender", daemon=True)
+
+    def start(self):
+        self.receiver_thread.start()
+        self.sender_thread.start()
+        return self
+
+    @property
+    def connected(self):
+        return self.connected_event.is_set()
+
+    def wait_until_connected(self, timeout=None):
+        return self.connected_event.wait(timeout)
+
+    def send(self, message, on_sent=None, on_dropped=None):
+        """
+        Queues a text message and returns right away. Returns whether we're connected (i.e. it goes out now, not later).
+        on_sent (callable): on_sent(), called on the sender thread once the message has been written to the socket
+        on_dropped (callable): on_dropped(reason), called if the message is never going to be sent
+        """
+        dropped = None
+        with self.condition:
+            if self.closed:
+                # Nothing is left to send it, so it fails right away
+                dropped = (time.monotonic(), message, on_sent, on_dropped)
+                reason = "The connection to VS Code was closed"
+            elif len(self.outbox) >= self.max_outbox:
+                dropped = self.outbox.popleft()
+                self.dropped += 1
+                reason = "Too many commands were waiting for VS Code"
+                print("❌ Too many commands waiting for VS Code, dropped the oldest one")
+            if not self.closed:
+                self.outbox.append((time.monotonic(), message, on_sent, on_dropped))
+                self.condition.notify_all()
+            connected = self.ws is not None and not self.closed
+        if dropped is not None:
+            self._dropped(dropped, reason)
+        return connected
+
+    def stats(self):
+        with self.condition:
+            return {
+                "connected": self.connected,
+                "connects": self.connects,
+                "sent": self.sent,
+                "queued": len(self.outbox),
+                "dropped": self.dropped,
+                "expired": self.expired,
+                "heartbeat_failures": self.heartbeat_failures,
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            ws = self.ws
+            unsent = list(self.outbox)
+            self.outbox.clear()
+            self.condition.notify_all()
+        self.closed_event.set()
+        for queued in unsent:
+            self._dropped(queued, "The connection to VS Code was closed")
+        if ws is not None:
+            try:
+                ws.close(timeout=1)
+            except Exception:
+                pass
+
+    def _connection_loop(self):
+        backoff = self.min_backoff
+        outage_reported = False
+        while not self.closed:
+            try:
+                # TCP_NODELAY: commands are tiny, so don't let Nagle hold them back waiting for more data
+                ws = websocket.create_connection(
+                    self.url,
+                    timeout=self.connect_timeout,
+                    sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),),
+                    enable_multithread=True
+                )
+                if self.hello_message is not None:
+                    ws.send(self.hello_message)
+            except Exception as e:
+                if not outage_reported:
+                    print(f"❌ Can't reach the VS Code WebSocket server ({e}), will keep retrying")
+                    outage_reported = True
+                # Random jitter, so a restarting server isn't hit by every client at the same moment
+                self.closed_event.wait(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = self.min_backoff
+            outage_reported = False
+            ws.settimeout(self.tick)
+            with self.condition:
+                self.ws = ws
+                self.connects += 1
+                self.condition.notify_all()
+            self.connected_event.set()
+            print("✅ Connected to the VS Code WebSocket server")
+            try:
+                self._receive_loop(ws)
+            finally:
+                with self.condition:
+                    self.ws = None
+                    self.condition.notify_all()
+                self.connected_event.clear()
+                ws.shutdown()
+            if not self.closed:
+                print("❌ Lost the connection to VS Code, reconnecting...")
+
+    def _receive_loop(self, ws):
+        last_heard = time.monotonic()
+        ping_sent_at = None
+        while not self.closed:
+            try:
+                opcode, frame = ws.recv_data_frame(control_frame=True)
+            except websocket.WebSocketTimeoutException:
+                now = time.monotonic()
+                if ping_sent_at is not None and now - ping_sent_at > self.heartbeat_timeout:
+                    self.heartbeat_failures += 1
+                    print("❌ VS Code server stopped answering heartbeats")
+                    return
+                if ping_sent_at is None and now - last_heard > self.heartbeat_interval:
+                    try:
+                        ws.ping()
+                    except Exception:
+                        return
+                    ping_sent_at = now
+                continue
+            except Exception:
+                # Connection reset, closed by the sender after a failed send, ...
+                return
+
+            # Anything at all from the server proves it's alive
+            last_heard = time.monotonic()
+            ping_sent_at = None
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                return
+            if opcode == websocket.ABNF.OPCODE_TEXT and self.on_message is not None:
+                try:
+                    self.on_message(frame.data.decode("utf-8") if isinstance(frame.data, bytes) else frame.data)
+                except Exception as e:
+                    print(f"❌ Error handling a message from VS Code: {e}")
+
+    def _send_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (self.ws is not None and self.outbox))
+                if self.closed:
+                    return
+                ws = self.ws
+                queued = self.outbox.popleft()
+            queued_at, message, on_sent, on_dropped = queued
+            if time.monotonic() - queued_at > self.max_queued_seconds:
+                self.expired += 1
+                print("❌ Dropped a VS Code command that waited too long for the connection")
+                self._dropped(queued, "Waited too long for the connection to VS Code")
+                continue
+            try:
+                ws.send(message)
+                self.sent += 1
+            except Exception:
+                with self.condition:
+                    # Keep it for the next connection, and don't spin on this broken one
+                    self.outbox.appendleft(queued)
+                ws.shutdown()
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed or self.ws is not ws)
+                continue
+            if on_sent is not None:
+                on_sent()
+
+    @staticmethod
+    def _dropped(queued, reason):
+        on_dropped = queued[3]
+        if on_dropped is not None:
+            on_dropped(reason)
+
 
 class VSCodeAPIHandler:
-    def __init__(self):
-        self.ws_url = "ws://localhost:5001"  # WebSocket server URL
-        try:
-            self.ws = websocket.create_connection(self.ws_url)
-            print("✅ Prisijungta prie WebSocket serverio!")  # DEBUG
-        except Exception as e:
-            print(f"❌ WebSocket prisijungimo klaida: {e}")
+    """
+    Sends editor commands to VS Code (through server.js). Every command carries an id, and the extension answers with an
+    ack or nack saying whether the edit landed and how long applying it took.
+    The extension also keeps editor_context (an EditorContextMirror) up to date with the file that's open, and tells
+    workspace_listeners about the workspace folder and file changes ({"type": "workspace", "folders"} / {"type": "filesChanged", "paths"}).
+
+    Parameters:
+    ws_url (str): WebSocket server URL
+    ack_timeout (float): seconds to wait for the extension's answer before calling the command failed
+    """
+
+    def __init__(self, ws_url="ws://localhost:5001", ack_timeout=5.0):
+        self.ws_url = ws_url  # WebSocket server URL
+        self.ack_timeout = ack_timeout
+        self.lock = threading.Lock()
+        self.command_ids = itertools.count(1)
+        # command id -> (future, command, time sent)
+        self.pending_commands = {}
+        # command -> {"round_trip": LatencyHistogram, "apply": LatencyHistogram}
+        self.latency = {}
+        self.editor_context = EditorContextMirror(request_resync=self._request_resync)
+        # callback(message) for workspace and filesChanged messages
+        self.workspace_listeners = []
+        # Connects in the background and keeps reconnecting, so a missing or restarted server.js never blocks us
+        self.connection = EditorConnection(
+            self.ws_url,
+            on_message=self._on_message,
+            hello_message=json.dumps({"type": "hello", "role": "python"})
+        ).start()
 
     def extract_code_from_markdown(self, text):
-        """Extract code from markdown code blocks."""
+        """Extract code from the first markdown code block (any language, ``` or ~~~)."""
         if not text:
             return ""
-        
-        lines = text.split('\n')
-        code_lines = []
-        in_code_block = False
-        
-        for line in lines:
-            if line.strip().startswith('```'):
-                if not in_code_block:  # Start of code block
-                    in_code_block = True
-                    continue
-                else:  # End of code block
-                    in_code_block = False
-                    break  # Stop after first code block
-            elif in_code_block:
-                # Skip the language identifier line (e.g., "python")
-                if code_lines or not line.strip().lower() == 'python':
-                    code_lines.append(line)
-        
-        return '\n'.join(code_lines)
-
-    def send_command(self, command, content=None):
-        """Siunčia komandą į WebSocket serverį (`server.js`)."""
+        parser = StreamingCommandParser()
+        parser.feed(text)
+        parser.finish()
+        return parser.code_blocks[0] if parser.code_blocks else ""
+
+    def send_command(self, command, content=None, session=None):
+        """
+        Siunčia komandą į WebSocket serverį (`server.js`).
+        Returns a Future for the result dict: id, command, ok, error, apply_ms (time VS Code spent on the edit)
+        and round_trip_ms (from this call until the answer came back). Use asyncio.wrap_future to await it.
+        session (str): see apply_edits
+        """
+        future = concurrent.futures.Future()
+        command_id = f"py{os.getpid()}-{next(self.command_ids)}"
         try:
             # Clean up the content if it's a code insertion
             if command == "insertGeneratedCode":
                 content = self.extract_code_from_markdown(content)
                 print(f"Extracted code to insert: {content}")  # Debug print
             
-            message = json.dumps({"command": command, "content": content})
-            self.ws.send(message)
-            print(f"✅ Sent command to VS Code: {command}")  # DEBUG
+            message = {"id": command_id, "command": command, "content": content}
+            if session:
+                message["session"] = session
+            message = json.dumps(message)
+            with self.lock:
+                self.pending_commands[command_id] = (future, command, time.perf_counter())
+            # The ack timer only starts once the command is on the wire. While VS Code is away it waits in the outbox,
+            # and failing it then would be a lie: it still gets applied once we reconnect.
+            if self.connection.send(message, on_sent=lambda: self._start_ack_timer(command_id),
+                                    on_dropped=lambda reason: self._fail_command(command_id, reason)):
+                print(f"✅ Sent command to VS Code: {command}")  # DEBUG
+            elif not self.connection.closed:
+                print(f"⏳ VS Code isn't connected, {command} will be sent once it is")
         except Exception as e:
             print(f"❌ Klaida siunčiant komandą: {e}")
+            with self.lock:
+                self.pending_commands.pop(command_id, None)
+            future.set_result(self._command_result(command_id, command, False, str(e)))
+        return future
 
     def insert_generated_code(self, content=None):  # Modified to accept content
         """Sends command to insert generated code into VS Code."""
-        self.send_command("insertGeneratedCode", content)
+        return self.send_command("insertGeneratedCode", content)
 
-    def edit_line(self):
-        """Siunčia komandą redaguoti pasirinktą eilutę VS Code."""
-        self.send_command("editLine")
+    def edit_line(self, content=None):
+        """Siunčia komandą redaguoti pasirinktą eilutę VS Code (the line is replaced with content)."""
+        return self.send_command("editLine", content)
 
     def delete_line(self):
         """Sends command to delete the selected line in VS Code."""
-        self.send_command("deleteLine")  # Make sure we use exactly "deleteLine" to match the extension
+        return self.send_command("deleteLine")  # Make sure we use exactly "deleteLine" to match the extension
+
+    def apply_edits(self, operations, session=None):
+        """
+        Sends several edits that VS Code applies together, in one editor.edit (one round trip, one undo step).
+        operations: list of {"op": "insert" | "replaceLine" | "deleteLine", "line": 1-based line or None for the cursor, "content": code}
+        Line numbers refer to the document as it is before any of the edits.
+        session (str): batches sent with the same session (e.g. one answer's edits, sent while it streams in) still
+        share one undo step, and their line numbers keep referring to the document before the session's first batch.
+        """
+        return self.send_command("batch", operations, session)
+
+    def end_edit_session(self, session):
+        """Tells VS Code that session's edits are done, so the user's next changes get an undo step of their own"""
+        self.connection.send(json.dumps({"type": "endSession", "session": session}))
+
+    def latency_stats(self):
+        """Round-trip and VS Code apply-time summaries, per command"""
+        with self.lock:
+            latency = dict(self.latency)
+        return {
+            command: {name: histogram.summary() for name, histogram in histograms.items()}
+            for command, histograms in latency.items()
+        }
+
+    def _request_resync(self):
+        self.connection.send(json.dumps({"type": "resync"}))
 
     def close(self):
         """Uždaro WebSocket ryšį."""
-        self.ws.close()
+        self.connection.close()
+
+    @staticmethod
+    def _command_result(command_id, command, ok, error=None, apply_ms=None, round_trip_ms=None):
+        return {
+            "id": command_id,
+            "command": command,
+            "ok": ok,
+            "error": error,
+            "apply_ms": apply_ms,
+            "round_trip_ms": round_trip_ms,
+        }
+
+    def _on_message(self, text):
+        message = json.loads(text)
+        if self.editor_context.handle_message(message):
+            return
+        if message.get("type") in ("workspace", "filesChanged"):
+            for listener in list(self.workspace_listeners):
+                listener(message)
+            return
+        if message.get("type") != "ack":
+            return
+        with self.lock:
+            pending = self.pending_commands.pop(message.get("id"), None)
+        if pending is None:
+            # Answer for a command we already gave up on
+            return
+        future, command, sent_at = pending
+        round_trip_ms = (time.perf_counter() - sent_at) * 1000
+        apply_ms = message.get("applyMs")
+        with self.lock:
+            histograms = self.latency.setdefault(command, {"round_trip": LatencyHistogram(), "apply": LatencyHistogram()})
+        histograms["round_trip"].record(round_trip_ms)
+        if apply_ms is not None:
+            histograms["apply"].record(apply_ms)
+        ok = bool(message.get("ok"))
+        if not ok:
+            print(f"❌ VS Code couldn't apply {command}: {message.get('error')}")
+        future.set_result(self._command_result(message["id"], command, ok, message.get("error"), apply_ms, round_trip_ms))
+
+    def _start_ack_timer(self, command_id):
+        ack_timer = threading.Timer(self.ack_timeout, self._on_ack_timeout, args=(command_id,))
+        ack_timer.daemon = True
+        ack_timer.start()
+
+    def _on_ack_timeout(self, command_id):
+        with self.lock:
+            pending = self.pending_commands.get(command_id)
+        if pending is not None:
+            print(f"❌ No answer from VS Code for {pending[1]} within {self.ack_timeout}s")
+        self._fail_command(command_id, f"No answer from VS Code within {self.ack_timeout:.0f} seconds")
+
+    def _fail_command(self, command_id, error):
+        with self.lock:
+            pending = self.pending_commands.pop(command_id, None)
+        if pending is None:
+            return
+        future, command, sent_at = pending
+        future.set_result(self._command_result(command_id, command, False, error))
+
+
+# Tests, against an in-process server that gets killed and restarted mid-session (no server.js or VS Code needed)
+if __name__ == '__main__':
+    from local_ws_server import LocalWebSocketServer
+
+    def fake_extension(server, client, text):
+        # Plays server.js and the extension: acks every command, and can't edit lines yet
+        message = json.loads(text)
+        if message.get("type") == "resync":
+            server.send(client, json.dumps({"type": "document", "uri": "file:///a.py", "languageId": "python", "version": 9,
+                                            "text": "resynced", "cursorLine": 0}))
+        if "command" not in message:
+            return
+        ok = message["command"] != "editLine"
+        ack = {"type": "ack", "id": message["id"], "ok": ok, "applyMs": 3, "error": None if ok else "editLine isn't supported"}
+        server.send(client, json.dumps(ack))
+
+    def received_commands():
+        return [json.loads(message)["command"] for message in server.received if "command" in json.loads(message)]
+
+    server = LocalWebSocketServer(on_message=fake_extension).start()
+    vscode_api = VSCodeAPIHandler(server.url, ack_timeout=1.0)
+    assert vscode_api.connection.wait_until_connected(5)
+    result = vscode_api.delete_line().result(timeout=5)
+    assert result["ok"] and result["apply_ms"] == 3 and result["round_trip_ms"] > 0, result
+    assert json.loads(server.received[0]) == {"type": "hello", "role": "python"}
+    print(f"Command acknowledged: {result}")
+    result = vscode_api.edit_line().result(timeout=5)
+    assert not result["ok"] and result["error"] == "editLine isn't supported", result
+    print(f"Failure reported back: {result}")
+
+    def wait_for_version(version):
+        deadline = time.perf_counter() + 5
+        while vscode_api.editor_context.version != version and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert vscode_api.editor_context.version == version, vscode_api.editor_context.stats()
+
+    # The open file is mirrored: one snapshot, then only changes. A gap in the versions gets a fresh snapshot.
+    server.broadcast(json.dumps({"type": "document", "uri": "file:///a.py", "languageId": "python", "version": 1,
+                                 "text": "a = 1\nb = 2", "cursorLine": 1}))
+    server.broadcast(json.dumps({"type": "documentChange", "uri": "file:///a.py", "fromVersion": 1, "version": 2, "changes": [
+        {"range": {"start": {"line": 1, "character": 4}, "end": {"line": 1, "character": 5}}, "text": "3"}]}))
+    wait_for_version(2)
+    assert vscode_api.editor_context.lines == ["a = 1", "b = 3"]
+    server.broadcast(json.dumps({"type": "documentChange", "uri": "file:///a.py", "fromVersion": 5, "version": 6, "changes": []}))
+    wait_for_version(9)
+    assert vscode_api.editor_context.lines == ["resynced"]
+    print(f"Editor mirror: {vscode_api.editor_context.stats()}")
+
+    # Kill the server. Sending keeps working (commands are queued) and never blocks.
+    server.stop()
+    while vscode_api.connection.connected:
+        time.sleep(0.01)
+    start = time.perf_counter()
+    futures = [vscode_api.delete_line() for _ in range(3)]
+    print(f"3 sends while disconnected took {(time.perf_counter() - start) * 1000:.2f} ms")
+    assert vscode_api.connection.stats()["queued"] == 3
+
+    # Restart it on the same port, the queued commands go out (and get acked) as soon as we're back.
+    # The outage is longer than ack_timeout: a command that hasn't been sent yet can't have timed out.
+    time.sleep(1.5)
+    restarted_at = time.perf_counter()
+    server.start()
+    assert all(future.result(timeout=5)["ok"] for future in futures)
+    assert received_commands() == ["deleteLine", "editLine"] + ["deleteLine"] * 3
+    print(f"Reconnected and flushed the queue {(time.perf_counter() - restarted_at) * 1000:.0f} ms after the restart")
+    print(f"Latency stats: {vscode_api.latency_stats()}")
+
+    # Nobody answers: the command fails after ack_timeout instead of hanging forever
+    server.on_message = None
+    result = vscode_api.delete_line().result(timeout=5)
+    assert not result["ok"] and "No answer" in result["error"], result
+
+    # Closing with commands still waiting for the connection fails them instead of leaving them hanging
+    server.stop()
+    while vscode_api.connection.connected:
+        time.sleep(0.01)
+    future = vscode_api.delete_line()
+    vscode_api.close()
+    result = future.result(timeout=1)
+    assert not result["ok"] and "closed" in result["error"], result
+    # And so does anything sent after closing
+    result = vscode_api.delete_line().result(timeout=0.1)
+    assert not result["ok"] and "closed" in result["error"], result
+    server.start()
 
-# ❌ Ištriname `if __name__ == '__main__':` dalį, kad nesivykdytų automatiškai.
+    # A peer that stops answering (but doesn't close the socket) is noticed by the heartbeat
+    connection = EditorConnection(server.url, heartbeat_interval=0.2, heartbeat_timeout=0.2).start()
+    assert connection.wait_until_connected(5)
+    server.answer_pings = False
+    hung_at = time.perf_counter()
+    while connection.heartbeat_failures == 0 and time.perf_counter() - hung_at < 5:
+        time.sleep(0.01)
+    assert connection.heartbeat_failures == 1
+    print(f"Hung peer detected after {(time.perf_counter() - hung_at) * 1000:.0f} ms")
+    server.answer_pings = True
+    assert connection.wait_until_connected(5)
+    print(f"Connection stats: {connection.stats()}")
+    connection.close()
+    server.stop()
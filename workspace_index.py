@@ -0,0 +1,600 @@
+import os
+import re
+import json
+import math
+import time
+import zlib
+import threading
+import functools
+from array import array
+from collections import Counter
+import numpy as np
+from rich import print
+
+INDEX_FORMAT_VERSION = 1
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+# fetchData -> fetch, data; HTTPServer -> http, server; parse_v2 -> parse, v, 2
+SUBWORD = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+STOP_WORDS = frozenset(
+    "the and for are but not you all any can was this that with from have has had what when where which who why how "
+    "self def return import class none true false null var let const function if else elif in is of to it as or an be on at by"
+    .split()
+)
+INDEXED_EXTENSIONS = frozenset(
+    ".py .pyi .js .jsx .ts .tsx .mjs .cjs .java .kt .scala .c .h .cc .cpp .hpp .cs .go .rs .rb .php .swift .m .lua .r "
+    ".sh .bat .ps1 .sql .html .css .scss .vue .svelte .md .rst .txt .json .yaml .yml .toml .ini .cfg"
+    .split()
+)
+SKIPPED_DIRECTORIES = frozenset(
+    "node_modules __pycache__ venv env site-packages dist build out target coverage".split()
+)
+# chunk_files value of a chunk whose file was changed or removed
+DELETED = 0xFFFFFFFF
+
+
+def tokenize(text):
+    """Lower-cased identifiers and words, plus the parts of camelCase / snake_case names, so "fetch data" finds fetchData"""
+    terms = []
+    for identifier in IDENTIFIER.findall(text):
+        term = identifier.lower()
+        if 2 <= len(term) <= 40 and term not in STOP_WORDS:
+            terms.append(term)
+        if "_" in identifier or not (identifier.islower() or identifier.isupper()):
+            for part in SUBWORD.findall(identifier):
+                part = part.lower()
+                if part != term and 2 <= len(part) <= 40 and part not in STOP_WORDS:
+                    terms.append(part)
+    return terms
+
+
+@functools.lru_cache(maxsize=200000)
+def term_hash(term):
+    # Terms are only stored as 32-bit hashes, that's what keeps the index small (no vocabulary)
+    return zlib.crc32(term.encode("utf-8"))
+
+
+class WorkspaceIndex:
+    """
+    Offline BM25 index of the code in a workspace folder, so prompts can include the bits of the project that matter.
+    Files are split into overlapping chunks of lines. Only term hashes, counts and line ranges are kept, the text is read
+    back from disk for the few chunks that end up in a prompt.
+
+    Postings live in two places: a compact base segment (numpy arrays sorted by term hash) and a small, unsorted segment of
+    recent additions that's merged into the base once it grows. A changed or removed file only marks its chunks deleted
+    (a tombstone), the merge drops them for good. The base segment is also what gets saved to disk (one compressed .npz).
+
+    Changes come in through notify_changed (e.g. from VS Code's file watcher) and a slow full rescan catches anything missed.
+
+    Parameters:
+    root (str): the workspace folder
+    index_path (str): where the index is saved, defaults to ~/.cache/ai_voice_assistant/
+    chunk_lines (int): lines per chunk
+    chunk_overlap (int): lines shared by neighbouring chunks, so code on a chunk border is still found
+    max_files (int): files beyond this are not indexed, keeps memory bounded on huge repos
+    max_file_bytes (int): bigger files (generated code, data) are skipped
+    merge_postings (int): recent postings kept outside the base segment before they're merged into it
+    rescan_interval (float): seconds between full rescans in the background thread
+    """
+
+    def __init__(self, root, index_path=None, chunk_lines=40, chunk_overlap=10, max_files=50000,
+                 max_file_bytes=512 * 1024, merge_postings=500000, rescan_interval=300.0):
+        self.root = os.path.abspath(root)
+        if index_path is None:
+            index_path = os.path.join(os.path.expanduser("~"), ".cache", "ai_voice_assistant",
+                                      f"workspace_{term_hash(self.root):08x}.npz")
+        self.index_path = index_path
+        self.chunk_lines = chunk_lines
+        self.chunk_overlap = chunk_overlap
+        self.max_files = max_files
+        self.max_file_bytes = max_file_bytes
+        self.merge_postings = merge_postings
+        self.rescan_interval = rescan_interval
+        # BM25 parameters
+        self.k1 = 1.2
+        self.b = 0.75
+
+        self.lock = threading.RLock()
+        # relative path -> [mtime_ns, size, file id, first chunk, chunk count]
+        self.files = {}
+        # file id -> relative path, None once the file is gone
+        self.file_paths = []
+        # Per chunk: file id (DELETED for tombstones), first and last line (1-based) and number of terms
+        self.chunk_files = array("I")
+        self.chunk_starts = array("I")
+        self.chunk_ends = array("I")
+        self.chunk_lengths = array("I")
+        self.live_chunks = 0
+        self.live_terms = 0
+
+        # Base segment: the postings of term_hashes[i] are posting_chunks/posting_counts[term_offsets[i]:term_offsets[i + 1]]
+        self.term_hashes = np.zeros(0, dtype=np.uint32)
+        self.term_offsets = np.zeros(1, dtype=np.int64)
+        self.posting_chunks = np.zeros(0, dtype=np.uint32)
+        self.posting_counts = np.zeros(0, dtype=np.uint16)
+        # Recent additions, one entry per (term, chunk), in the order they were added
+        self.recent_hashes = array("I")
+        self.recent_chunks = array("I")
+        self.recent_counts = array("H")
+
+        self.changed_paths = set()
+        self.wake_up = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.dirty = False
+        self.last_scan = None
+
+    # Background indexing
+
+    def start(self):
+        """Loads the saved index and keeps it up to date on a background thread"""
+        self.thread = threading.Thread(target=self._run, name="workspace-index", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, save=True):
+        self.stopped.set()
+        self.wake_up.set()
+        if self.thread is not None:
+            self.thread.join()
+        if save and self.dirty:
+            self.save()
+
+    def notify_changed(self, paths):
+        """Absolute paths that were created, changed or deleted. They're re-indexed on the background thread."""
+        with self.lock:
+            self.changed_paths.update(paths)
+        self.wake_up.set()
+
+    def _run(self):
+        try:
+            if os.path.exists(self.index_path):
+                self.load()
+            self.refresh()
+            self.save()
+        except Exception as e:
+            print(f"[red]Couldn't index {self.root}: {e}")
+            self.last_scan = time.monotonic()
+        while not self.stopped.is_set():
+            self.wake_up.wait(timeout=self.rescan_interval)
+            self.wake_up.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.process_changes()
+                if time.monotonic() - self.last_scan >= self.rescan_interval:
+                    self.refresh()
+                    if self.dirty:
+                        self.save()
+            except Exception as e:
+                print(f"[red]Couldn't update the workspace index: {e}")
+
+    # Indexing
+
+    def refresh(self):
+        """Walks the workspace, indexing new and changed files and forgetting deleted ones. Returns counts of each."""
+        start = time.perf_counter()
+        seen = set()
+        added = updated = 0
+        for relative_path, full_path, stat in self._walk():
+            if self.stopped.is_set():
+                # Half a scan can't tell which files are gone
+                return {"added": added, "updated": updated, "removed": 0}
+            seen.add(relative_path)
+            entry = self.files.get(relative_path)
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                continue
+            if entry is None and len(self.files) >= self.max_files:
+                continue
+            if self._index_file(relative_path, full_path, stat):
+                if entry is None:
+                    added += 1
+                else:
+                    updated += 1
+        removed = 0
+        for relative_path in list(self.files):
+            if relative_path not in seen:
+                self._remove_file(relative_path)
+                removed += 1
+        self.last_scan = time.monotonic()
+        if added or updated or removed:
+            print(f"[green]Workspace index: {added} files added, {updated} updated, {removed} removed "
+                  f"in {time.perf_counter() - start:.1f}s ({len(self.files)} files, {self.live_chunks} chunks)")
+        return {"added": added, "updated": updated, "removed": removed}
+
+    def process_changes(self):
+        """Re-indexes the paths passed to notify_changed"""
+        with self.lock:
+            changed_paths, self.changed_paths = self.changed_paths, set()
+        for full_path in changed_paths:
+            full_path = os.path.abspath(full_path)
+            relative_path = os.path.relpath(full_path, self.root).replace(os.sep, "/")
+            if relative_path.startswith("../") or not self._is_indexed_path(relative_path):
+                continue
+            try:
+                stat = os.stat(full_path)
+            except OSError:
+                stat = None
+            if stat is None or stat.st_size > self.max_file_bytes:
+                if relative_path in self.files:
+                    self._remove_file(relative_path)
+                continue
+            entry = self.files.get(relative_path)
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                continue
+            if entry is None and len(self.files) >= self.max_files:
+                continue
+            self._index_file(relative_path, full_path, stat)
+        return len(changed_paths)
+
+    def _walk(self):
+        for directory, directory_names, file_names in os.walk(self.root):
+            # Pruned in place, so os.walk never goes into them
+            directory_names[:] = [name for name in directory_names if not name.startswith(".") and name not in SKIPPED_DIRECTORIES]
+            for file_name in file_names:
+                if os.path.splitext(file_name)[1].lower() not in INDEXED_EXTENSIONS:
+                    continue
+                full_path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(full_path)
+                except OSError:
+                    continue
+                if stat.st_size <= self.max_file_bytes:
+                    yield os.path.relpath(full_path, self.root).replace(os.sep, "/"), full_path, stat
+
+    @staticmethod
+    def _is_indexed_path(relative_path):
+        parts = relative_path.split("/")
+        if any(part.startswith(".") or part in SKIPPED_DIRECTORIES for part in parts[:-1]):
+            return False
+        return os.path.splitext(parts[-1])[1].lower() in INDEXED_EXTENSIONS
+
+    def _read_text(self, full_path):
+        with open(full_path, "rb") as file:
+            data = file.read()
+        # Binary files don't belong in a prompt
+        if b"\0" in data[:8192]:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def _chunk(self, text):
+        lines = text.split("\n")
+        step = self.chunk_lines - self.chunk_overlap
+        chunks = []
+        for start in range(0, max(len(lines) - self.chunk_overlap, 1), step):
+            end = min(start + self.chunk_lines, len(lines))
+            term_counts = Counter(tokenize("\n".join(lines[start:end])))
+            if term_counts:
+                hashes = array("I", [term_hash(term) for term in term_counts])
+                counts = array("H", [min(count, 65535) for count in term_counts.values()])
+                chunks.append((start + 1, end, hashes, counts, sum(term_counts.values())))
+        return chunks
+
+    def _index_file(self, relative_path, full_path, stat):
+        try:
+            text = self._read_text(full_path)
+        except OSError:
+            return False
+        # Tokenizing is the slow part and doesn't need the lock, so searches aren't held up by it
+        chunks = self._chunk(text) if text is not None else []
+        with self.lock:
+            if relative_path in self.files:
+                self._remove_file(relative_path)
+            file_id = len(self.file_paths)
+            self.file_paths.append(relative_path)
+            first_chunk = len(self.chunk_files)
+            for start_line, end_line, hashes, counts, chunk_length in chunks:
+                chunk_id = len(self.chunk_files)
+                self.chunk_files.append(file_id)
+                self.chunk_starts.append(start_line)
+                self.chunk_ends.append(end_line)
+                self.chunk_lengths.append(chunk_length)
+                self.live_chunks += 1
+                self.live_terms += chunk_length
+                self.recent_hashes.extend(hashes)
+                self.recent_chunks.extend(array("I", [chunk_id]) * len(hashes))
+                self.recent_counts.extend(counts)
+            self.files[relative_path] = [stat.st_mtime_ns, stat.st_size, file_id, first_chunk, len(chunks)]
+            self.dirty = True
+            if len(self.recent_hashes) >= self.merge_postings:
+                self.merge()
+        return True
+
+    def _remove_file(self, relative_path):
+        with self.lock:
+            _, _, file_id, first_chunk, chunk_count = self.files.pop(relative_path)
+            self.file_paths[file_id] = None
+            for chunk_id in range(first_chunk, first_chunk + chunk_count):
+                self.chunk_files[chunk_id] = DELETED
+                self.live_chunks -= 1
+                self.live_terms -= self.chunk_lengths[chunk_id]
+            self.dirty = True
+
+    def merge(self):
+        """
+        Moves the recent postings into the base segment and drops deleted chunks for good (chunk and file ids are renumbered).
+        All numpy, so it takes well under a second even for big indexes.
+        """
+        with self.lock:
+            chunk_files = np.frombuffer(self.chunk_files, dtype=np.uint32) if len(self.chunk_files) else np.zeros(0, dtype=np.uint32)
+            live = chunk_files != DELETED
+            new_chunk_ids = (np.cumsum(live) - 1).astype(np.uint32)
+
+            # Every posting as (term hash, chunk, count), base and recent together
+            base_hashes = np.repeat(self.term_hashes, np.diff(self.term_offsets))
+            hashes = np.concatenate([base_hashes, np.frombuffer(self.recent_hashes, dtype=np.uint32)])
+            chunks = np.concatenate([self.posting_chunks, np.frombuffer(self.recent_chunks, dtype=np.uint32)])
+            counts = np.concatenate([self.posting_counts, np.frombuffer(self.recent_counts, dtype=np.uint16)])
+
+            keep = live[chunks] if len(chunks) else np.zeros(0, dtype=bool)
+            hashes, chunks, counts = hashes[keep], new_chunk_ids[chunks[keep]], counts[keep]
+            order = np.lexsort((chunks, hashes))
+            hashes, self.posting_chunks, self.posting_counts = hashes[order], chunks[order], counts[order]
+            self.term_hashes, first_postings = np.unique(hashes, return_index=True)
+            self.term_offsets = np.append(first_postings, len(hashes)).astype(np.int64)
+            self.recent_hashes, self.recent_chunks, self.recent_counts = array("I"), array("I"), array("H")
+
+            # Files keep their chunks contiguous, so only the ids change
+            new_file_ids = {}
+            file_paths = []
+            for file_id, relative_path in enumerate(self.file_paths):
+                if relative_path is not None:
+                    new_file_ids[file_id] = len(file_paths)
+                    file_paths.append(relative_path)
+            self.file_paths = file_paths
+            for entry in self.files.values():
+                entry[2] = new_file_ids[entry[2]]
+                entry[3] = int(new_chunk_ids[entry[3]]) if entry[4] else 0
+            remap_files = np.array([new_file_ids.get(file_id, 0) for file_id in range(max(new_file_ids, default=-1) + 1)], dtype=np.uint32)
+            live_files = chunk_files[live]
+            self.chunk_files = array("I", remap_files[live_files].tobytes()) if len(live_files) else array("I")
+            self.chunk_starts = array("I", np.frombuffer(self.chunk_starts, dtype=np.uint32)[live].tobytes()) if len(live_files) else array("I")
+            self.chunk_ends = array("I", np.frombuffer(self.chunk_ends, dtype=np.uint32)[live].tobytes()) if len(live_files) else array("I")
+            self.chunk_lengths = array("I", np.frombuffer(self.chunk_lengths, dtype=np.uint32)[live].tobytes()) if len(live_files) else array("I")
+
+    # Searching
+
+    def search(self, query, k=5):
+        """Top k chunks for the query by BM25: list of (score, relative path, first line, last line)"""
+        query_hashes = {term_hash(term) for term in tokenize(query)}
+        with self.lock:
+            if not query_hashes or not self.live_chunks:
+                return []
+            chunk_files = np.frombuffer(self.chunk_files, dtype=np.uint32)
+            chunk_lengths = np.frombuffer(self.chunk_lengths, dtype=np.uint32)
+            recent = (np.frombuffer(self.recent_hashes, dtype=np.uint32), np.frombuffer(self.recent_chunks, dtype=np.uint32),
+                      np.frombuffer(self.recent_counts, dtype=np.uint16)) if len(self.recent_hashes) else None
+            average_length = self.live_terms / self.live_chunks
+            scores = np.zeros(len(chunk_files), dtype=np.float32)
+            for hash_value in query_hashes:
+                chunks, counts = self._postings(hash_value, recent)
+                live = chunk_files[chunks] != DELETED
+                chunks, counts = chunks[live], counts[live].astype(np.float32)
+                if not len(chunks):
+                    continue
+                idf = math.log(1 + (self.live_chunks - len(chunks) + 0.5) / (len(chunks) + 0.5))
+                length_norm = self.k1 * (1 - self.b + self.b * chunk_lengths[chunks] / average_length)
+                # A chunk is in a term's postings at most once, so this never adds to the same score twice
+                scores[chunks] += idf * counts * (self.k1 + 1) / (counts + length_norm)
+            top = np.argpartition(-scores, min(k, len(scores) - 1))[:k] if len(scores) > k else np.arange(len(scores))
+            top = sorted((chunk for chunk in top if scores[chunk] > 0), key=lambda chunk: -scores[chunk])
+            return [(float(scores[chunk]), self.file_paths[chunk_files[chunk]], self.chunk_starts[chunk], self.chunk_ends[chunk]) for chunk in top]
+
+    def _postings(self, hash_value, recent):
+        position = np.searchsorted(self.term_hashes, hash_value)
+        if position < len(self.term_hashes) and self.term_hashes[position] == hash_value:
+            start, end = self.term_offsets[position], self.term_offsets[position + 1]
+            chunks, counts = self.posting_chunks[start:end], self.posting_counts[start:end]
+        else:
+            chunks, counts = self.posting_chunks[:0], self.posting_counts[:0]
+        if recent is not None:
+            # The recent segment is small (see merge_postings), a scan is fine
+            recent_hashes, recent_chunks, recent_counts = recent
+            matches = recent_hashes == hash_value
+            if matches.any():
+                chunks = np.concatenate([chunks, recent_chunks[matches]])
+                counts = np.concatenate([counts, recent_counts[matches]])
+        return chunks, counts
+
+    def relevant_snippets(self, query, max_tokens, encoding, k=8):
+        """
+        The best matching chunks, read back from disk and formatted for a prompt, as many as fit in max_tokens.
+        Chunks overlapping one that's already in are skipped. Returns "" if nothing matches.
+        """
+        snippets = []
+        tokens_left = max_tokens
+        taken = []
+        for _, relative_path, start_line, end_line in self.search(query, k):
+            if any(path == relative_path and start_line <= taken_end and end_line >= taken_start for path, taken_start, taken_end in taken):
+                continue
+            try:
+                with open(os.path.join(self.root, relative_path), encoding="utf-8", errors="replace") as file:
+                    lines = file.read().split("\n")[start_line - 1:end_line]
+            except OSError:
+                continue
+            snippet = f"{relative_path}, lines {start_line}-{end_line}:\n```\n" + "\n".join(lines) + "\n```"
+            snippet_tokens = len(encoding.encode(snippet))
+            if snippet_tokens > tokens_left:
+                continue
+            tokens_left -= snippet_tokens
+            taken.append((relative_path, start_line, end_line))
+            snippets.append(snippet)
+        return "\n\n".join(snippets)
+
+    # Saving
+
+    def save(self):
+        """Saves the index (merged first) as one compressed .npz, written to a temporary file and swapped in"""
+        with self.lock:
+            self.merge()
+            header = {
+                "version": INDEX_FORMAT_VERSION,
+                "root": self.root,
+                "chunk_lines": self.chunk_lines,
+                "chunk_overlap": self.chunk_overlap,
+                "files": self.files,
+                "file_paths": self.file_paths,
+            }
+            arrays = {
+                "header": np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8),
+                "chunk_files": np.frombuffer(self.chunk_files, dtype=np.uint32),
+                "chunk_starts": np.frombuffer(self.chunk_starts, dtype=np.uint32),
+                "chunk_ends": np.frombuffer(self.chunk_ends, dtype=np.uint32),
+                "chunk_lengths": np.frombuffer(self.chunk_lengths, dtype=np.uint32),
+                "term_hashes": self.term_hashes,
+                "term_offsets": self.term_offsets,
+                "posting_chunks": self.posting_chunks,
+                "posting_counts": self.posting_counts,
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+            temporary_path = self.index_path + ".tmp.npz"
+            np.savez_compressed(temporary_path, **arrays)
+            os.replace(temporary_path, self.index_path)
+            self.dirty = False
+
+    def load(self):
+        """Loads a saved index. Returns False (and keeps the empty index) if it's missing or was made with other settings."""
+        try:
+            with np.load(self.index_path, allow_pickle=False) as saved:
+                header = json.loads(saved["header"].tobytes().decode("utf-8"))
+                if (header["version"] != INDEX_FORMAT_VERSION or header["root"] != self.root
+                        or header["chunk_lines"] != self.chunk_lines or header["chunk_overlap"] != self.chunk_overlap):
+                    return False
+                arrays = {name: saved[name] for name in saved.files if name != "header"}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[yellow]Couldn't load the workspace index, rebuilding it: {e}")
+            return False
+        with self.lock:
+            self.files = header["files"]
+            self.file_paths = header["file_paths"]
+            self.chunk_files = array("I", arrays["chunk_files"].tobytes())
+            self.chunk_starts = array("I", arrays["chunk_starts"].tobytes())
+            self.chunk_ends = array("I", arrays["chunk_ends"].tobytes())
+            self.chunk_lengths = array("I", arrays["chunk_lengths"].tobytes())
+            self.term_hashes = arrays["term_hashes"]
+            self.term_offsets = arrays["term_offsets"]
+            self.posting_chunks = arrays["posting_chunks"]
+            self.posting_counts = arrays["posting_counts"]
+            self.recent_hashes, self.recent_chunks, self.recent_counts = array("I"), array("I"), array("H")
+            self.live_chunks = len(self.chunk_files)
+            self.live_terms = int(np.frombuffer(self.chunk_lengths, dtype=np.uint32).sum(dtype=np.int64)) if self.live_chunks else 0
+            self.dirty = False
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.files),
+                "chunks": self.live_chunks,
+                "deleted_chunks": len(self.chunk_files) - self.live_chunks,
+                "terms": len(self.term_hashes),
+                "postings": len(self.posting_chunks) + len(self.recent_hashes),
+                "recent_postings": len(self.recent_hashes),
+                "memory_bytes": (self.term_hashes.nbytes + self.term_offsets.nbytes + self.posting_chunks.nbytes + self.posting_counts.nbytes
+                                 + 4 * len(self.chunk_files) * 4 + 10 * len(self.recent_hashes)),
+            }
+
+
+# Tests and benchmark: python workspace_index.py [number of files]
+if __name__ == '__main__':
+    import sys
+    import random
+    import shutil
+    import tempfile
+    import tracemalloc
+    from latency_histogram import LatencyHistogram
+
+    workspace = tempfile.mkdtemp(prefix="workspace_index_test_")
+
+    def write_file(relative_path, text):
+        full_path = os.path.join(workspace, relative_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        return full_path
+
+    try:
+        # Small workspace: the right file comes first, and changes show up after notify_changed
+        write_file("api/client.py", "import requests\n\ndef fetchData(url):\n    return requests.get(url).json()\n")
+        write_file("ui/button.ts", "export function renderButton(label: string) {\n  return `<button>${label}</button>`;\n}\n")
+        write_file("README.md", "# Demo\nA project that fetches data and renders buttons.\n")
+        write_file("node_modules/lib/index.js", "function fetchData() {}\n")
+        write_file(".git/config", "fetchData")
+        index = WorkspaceIndex(workspace, index_path=os.path.join(workspace, ".index", "index.npz"))
+        assert index.refresh() == {"added": 3, "updated": 0, "removed": 0}
+        assert index.search("fetch data from a url")[0][1] == "api/client.py"
+        assert index.search("render the button")[0][1] == "ui/button.ts"
+        assert index.search("nothing like this") == []
+
+        full_path = write_file("api/client.py", "def uploadFile(path):\n    pass\n")
+        os.remove(os.path.join(workspace, "ui/button.ts"))
+        index.notify_changed([full_path, os.path.join(workspace, "ui/button.ts")])
+        assert index.process_changes() == 2
+        assert [result[1] for result in index.search("fetch data")] == ["README.md"]
+        assert index.search("upload file")[0][1] == "api/client.py" and index.search("render button") == []
+        assert index.stats()["deleted_chunks"] == 2
+        index.save()
+        assert index.stats()["deleted_chunks"] == 0 and index.search("upload file")[0][1] == "api/client.py"
+        reloaded = WorkspaceIndex(workspace, index_path=index.index_path)
+        assert reloaded.load() and reloaded.search("upload file") == index.search("upload file")
+        assert reloaded.refresh() == {"added": 0, "updated": 0, "removed": 0}
+        print("[green]Search, incremental updates, tombstones, merge and save/load work")
+        shutil.rmtree(workspace)
+        os.makedirs(workspace)
+
+        # Benchmark on a generated repo
+        file_count = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+        rng = random.Random(0)
+        words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+        for file_number in range(file_count):
+            lines = []
+            for function_number in range(rng.randint(3, 12)):
+                name = f"{rng.choice(words)}_{rng.choice(words)}"
+                lines.append(f"def {name}({rng.choice(words)}, {rng.choice(words)}Value):")
+                lines.append(f"    \"\"\"{' '.join(rng.choice(words) for _ in range(8))}\"\"\"")
+                for _ in range(rng.randint(3, 15)):
+                    lines.append(f"    {rng.choice(words)} = {rng.choice(words)}.{rng.choice(words)}({rng.choice(words)}, {rng.randint(0, 99)})")
+                lines.append("")
+            write_file(f"src/package_{file_number % 50}/module_{file_number}.py", "\n".join(lines))
+
+        index_path = os.path.join(tempfile.gettempdir(), "workspace_index_benchmark.npz")
+        index = WorkspaceIndex(workspace, index_path=index_path)
+        start = time.perf_counter()
+        index.refresh()
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        index.save()
+        save_seconds = time.perf_counter() - start
+
+        query_latency = LatencyHistogram()
+        for _ in range(200):
+            query = " ".join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+            start = time.perf_counter()
+            index.search(query, k=8)
+            query_latency.record((time.perf_counter() - start) * 1000)
+
+        changed = [write_file(f"src/package_0/module_{file_number}.py", f"def changed_{file_number}():\n    pass\n") for file_number in range(0, 500, 50)]
+        index.notify_changed(changed)
+        start = time.perf_counter()
+        index.process_changes()
+        update_ms = (time.perf_counter() - start) * 1000
+        assert index.search("changed_50")[0][1] == "src/package_0/module_50.py"
+
+        # Memory the loaded index actually holds on to (tracemalloc sees numpy's buffers too)
+        tracemalloc.start()
+        start = time.perf_counter()
+        reloaded = WorkspaceIndex(workspace, index_path=index_path)
+        reloaded.load()
+        load_ms = (time.perf_counter() - start) * 1000
+        loaded_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        summary = query_latency.summary()
+        stats = index.stats()
+        print(f"[green]{file_count} files, {stats['chunks']} chunks, {stats['postings']} postings")
+        print(f"[green]Build {build_seconds:.2f}s, save {save_seconds * 1000:.0f} ms, load {load_ms:.0f} ms, "
+              f"{len(changed)} changed files re-indexed in {update_ms:.1f} ms")
+        print(f"[green]Query p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, max {summary['max_ms']:.2f} ms")
+        print(f"[green]Index arrays {stats['memory_bytes'] / 1e6:.1f} MB, {loaded_bytes / 1e6:.1f} MB in memory after loading, "
+              f"{os.path.getsize(index_path) / 1e6:.1f} MB on disk")
+        os.remove(index_path)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)